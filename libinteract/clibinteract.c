@@ -284,6 +284,132 @@ int square_mindist(double* coords1, double* coords2, int nframes, int nsets1, in
 }
 
 
+int cell_pairs(double* coords1, int n1, double* coords2, int n2, double co, long* pairs, int max_pairs) {
+
+  // find all pairs of points of coords1 and coords2 closer than co
+  // using a cell list of coords2. Up to max_pairs pairs are written
+  // to pairs (as i, j) and the total number of pairs is returned
+  int i = 0;
+  int j = 0;
+  int d = 0;
+  int npairs = 0;
+  double lo[3];
+  double hi[3];
+  int dims[3];
+  int cell[3];
+  int neigh[3];
+  double size = co;
+  long ncells = 0;
+  long c = 0;
+  int* head;
+  int* next;
+  double co2 = co*co;
+  double dist2 = 0.0;
+  double diff = 0.0;
+
+  if (n1 == 0 || n2 == 0 || co <= 0.0)
+    return 0;
+
+  // bounding box of coords2
+  for (d=0; d<3; d++) {
+    lo[d] = coords2[d];
+    hi[d] = coords2[d];
+  }
+  for (j=1; j<n2; j++) {
+    for (d=0; d<3; d++) {
+      if (coords2[j*3+d] < lo[d]) lo[d] = coords2[j*3+d];
+      if (coords2[j*3+d] > hi[d]) hi[d] = coords2[j*3+d];
+    }
+  }
+
+  // cells must be at least as large as the cut-off; they are
+  // enlarged if there would be many more cells than points
+  while (1) {
+    ncells = 1;
+    for (d=0; d<3; d++) {
+      dims[d] = (int) ((hi[d] - lo[d]) / size) + 1;
+      ncells *= dims[d];
+    }
+    if (ncells <= 8 * (long) n2 + 64)
+      break;
+    size *= 2.0;
+  }
+
+  // linked lists of the points in each cell
+  head = (int*) malloc(ncells * sizeof(int));
+  next = (int*) malloc(n2 * sizeof(int));
+  for (c=0; c<ncells; c++)
+    head[c] = -1;
+  for (j=0; j<n2; j++) {
+    for (d=0; d<3; d++)
+      cell[d] = (int) ((coords2[j*3+d] - lo[d]) / size);
+    c = ((long) cell[0] * dims[1] + cell[1]) * dims[2] + cell[2];
+    next[j] = head[c];
+    head[c] = j;
+  }
+
+  for (i=0; i<n1; i++) {
+    for (d=0; d<3; d++)
+      cell[d] = (int) floor((coords1[i*3+d] - lo[d]) / size);
+    // visit the cell of the point and its neighbours
+    for (neigh[0]=cell[0]-1; neigh[0]<=cell[0]+1; neigh[0]++) {
+      if (neigh[0] < 0 || neigh[0] >= dims[0]) continue;
+      for (neigh[1]=cell[1]-1; neigh[1]<=cell[1]+1; neigh[1]++) {
+	if (neigh[1] < 0 || neigh[1] >= dims[1]) continue;
+	for (neigh[2]=cell[2]-1; neigh[2]<=cell[2]+1; neigh[2]++) {
+	  if (neigh[2] < 0 || neigh[2] >= dims[2]) continue;
+	  c = ((long) neigh[0] * dims[1] + neigh[1]) * dims[2] + neigh[2];
+	  for (j=head[c]; j!=-1; j=next[j]) {
+	    dist2 = 0.0;
+	    for (d=0; d<3; d++) {
+	      diff = coords1[i*3+d] - coords2[j*3+d];
+	      dist2 += diff*diff;
+	    }
+	    if (dist2 <= co2) {
+	      if (npairs < max_pairs) {
+		pairs[npairs*2] = i;
+		pairs[npairs*2+1] = j;
+	      }
+	      npairs++;
+	    }
+	  }
+	}
+      }
+    }
+  }
+
+  free(head);
+  free(next);
+  return npairs;
+}
+
+int count_pairs(long* keys, long* weights, int nkeys, long* table_keys, long* table_counts, long* table_order, int capacity, int used) {
+
+  // add weights to the counts of keys in an open addressing hash
+  // table (capacity must be a power of two and the table must not
+  // fill up). Empty slots have key -1, and the order of first
+  // insertion is kept. Return the number of keys in the table
+  int i = 0;
+  unsigned long mask = (unsigned long) capacity - 1;
+  unsigned long slot = 0;
+
+  for (i=0; i<nkeys; i++) {
+    // Fibonacci hashing
+    slot = (((unsigned long) keys[i] * 11400714819323198485UL) >> 32) & mask;
+    while (table_keys[slot] != -1 && table_keys[slot] != keys[i])
+      slot = (slot + 1) & mask;
+    if (table_keys[slot] == -1) {
+      table_keys[slot] = keys[i];
+      table_counts[slot] = 0;
+      table_order[slot] = used;
+      used++;
+    }
+    table_counts[slot] += weights[i];
+  }
+  return used;
+}
+
+
 
 //int main() {
 
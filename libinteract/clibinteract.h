@@ -27,4 +27,6 @@ int triangular_distmatrix(double*, int, int, double, long*);
 int square_distmatrix(double*, double*, int, int, int, double, long*);
 int triangular_mindist(double*, int, int, long*, double, long*);
 int square_mindist(double*, double*, int, int, int, long*, long*, double, long*);
+int cell_pairs(double*, int, double*, int, double, long*, int);
+int count_pairs(long*, long*, int, long*, long*, long*, int, int);
 
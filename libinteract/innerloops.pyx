@@ -88,3 +88,35 @@ class LoopDistances():
 	
         return np.reshape(results, (nsets, nsets))	
 
+
+
+def run_cell_pairs(p_coords1, p_coords2, co):
+    """Find all the pairs of points (i in coords1, j in coords2)
+    closer than co, using a cell list. Return an array of i, j."""
+
+    cdef np.ndarray[np.float64_t, ndim=2] coords1 = np.ascontiguousarray(p_coords1, dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=2] coords2 = np.ascontiguousarray(p_coords2, dtype=np.float64)
+    cdef int max_pairs = 16*coords1.shape[0] + 16
+    cdef np.ndarray[np.int_t, ndim=1] pairs = np.zeros((max_pairs*2), dtype=np.int_)
+    cdef int npairs
+
+    npairs = innerloops.cell_pairs(<double*> coords1.data, coords1.shape[0], <double*> coords2.data, coords2.shape[0], co, <long*> pairs.data, max_pairs)
+    # run again with enough room if there were more pairs
+    if npairs > max_pairs:
+        max_pairs = npairs
+        pairs = np.zeros((max_pairs*2), dtype=np.int_)
+        npairs = innerloops.cell_pairs(<double*> coords1.data, coords1.shape[0], <double*> coords2.data, coords2.shape[0], co, <long*> pairs.data, max_pairs)
+
+    return np.reshape(pairs[:npairs*2], (npairs, 2))
+
+def run_count_pairs(p_keys, p_weights, p_table_keys, p_table_counts, p_table_order, used):
+    """Add weights to the counts of keys in a hash table (see
+    count_pairs in clibinteract.c). Return the number of keys."""
+
+    cdef np.ndarray[np.int_t, ndim=1] keys = np.ascontiguousarray(p_keys, dtype=np.int_)
+    cdef np.ndarray[np.int_t, ndim=1] weights = np.ascontiguousarray(p_weights, dtype=np.int_)
+    cdef np.ndarray[np.int_t, ndim=1] table_keys = p_table_keys
+    cdef np.ndarray[np.int_t, ndim=1] table_counts = p_table_counts
+    cdef np.ndarray[np.int_t, ndim=1] table_order = p_table_order
+
+    return innerloops.count_pairs(<long*> keys.data, <long*> weights.data, keys.shape[0], <long*> table_keys.data, <long*> table_counts.data, <long*> table_order.data, table_keys.shape[0], used)
@@ -21,19 +21,695 @@
 #   along with this program.
 #   If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
 import sys
 import logging as log
 import collections
+import contextlib
 import itertools
+import hashlib
+import multiprocessing
 import configparser as cp
 import json
 import struct
+import time
 import numpy as np
-import MDAnalysis as mda
 
 from libinteract import innerloops as il
 
 
+############################## PROFILING ##############################
+
+# wall and CPU time spent in each stage (None if profiling is off)
+_profile = None
+# stages currently running, outermost first
+_profile_stack = []
+# wall and CPU time when profiling was enabled
+_profile_start = None
+
+def enable_profiling():
+    """Start recording the wall and CPU time spent in each stage of
+    the analyses."""
+
+    global _profile, _profile_start
+
+    _profile = collections.OrderedDict()
+    del _profile_stack[:]
+    _profile_start = (time.perf_counter(), time.process_time())
+
+
+def disable_profiling():
+    """Stop recording the time spent in each stage."""
+
+    global _profile, _profile_start
+
+    _profile = None
+    del _profile_stack[:]
+    _profile_start = None
+
+
+@contextlib.contextmanager
+def profile_stage(name):
+    """Record the time spent in a stage, nested in the stages
+    currently running (e.g. "hc/kernel"). The statistics of the stage
+    are yielded (None if profiling is off)."""
+
+    if _profile is None:
+        yield None
+        return
+    _profile_stack.append(name)
+    key = "/".join(_profile_stack)
+    stats = _profile.setdefault(key, \
+                                {"wall" : 0.0, \
+                                 "cpu" : 0.0, \
+                                 "calls" : 0, \
+                                 "frames" : 0})
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield stats
+    finally:
+        stats["wall"] += time.perf_counter() - wall
+        stats["cpu"] += time.process_time() - cpu
+        stats["calls"] += 1
+        _profile_stack.pop()
+
+
+def profile_iter(name, iterable):
+    """Iterate over an iterable, recording the time spent getting
+    each item as a stage (one call per item)."""
+
+    iterator = iter(iterable)
+    while True:
+        with profile_stage(name) as stats:
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            # the time spent finding the end is recorded, but no item
+            # was got
+            if stats is not None:
+                stats["calls"] -= 1
+            return
+        yield item
+
+
+def profile_frames(numframes):
+    """Record the number of frames analyzed by the outermost stage
+    currently running."""
+
+    if _profile is not None and _profile_stack:
+        _profile[_profile_stack[0]]["frames"] += numframes
+
+
+def get_profile_report():
+    """Get the time spent in each stage, and the frames per second
+    of the stages which analyzed frames, as a dictionary."""
+
+    if _profile is None:
+        return None
+    stages = []
+    for key, stats in _profile.items():
+        stage = {"stage" : key, \
+                 "wall_s" : stats["wall"], \
+                 "cpu_s" : stats["cpu"], \
+                 "calls" : stats["calls"]}
+        if stats["frames"]:
+            stage["frames"] = stats["frames"]
+            stage["frames_per_s"] = \
+                stats["frames"]/stats["wall"] if stats["wall"] else None
+        stages.append(stage)
+    return {"wall_s" : time.perf_counter() - _profile_start[0], \
+            "cpu_s" : time.process_time() - _profile_start[1], \
+            "stages" : stages}
+
+
+############################# COORDINATES #############################
+
+class CoordinatesCache:
+    def __repr__(self):
+        fmt_repr = "<CoordinatesCache {:d} frames, {:d} atoms>"
+        return fmt_repr.format(self.coords.shape[0], self.coords.shape[1])
+
+    def __init__(self, coords, indices = None):
+        # coordinates must be stored as frames x atoms x 3
+        if coords.ndim != 3 or coords.shape[2] != 3:
+            errstr = \
+                "Coordinates must be an array of shape " \
+                "(frames x atoms x 3), but {:s} was found."
+            raise ValueError(errstr.format(str(coords.shape)))
+        # without an index, the array is assumed to hold all the
+        # atoms of the system, in the same order
+        if indices is None:
+            indices = np.arange(coords.shape[1])
+        indices = np.asarray(indices, dtype = np.int64)
+        if indices.shape != (coords.shape[1],):
+            errstr = \
+                "The atom index has {:d} elements, but the " \
+                "coordinates refer to {:d} atoms."
+            raise ValueError(errstr.format(len(indices), coords.shape[1]))
+        if np.any(np.diff(indices) <= 0):
+            raise ValueError("Atom indices must be sorted and unique.")
+        self.coords = coords
+        self.indices = indices
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def get_columns(self, atomgroup):
+        """Get where (index along the atoms axis) the atoms of an
+        atom group are stored in the cache."""
+
+        atom_indices = atomgroup.indices
+        columns = np.searchsorted(self.indices, atom_indices)
+        # atoms after the last cached atom would be out of bounds
+        found = columns < len(self.indices)
+        found[found] = self.indices[columns[found]] == atom_indices[found]
+        if not np.all(found):
+            errstr = \
+                "{:d} atom(s) needed by the analysis are not present " \
+                "in the coordinates cache."
+            raise ValueError(errstr.format(np.sum(~found)))
+        return columns
+
+
+def get_cache_index_fname(fname):
+    """Get the name of the file storing the atom index of a
+    coordinates cache."""
+
+    return os.path.splitext(fname)[0] + ".idx.npy"
+
+
+def write_coords_cache(uni, selections, fname):
+    """Store the coordinates of all the atoms in the selections
+    along the trajectory in a memory-mapped .npy file, and their
+    indices in a sidecar file."""
+
+    # atoms to be cached, sorted and without duplicates
+    indices = np.unique(np.concatenate([sel.indices for sel in selections]))
+    atoms = uni.atoms[indices]
+    numframes = len(uni.trajectory)
+    # the array is written to disk frame by frame
+    coords = np.lib.format.open_memmap(fname, \
+                                       mode = "w+", \
+                                       dtype = np.float32, \
+                                       shape = (numframes, len(atoms), 3))
+    for ts_i, ts in enumerate(uni.trajectory):
+        # log the progress along the trajectory
+        logstr = "Caching coordinates: frame {:d} / {:d} ({:3.1f}%)\r"
+        sys.stdout.write(\
+            logstr.format(ts_i + 1, \
+                          numframes, \
+                          float(ts_i + 1)/float(numframes)*100.0))
+        sys.stdout.flush()
+        coords[ts_i] = atoms.positions
+    coords.flush()
+    np.save(get_cache_index_fname(fname), indices)
+    # return the cache, ready to be used
+    return CoordinatesCache(coords, indices)
+
+
+def load_coords_cache(fname):
+    """Load a coordinates cache (memory-mapped). If no atom index
+    is found next to it, the array must contain all the atoms of
+    the system."""
+
+    coords = np.load(fname, mmap_mode = "r")
+    idx_fname = get_cache_index_fname(fname)
+    indices = np.load(idx_fname) if os.path.exists(idx_fname) else None
+    return CoordinatesCache(coords, indices)
+
+
+def get_numframes(uni, coords_cache = None, start = None, stop = None):
+    """Get the number of frames to be analyzed (between the start
+    and stop frames, if given)."""
+
+    if coords_cache is None:
+        numframes = len(uni.trajectory)
+    else:
+        numframes = len(coords_cache)
+    return len(range(numframes)[start:stop])
+
+
+def iter_positions(uni, \
+                   selections, \
+                   coords_cache = None, \
+                   start = None, \
+                   stop = None):
+    """For each frame (between the start and stop frames, if given),
+    yield the list of the positions of the atoms in each selection,
+    read either from the trajectory or from a coordinates cache."""
+
+    if coords_cache is None:
+        for ts in profile_iter("read", uni.trajectory[start:stop]):
+            yield [sel.positions for sel in selections]
+    else:
+        columns = [coords_cache.get_columns(sel) for sel in selections]
+        for frame in profile_iter("read", coords_cache.coords[start:stop]):
+            # read the whole frame at once
+            frame = np.asarray(frame)
+            yield [frame[c] for c in columns]
+
+
+############################### PARALLEL ##############################
+
+# function and shared arguments of the job currently run by forked
+# worker processes, which inherit them instead of receiving them
+# pickled
+_forked_job = None
+
+def _run_forked(item):
+    """Run the current job on a single item."""
+
+    func, shared = _forked_job
+    return func(item, *shared)
+
+
+def get_nprocs(nprocs = None, ntasks = None):
+    """Get the number of worker processes to use: nprocs (by default
+    one per CPU), at least one and no more than ntasks."""
+
+    if nprocs is None:
+        nprocs = os.cpu_count() or 1
+    if ntasks is not None:
+        nprocs = min(nprocs, ntasks)
+    return max(1, nprocs)
+
+
+@contextlib.contextmanager
+def forked_map(func, shared = (), nprocs = None):
+    """Yield a function lazily mapping func(item, *shared) over the
+    items of an iterable, in order. Items are processed by forked
+    worker processes (see get_nprocs for nprocs), or in this process
+    if only one is used or fork is not available. On exit, the
+    workers complete the items already submitted, unless the exit
+    is caused by an interruption (e.g. KeyboardInterrupt)."""
+
+    global _forked_job
+
+    nprocs = get_nprocs(nprocs)
+    # jobs may be nested (e.g. in the serial fallback)
+    previous = _forked_job
+    _forked_job = (func, shared)
+    pool = None
+    interrupted = False
+    try:
+        if nprocs > 1 and \
+           "fork" in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context("fork").Pool(nprocs)
+            yield lambda items, chunksize = 1: \
+                pool.imap(_run_forked, items, chunksize)
+        else:
+            yield lambda items, chunksize = 1: map(_run_forked, items)
+    except BaseException as exc:
+        interrupted = not isinstance(exc, Exception)
+        raise
+    finally:
+        if pool is not None and interrupted:
+            pool.terminate()
+        elif pool is not None:
+            # terminating workers while they send their results can
+            # leave the pool deadlocked
+            pool.close()
+            pool.join()
+        _forked_job = previous
+
+
+def run_forked(func, shared, items, nprocs = None):
+    """Call func(item, *shared) for each item, in forked worker
+    processes (see forked_map; by default one per item up to the
+    number of CPUs). Return the list of the results, in order."""
+
+    items = list(items)
+    nprocs = get_nprocs(nprocs, len(items))
+    # the same chunks as multiprocessing.Pool.map
+    chunksize = max(1, -(-len(items) // (nprocs * 4)))
+    with forked_map(func, shared, nprocs) as fmap:
+        return list(fmap(items, chunksize))
+
+
+############################### REPLICAS ##############################
+
+def _run_replica(trj, func, uni):
+    """Run a job on a single replica."""
+
+    # replace the trajectory, leaving topology and selections untouched
+    uni.load_new(trj)
+    return func(uni)
+
+
+def run_replicas(func, uni, trjs, nprocs = None):
+    """Call func(uni) once for each trajectory, after loading it in
+    the Universe. Replicas are processed concurrently by forked worker
+    processes (one per replica, unless nprocs is given), so that the
+    topology and the atom selections are only built once."""
+
+    if nprocs is None:
+        nprocs = len(trjs)
+    return run_forked(_run_replica, (func, uni), trjs, nprocs)
+
+
+############################### RECORDS ###############################
+
+# fields of the records of each kind of interaction (the indexes
+# refer to the persistence matrix for interactions, to the residues
+# of the reference for the statistical potential and to the atoms
+# of the topology for hydrogen bonds)
+INTERACT_FIELDS = [("index1", int), ("segid1", str), ("resid1", int), \
+                   ("resname1", str), ("group1", str), \
+                   ("index2", int), ("segid2", str), ("resid2", int), \
+                   ("resname2", str), ("group2", str), \
+                   ("persistence", float)]
+POTENTIAL_FIELDS = [("index1", int), ("segid1", str), ("resid1", int), \
+                    ("resname1", str), \
+                    ("index2", int), ("segid2", str), ("resid2", int), \
+                    ("resname2", str), \
+                    ("energy", float)]
+HBONDS_FIELDS = [("index1", int), ("segid1", str), ("resid1", int), \
+                 ("resname1", str), ("atom1", str), \
+                 ("index2", int), ("segid2", str), ("resid2", int), \
+                 ("resname2", str), ("atom2", str), \
+                 ("persistence", float)]
+HBONDS_RES_FIELDS = [("segid1", str), ("resid1", int), \
+                     ("segid2", str), ("resid2", int), \
+                     ("persistence", float)]
+
+# line format of the output files and the fields it uses
+INTERACT_LINE = ("%s-%d%s_%s:%s-%d%s_%s\t%3.1f\n", \
+                 ("segid1", "resid1", "resname1", "group1", \
+                  "segid2", "resid2", "resname2", "group2", \
+                  "persistence"))
+POTENTIAL_LINE = ("%s-%s%d:%s-%s%d\t%.3f\n", \
+                  ("segid1", "resname1", "resid1", \
+                   "segid2", "resname2", "resid2", \
+                   "energy"))
+HBONDS_LINE = ("%s-%d%s_%s:%s-%d%s_%s\t\t%3.2f\n", \
+               ("segid1", "resid1", "resname1", "atom1", \
+                "segid2", "resid2", "resname2", "atom2", \
+                "persistence"))
+HBONDS_RES_LINE = ("%s%d:%s%d\t\t%3.2f\n", \
+                   ("segid1", "resid1", "segid2", "resid2", \
+                    "persistence"))
+
+# number of records formatted at once by the writers
+WRITE_CHUNKSIZE = 10000
+
+def make_records(fields, columns):
+    """Build a record array from the given (name, type) fields and
+    the corresponding columns of values."""
+
+    arrays = [np.asarray(column, dtype = dtype) \
+              for (name, dtype), column in zip(fields, columns)]
+    return np.rec.fromarrays(arrays, names = [f[0] for f in fields])
+
+
+def get_records_line(records):
+    """Get the output line format for records of any kind."""
+
+    names = records.dtype.names
+    if "energy" in names:
+        return POTENTIAL_LINE
+    if "group1" in names:
+        return INTERACT_LINE
+    if "atom1" in names:
+        return HBONDS_LINE
+    return HBONDS_RES_LINE
+
+
+def write_records(records, out, line = None):
+    """Write records to a file object, one line each, in chunks
+    so that the whole output never needs to be kept in memory.
+    The line format depends on the kind of records, if not given."""
+
+    if line is None:
+        line = get_records_line(records)
+    fmt, fields = line
+    for start in range(0, len(records), WRITE_CHUNKSIZE):
+        chunk = records[start:start+WRITE_CHUNKSIZE]
+        # convert the columns to Python objects all at once
+        columns = [chunk[field].tolist() for field in fields]
+        out.write("".join([fmt % row for row in zip(*columns)]))
+
+
+def records_to_str(records):
+    """Get the output string for records of any kind."""
+
+    out = io.StringIO()
+    write_records(records, out)
+    return out.getvalue()
+
+
+########################### PARTIAL RESULTS ###########################
+
+# version of the partial results file format
+PARTIAL_VERSION = 1
+
+# kinds of analyses whose raw counts can be stored as partial results
+PARTIAL_KINDS = ("hc", "sb", "hb", "kbp")
+
+def _to_json(obj):
+    """Serialize an object to JSON, converting numpy scalars."""
+
+    return json.dumps(obj, default = lambda o: o.item())
+
+
+def get_topology_fingerprint(uni):
+    """Get a fingerprint of the topology of a Universe, used to check
+    that partial results refer to the same system."""
+
+    atoms = uni.atoms
+    fingerprint = hashlib.sha1(str(len(atoms)).encode())
+    for attr in (atoms.names, atoms.resnames, atoms.resids, atoms.segids):
+        fingerprint.update("\t".join([str(a) for a in attr]).encode())
+    return fingerprint.hexdigest()
+
+
+def make_partial(kind, counts, numframes, params, fingerprint, labels):
+    """Build the partial results of an analysis, i.e. the raw counts
+    (or sums, for the statistical potential) accumulated over a given
+    number of frames, together with the parameters of the analysis,
+    the topology fingerprint and what the counts refer to."""
+
+    if kind not in PARTIAL_KINDS:
+        raise ValueError(f"Unknown kind of partial results: {kind}.")
+    # parameters and identifiers are kept as they will be read
+    # back, so that partial results can always be compared
+    if kind != "hb":
+        labels = dict([(k, [tuple(i) for i in v]) \
+                       for k, v in json.loads(_to_json(labels)).items()])
+    return {"kind" : kind, \
+            "counts" : counts, \
+            "numframes" : int(numframes), \
+            "params" : json.loads(_to_json(params)), \
+            "fingerprint" : fingerprint, \
+            "labels" : labels}
+
+
+def save_partial(fname, partial):
+    """Save partial results to a .npz file."""
+
+    kind = partial["kind"]
+    arrays = {}
+    if kind == "hb":
+        # hydrogen bonds and pairs of residues are stored as lists
+        # of keys and arrays of counts
+        hb_counts, res_counts = partial["counts"]
+        labels = {"hbonds" : list(hb_counts.keys()), \
+                  "residues" : [sorted(key) for key in res_counts.keys()]}
+        arrays["counts"] = np.array(list(hb_counts.values()), \
+                                    dtype = np.int64)
+        arrays["res_counts"] = np.array(list(res_counts.values()), \
+                                        dtype = np.int64)
+    else:
+        labels = partial["labels"]
+        arrays["counts"] = np.asarray(partial["counts"])
+    # np.savez adds the extension if missing
+    with open(fname, "wb") as fh:
+        np.savez(fh, \
+                 version = PARTIAL_VERSION, \
+                 kind = kind, \
+                 numframes = partial["numframes"], \
+                 params = _to_json(partial["params"]), \
+                 fingerprint = partial["fingerprint"], \
+                 labels = _to_json(labels), \
+                 **arrays)
+
+
+def load_partial(fname):
+    """Load partial results from a .npz file."""
+
+    with np.load(fname, allow_pickle = False) as data:
+        if int(data["version"]) != PARTIAL_VERSION:
+            errstr = "Unsupported partial results version: {:d}."
+            raise ValueError(errstr.format(int(data["version"])))
+        kind = str(data["kind"])
+        labels = json.loads(str(data["labels"]))
+        if kind == "hb":
+            # rebuild the counters of hydrogen bonds and residues
+            hb_counts = collections.OrderedDict(\
+                zip([tuple(k) for k in labels["hbonds"]], \
+                    data["counts"].tolist()))
+            res_counts = collections.Counter(\
+                dict(zip([frozenset([tuple(i) for i in k]) \
+                          for k in labels["residues"]], \
+                         data["res_counts"].tolist())))
+            counts = (hb_counts, res_counts)
+            labels = {}
+        else:
+            counts = data["counts"]
+        return make_partial(kind = kind, \
+                            counts = counts, \
+                            numframes = int(data["numframes"]), \
+                            params = json.loads(str(data["params"])), \
+                            fingerprint = str(data["fingerprint"]), \
+                            labels = labels)
+
+
+def merge_hbonds_counts(results):
+    """Sum the hydrogen bonds counts (hydrogen bonds counts, residue
+    pairs counts and number of frames) of several runs."""
+
+    hb_counts = collections.OrderedDict()
+    res_counts = collections.Counter()
+    for run_hb_counts, run_res_counts, numframes in results:
+        for hbond, hb_occur in run_hb_counts.items():
+            hb_counts[hbond] = hb_counts.get(hbond, 0) + hb_occur
+        res_counts.update(run_res_counts)
+    numframes = sum([r[2] for r in results])
+    return (hb_counts, res_counts, numframes)
+
+
+def check_partials(partials):
+    """Check that partial results refer to the same analysis (same
+    kind, parameters and identifiers) of the same system."""
+
+    first = partials[0]
+    for partial in partials[1:]:
+        for key in ("kind", "fingerprint", "params", "labels"):
+            if partial[key] != first[key]:
+                errstr = \
+                    "Partial results are not compatible: they differ " \
+                    "in {:s}."
+                raise ValueError(errstr.format(key))
+
+
+def merge_partials(partials):
+    """Merge partial results computed on different parts of the
+    trajectory (or different trajectories) of the same system."""
+
+    if not partials:
+        raise ValueError("No partial results to be merged.")
+    check_partials(partials)
+    first = partials[0]
+    if first["kind"] == "hb":
+        hb_counts, res_counts, numframes = \
+            merge_hbonds_counts(\
+                [p["counts"] + (p["numframes"],) for p in partials])
+        counts = (hb_counts, res_counts)
+    else:
+        counts = np.sum([p["counts"] for p in partials], axis = 0)
+        numframes = sum([p["numframes"] for p in partials])
+    return make_partial(kind = first["kind"], \
+                        counts = counts, \
+                        numframes = numframes, \
+                        params = first["params"], \
+                        fingerprint = first["fingerprint"], \
+                        labels = first["labels"])
+
+
+def run_checkpointed(sumfunc, \
+                     makefunc, \
+                     numframes, \
+                     fname, \
+                     checkpoint_every = None, \
+                     resume = False):
+    """Accumulate counts over the frames of a trajectory in chunks of
+    checkpoint_every frames (all of them at once, if not given), saving
+    them as partial results in fname after each chunk. If resume is
+    True and fname exists, only the frames it does not cover yet are
+    analyzed (e.g. after a crash, or when the trajectory has been
+    extended).
+
+    sumfunc(start, stop, counts) must return the counts accumulated
+    over frames [0, stop), given those accumulated over frames
+    [0, start) (None at the beginning), while makefunc(counts,
+    numframes) must return the corresponding partial results.
+    Return the counts and the number of frames."""
+
+    counts = None
+    start = 0
+    if resume and os.path.exists(fname):
+        state = load_partial(fname)
+        # the state must come from the same analysis
+        check_partials([makefunc(state["counts"], state["numframes"]), \
+                        state])
+        counts, start = state["counts"], state["numframes"]
+        if start > numframes:
+            errstr = \
+                "The partial results in {:s} cover {:d} frames, but " \
+                "the trajectory has only {:d}."
+            raise ValueError(errstr.format(fname, start, numframes))
+        logstr = "Resuming from {:s}: {:d} frame(s) already analyzed."
+        log.info(logstr.format(fname, start))
+    if counts is None and numframes == 0:
+        raise ValueError("No frames to be analyzed.")
+    if not checkpoint_every:
+        checkpoint_every = max(numframes - start, 1)
+    for chunk_start in range(start, numframes, checkpoint_every):
+        chunk_stop = min(chunk_start + checkpoint_every, numframes)
+        counts = sumfunc(chunk_start, chunk_stop, counts)
+        # write the whole file first, so that a crash while saving
+        # does not corrupt the last checkpoint
+        tmp_fname = fname + ".tmp"
+        save_partial(tmp_fname, makefunc(counts, chunk_stop))
+        os.replace(tmp_fname, fname)
+
+    return (counts, numframes)
+
+
+def format_partial(partial, \
+                   pdb, \
+                   uni, \
+                   do_fullmatrix = False, \
+                   as_records = False):
+    """Build the output string (records if as_records is True) and,
+    if requested, the full matrix from partial results."""
+
+    kind = partial["kind"]
+    params = partial["params"]
+    counts = partial["counts"]
+    numframes = partial["numframes"]
+    labels = partial["labels"]
+    if kind in ("hc", "sb"):
+        fullmatrixfunc = None
+        if do_fullmatrix:
+            fullmatrixfunc = \
+                calc_sc_fullmatrix if kind == "hc" else calc_cg_fullmatrix
+        return format_interact(identifiers = labels["identifiers"], \
+                               idxs = labels["idxs"], \
+                               percmat = counts/numframes*100.0, \
+                               perco = params["perco"], \
+                               fullmatrixfunc = fullmatrixfunc, \
+                               as_records = as_records)
+    elif kind == "kbp":
+        residue_pairs = [(pdb.residues[i], pdb.residues[j]) \
+                         for i, j in labels["residue_pairs"]]
+        return format_potential(pdb = pdb, \
+                                residue_pairs = residue_pairs, \
+                                scores = counts/float(numframes), \
+                                do_fullmatrix = do_fullmatrix, \
+                                as_records = as_records)
+    elif kind == "hb":
+        hb_counts, res_counts = counts
+        return format_hbonds(hb_counts = hb_counts, \
+                             res_counts = res_counts, \
+                             numframes = numframes, \
+                             pdb = pdb, \
+                             uni = uni, \
+                             perco = params["perco"], \
+                             perresidue = params["perresidue"], \
+                             do_fullmatrix = do_fullmatrix, \
+                             as_records = as_records)
+
+
 ############################## POTENTIAL ##############################
 
 class Sparse:
@@ -258,27 +934,21 @@ def parse_hbs_file(fname):
 
     return dict(ACCEPTORS=acceptors, DONORS=donors)
 
-def do_potential(kbp_atomlist,
-                 residues_list,
-                 potential_file,
-                 parse_sparse_func = parse_sparse,
-                 calc_potential_func = calc_potential,
-                 seq_dist_co = 0,
-                 uni = None,
-                 pdb = None,
-                 do_fullmatrix = True,
-                 kbT = 1.0):
+def generate_kbp_selections(kbp_atomlist,
+                            residues_list,
+                            sparses,
+                            uni,
+                            seq_dist_co = 0):
+    """Generate the pairs of residues and the atom selections
+    for the potential calculation."""
 
-    log.info("Loading potential definition . . .")
-    sparses = parse_sparse_func(potential_file)
-    log.info("Loading input files...")
+    import MDAnalysis as mda
 
     ok_residues = []
     discarded_residues = set()
     residue_pairs = []
     atom_selections = []
     ordered_sparses = []
-    numframes = len(uni.trajectory)
 
     for res in uni.residues:
         # check if the residue type is one of
@@ -344,14 +1014,42 @@ def do_potential(kbp_atomlist,
                 atom_selections.append(selected_atoms)
                 ordered_sparses.append(this_sparse)
 
+    return (residue_pairs, atom_selections, ordered_sparses)
+
+
+def calc_potential_sums(uni,
+                        atom_selections,
+                        ordered_sparses,
+                        calc_potential_func = calc_potential,
+                        kbT = 1.0,
+                        coords_cache = None,
+                        start = None,
+                        stop = None,
+                        scores = None):
+    """Sum the potential scores of each pair of residues over the
+    frames (between the start and stop frames, if given), adding
+    them to the scores passed, if any. Return the sums and the
+    number of frames."""
+
+    numframes = get_numframes(uni, coords_cache, start, stop)
+    profile_frames(numframes)
     # create an matrix of floats to store scores (initially
     # filled with zeros)
-    scores = np.zeros((len(residue_pairs)), dtype = np.float64)
+    if scores is None:
+        scores = np.zeros((len(atom_selections)), dtype = np.float64)
+    else:
+        scores = np.array(scores, dtype = np.float64)
     # set coordinates to None
     coords = None
     # for each frame in the trajectory
     numframe = 1
-    for ts_i, ts in enumerate(uni.trajectory):
+    positions_iter = iter_positions(uni, \
+                                    atom_selections, \
+                                    coords_cache, \
+                                    start, \
+                                    stop)
+    positions_iter = profile_iter("gather", positions_iter)
+    for ts_i, positions in enumerate(positions_iter):
         # log the progress along the trajectory
         logstr = "Now analyzing: frame {:d} / {:d} ({:3.1f}%)\r"
         sys.stdout.write(\
@@ -360,43 +1058,49 @@ def do_potential(kbp_atomlist,
                           float(numframe)/float(numframes)*100.0))
         sys.stdout.flush()       
         
-        # create an array of coordinates by concatenating the arrays of
-        # atom positions in the selections row-wise
-        coords = \
-            np.array(\
-                np.concatenate(\
-                    [sel.positions for sel in atom_selections]), \
-            dtype = np.float64)
-
-        inner_loop = il.LoopDistances(coords, coords, None)
-        # compute distances
-        distances = \
-            inner_loop.run_potential_distances(len(atom_selections), 4, 1)
-        # compute scores
-        scores += \
-            calc_potential_func(distances = distances, \
-                                ordered_sparses = ordered_sparses, \
-                                kbT = kbT)
-    
-    # divide the scores for the lenght of the trajectory
-    scores /= float(numframes)
-    # create the output string
-    outstr = ""
-    # set the format for the representation of each pair of
-    # residues in the output string
-    outstr_fmt = "{:s}-{:s}{:d}:{:s}-{:s}{:d}\t{:.3f}\n"
-    for i, score in enumerate(scores):
-        if abs(score) > 0.000001:
-            # update the output string
-            outstr +=  \
-                outstr_fmt.format(\
-                    pdb.residues[residue_pairs[i][0].ix].segment.segid, \
-                    pdb.residues[residue_pairs[i][0].ix].resname, \
-                    pdb.residues[residue_pairs[i][0].ix].resid, \
-                    pdb.residues[residue_pairs[i][1].ix].segment.segid, \
-                    pdb.residues[residue_pairs[i][1].ix].resname, \
-                    pdb.residues[residue_pairs[i][1].ix].resid, \
-                    score)
+        with profile_stage("kernel"):
+            # create an array of coordinates by concatenating the arrays
+            # of atom positions in the selections row-wise
+            coords = \
+                np.array(np.concatenate(positions), dtype = np.float64)
+
+            inner_loop = il.LoopDistances(coords, coords, None)
+            # compute distances
+            distances = \
+                inner_loop.run_potential_distances(len(atom_selections), \
+                                                   4, \
+                                                   1)
+            # compute scores
+            scores += \
+                calc_potential_func(distances = distances, \
+                                    ordered_sparses = ordered_sparses, \
+                                    kbT = kbT)
+
+    return (scores, numframes)
+
+
+def format_potential(pdb, \
+                     residue_pairs, \
+                     scores, \
+                     do_fullmatrix = True, \
+                     as_records = False):
+    """Build the output records (or string, unless as_records is
+    True) and, if requested, the full matrix from the average
+    potential scores."""
+
+    # indexes of the residues of each pair with a non-zero score
+    ix1 = np.array([pair[0].ix for pair in residue_pairs], dtype = int)
+    ix2 = np.array([pair[1].ix for pair in residue_pairs], dtype = int)
+    nonzero = np.abs(scores) > 0.000001
+    ix1, ix2 = ix1[nonzero], ix2[nonzero]
+    # segment IDs, residue IDs and names of the reference residues
+    segids = np.array(pdb.residues.segids, dtype = str)
+    resids = np.array(pdb.residues.resids, dtype = int)
+    resnames = np.array(pdb.residues.resnames, dtype = str)
+    records = make_records(POTENTIAL_FIELDS, \
+                           [ix1, segids[ix1], resids[ix1], resnames[ix1], \
+                            ix2, segids[ix2], resids[ix2], resnames[ix2], \
+                            np.asarray(scores)[nonzero]])
     
     # inizialize the matrix to None  
     dm = None   
@@ -411,20 +1115,148 @@ def do_potential(kbp_atomlist,
         dm[pair_firstelems, pairs_secondelems] = scores
         dm[pairs_secondelems, pair_firstelems] = scores
     
-    # return the output string and the matrix
-    return (outstr, dm)
+    # return the output records (or string) and the matrix
+    if as_records:
+        return (records, dm)
+    return (records_to_str(records), dm)
 
-def calc_dist_matrix(uni, \
+
+def do_potential(kbp_atomlist,
+                 residues_list,
+                 potential_file,
+                 parse_sparse_func = parse_sparse,
+                 calc_potential_func = calc_potential,
+                 seq_dist_co = 0,
+                 uni = None,
+                 pdb = None,
+                 do_fullmatrix = True,
+                 kbT = 1.0,
+                 coords_cache = None,
+                 trjs = None,
+                 nprocs = None,
+                 partial_fname = None,
+                 checkpoint_every = None,
+                 resume = False,
+                 as_records = False):
+    """Compute the statistical potential for all pairs of residues
+    and return the output string (records if as_records is True) and
+    the matrix. If a list of trajectories is given, each replica is
+    processed separately and a list of per-replica (output string,
+    matrix) is returned as well. If partial_fname is given, the sums of the
+    scores are saved there as partial results (every checkpoint_every
+    frames, resuming from the frames already there if resume is True,
+    for a single trajectory)."""
+
+    if trjs is not None and (checkpoint_every or resume):
+        raise ValueError("Checkpoints are not supported for replicas.")
+
+    with profile_stage("identifiers"):
+        log.info("Loading potential definition . . .")
+        sparses = parse_sparse_func(potential_file)
+        log.info("Loading input files...")
+
+        residue_pairs, atom_selections, ordered_sparses = \
+            generate_kbp_selections(kbp_atomlist = kbp_atomlist, \
+                                    residues_list = residues_list, \
+                                    sparses = sparses, \
+                                    uni = uni, \
+                                    seq_dist_co = seq_dist_co)
+
+    sumsfunc = \
+        lambda u, start = None, stop = None, scores = None: \
+            calc_potential_sums(uni = u, \
+                                atom_selections = atom_selections, \
+                                ordered_sparses = ordered_sparses, \
+                                calc_potential_func = calc_potential_func, \
+                                kbT = kbT, \
+                                coords_cache = coords_cache, \
+                                start = start, \
+                                stop = stop, \
+                                scores = scores)
+
+    # partial results for the sums of the scores
+    if partial_fname is not None:
+        params = {"kbT" : kbT, \
+                  "seq_dist_co" : seq_dist_co, \
+                  "residues_list" : residues_list, \
+                  "potential_file" : os.path.basename(potential_file)}
+        labels = {"residue_pairs" : [(res1.ix, res2.ix) \
+                                     for res1, res2 in residue_pairs]}
+        fingerprint = get_topology_fingerprint(uni)
+        makefunc = \
+            lambda sums, numframes: \
+                make_partial(kind = "kbp", \
+                             counts = sums, \
+                             numframes = numframes, \
+                             params = params, \
+                             fingerprint = fingerprint, \
+                             labels = labels)
+
+    replicas = None
+    if trjs is None and partial_fname is not None:
+        # scores are added frame by frame to those already summed,
+        # as in a single run over the whole trajectory
+        sums, numframes = \
+            run_checkpointed(\
+                sumfunc = \
+                    lambda start, stop, sums: \
+                        sumsfunc(uni, start, stop, sums)[0], \
+                makefunc = makefunc, \
+                numframes = get_numframes(uni, coords_cache), \
+                fname = partial_fname, \
+                checkpoint_every = checkpoint_every, \
+                resume = resume)
+    elif trjs is None:
+        sums, numframes = sumsfunc(uni)
+    else:
+        results = run_replicas(sumsfunc, uni, trjs, nprocs)
+        # average scores for each replica
+        replicas = \
+            [format_potential(pdb = pdb, \
+                              residue_pairs = residue_pairs, \
+                              scores = r_sums/float(r_numframes), \
+                              do_fullmatrix = do_fullmatrix, \
+                              as_records = as_records) \
+             for r_sums, r_numframes in results]
+        # sum scores over all the replicas
+        sums = np.sum([r[0] for r in results], axis = 0)
+        numframes = sum([r[1] for r in results])
+        profile_frames(numframes)
+        # save the sums of the scores, if requested
+        if partial_fname is not None:
+            save_partial(partial_fname, makefunc(sums, numframes))
+
+    # divide the scores for the lenght of the trajectory
+    with profile_stage("assembly"):
+        outstr, dm = format_potential(pdb = pdb, \
+                                      residue_pairs = residue_pairs, \
+                                      scores = sums/float(numframes), \
+                                      do_fullmatrix = do_fullmatrix, \
+                                      as_records = as_records)
+
+    if replicas is None:
+        return (outstr, dm)
+    # return pooled output string and matrix, and replicas
+    return (outstr, dm, replicas)
+
+def calc_dist_counts(uni, \
                      idxs, \
                      chosenselections, \
                      co, \
                      mindist = False, \
                      mindist_mode = None, \
                      pos_char = "p", \
-                     neg_char = "n"):
-    """Compute matrix of distances"""
+                     neg_char = "n", \
+                     coords_cache = None, \
+                     start = None, \
+                     stop = None):
+    """Count, for each pair of selections, the frames (between the
+    start and stop frames, if given) in which they are within the
+    distance cut-off. Return the matrix of counts and the number
+    of frames."""
     
-    numframes = len(uni.trajectory)
+    numframes = get_numframes(uni, coords_cache, start, stop)
+    profile_frames(numframes)
     # initialize the final matrix
     percmat = \
         np.zeros((len(chosenselections), len(chosenselections)), \
@@ -433,10 +1265,12 @@ def calc_dist_matrix(uni, \
     if mindist:
         # lists for positively charged atoms
         pos = []
+        pos_ix = []
         pos_idxs = []
         pos_sizes = []
         # lists for negatively charged atoms
         neg = []
+        neg_ix = []
         neg_idxs = []
         neg_sizes = []
 
@@ -448,12 +1282,14 @@ def calc_dist_matrix(uni, \
             # positively charged atom
             if charge_char == pos_char:
                 pos.append(chosenselections[i])
+                pos_ix.append(i)
                 pos_idxs.append(idxs[i])
                 pos_sizes.append(len(chosenselections[i]))
             # if the index contains the indication of a
             # negatively charged atom
             elif charge_char == neg_char:
                 neg.append(chosenselections[i])
+                neg_ix.append(i)
                 neg_idxs.append(idxs[i])
                 neg_sizes.append(len(chosenselections[i]))
             # if none of the above
@@ -473,17 +1309,21 @@ def calc_dist_matrix(uni, \
         # with different charges
         if mindist_mode == "diff":
             sets = [(pos, neg)]
+            sets_ix = [(pos_ix, neg_ix)]
             sets_idxs = [(pos_idxs, neg_idxs)]
             sets_sizes = [(pos_sizes, neg_sizes)]
         # if we are interested in interactions between atoms
         # with the same charge
         elif mindist_mode == "same":
             sets = [(pos, pos), (neg, neg)]
+            sets_ix = [(pos_ix, pos_ix), (neg_ix, neg_ix)]
             sets_idxs = [(pos_idxs, pos_idxs), (neg_idxs, neg_idxs)]
             sets_sizes = [(pos_sizes, pos_sizes), (neg_idxs, neg_sizes)]
         # if we are interested in both
         elif mindist_mode == "both":
             sets = [(chosenselections, chosenselections)]
+            all_ix = list(range(len(chosenselections)))
+            sets_ix = [(all_ix, all_ix)]
             sets_idxs = [(idxs, idxs)]
             sizes =  [len(s) for s in chosenselections]
             sets_sizes = [(sizes, sizes)]
@@ -500,9 +1340,15 @@ def calc_dist_matrix(uni, \
         # create an empty list to store the atomic coordinates
         coords = [([[], []]) for s in sets]
 
+        log.info("Caching coordinates...")
         # for each frame in the trajectory
         numframe = 1
-        for ts in uni.trajectory:
+        positions_iter = iter_positions(uni, \
+                                        chosenselections, \
+                                        coords_cache, \
+                                        start, \
+                                        stop)
+        for positions in profile_iter("gather", positions_iter):
             # log the progress along the trajectory
             logstr = \
                 "Caching coordinates: frame {:d} / {:d} ({:3.1f}%)\r"
@@ -515,76 +1361,83 @@ def calc_dist_matrix(uni, \
             numframe += 1
             
             # for each set of atoms
-            for s_index, s in enumerate(sets):
+            for s_index, s in enumerate(sets_ix):
                 if s[0] == s[1]:
                     # triangular case
-                    log.info("Caching coordinates...")
-                    for group in s[0]:
-                        coords[s_index][0].append(group.positions)
-                        coords[s_index][1].append(group.positions)
+                    coords[s_index][0].extend([positions[i] for i in s[0]])
                 else:
                     # square case
-                    log.info("Caching coordinates...")
-                    for group in s[0]:
-                        coords[s_index][0].append(group.positions)
-                    for group in s[1]:
-                        coords[s_index][1].append(group.positions)
-
-        for s_index, s in enumerate(sets):
-            # recover the final matrix
-            if s[0] == s[1]:
-                # triangular case
-                this_coords = \
-                    np.array(np.concatenate(coords[s_index][0]), \
-                             dtype = np.float64)
-                # compute the distances within the cut-off
-                inner_loop = il.LoopDistances(this_coords, this_coords, co)
-                percmats.append(\
-                    inner_loop.run_triangular_mindist(\
-                        sets_sizes[s_index][0]))
+                    coords[s_index][0].extend([positions[i] for i in s[0]])
+                    coords[s_index][1].extend([positions[i] for i in s[1]])
 
-            else:
-                # square case
-                this_coords1 = \
-                    np.array(np.concatenate(coords[s_index][0]), \
-                             dtype = np.float64)              
-                this_coords2 = \
-                    np.array(np.concatenate(coords[s_index][1]), \
-                             dtype = np.float64)
-                # compute the distances within the cut-off
-                inner_loop = il.LoopDistances(this_coords1, this_coords2, co)
-                percmats.append(\
-                    inner_loop.run_square_mindist(\
-                        sets_sizes[s_index][0], \
-                        sets_sizes[s_index][1]))
-
-        for s_index, s in enumerate(sets): 
-            # recover the final matrix
-            pos_idxs = sets_idxs[s_index][0]
-            neg_idxs = sets_idxs[s_index][1]
-            if s[0] == s[1]:
-                # triangular case
-                for j in range(len(s[0])):
-                    for k in range(0, j):
-                        ix_j = idxs.index(pos_idxs[j])
-                        ix_k = idxs.index(pos_idxs[k])
-                        percmat[ix_j, ix_k] = percmats[s_index][j,k]         
-                        percmat[ix_k, ix_j] = percmats[s_index][j,k]
-            else: 
-                # square case
-                for j in range(len(s[0])):
-                    for k in range(len(s[1])):
-                        ix_j_p = idxs.index(pos_idxs[j])
-                        ix_k_n = idxs.index(neg_idxs[k])
-                        percmat[ix_j_p, ix_k_n] = percmats[s_index][j,k]         
-                        percmat[ix_k_n, ix_j_p] = percmats[s_index][j,k]
+        # compute the minimum distances for each set of atoms
+        with profile_stage("kernel"):
+            for s_index, s in enumerate(sets):
+                # recover the final matrix
+                if s[0] == s[1]:
+                    # triangular case
+                    this_coords = \
+                        np.array(np.concatenate(coords[s_index][0]), \
+                                 dtype = np.float64)
+                    # compute the distances within the cut-off
+                    inner_loop = \
+                        il.LoopDistances(this_coords, this_coords, co)
+                    percmats.append(\
+                        inner_loop.run_triangular_mindist(\
+                            sets_sizes[s_index][0]))
+
+                else:
+                    # square case
+                    this_coords1 = \
+                        np.array(np.concatenate(coords[s_index][0]), \
+                                 dtype = np.float64)              
+                    this_coords2 = \
+                        np.array(np.concatenate(coords[s_index][1]), \
+                                 dtype = np.float64)
+                    # compute the distances within the cut-off
+                    inner_loop = \
+                        il.LoopDistances(this_coords1, this_coords2, co)
+                    percmats.append(\
+                        inner_loop.run_square_mindist(\
+                            sets_sizes[s_index][0], \
+                            sets_sizes[s_index][1]))
+
+        # fill the final matrix
+        with profile_stage("assembly"):
+            for s_index, s in enumerate(sets): 
+                # recover the final matrix
+                pos_idxs = sets_idxs[s_index][0]
+                neg_idxs = sets_idxs[s_index][1]
+                if s[0] == s[1]:
+                    # triangular case
+                    for j in range(len(s[0])):
+                        for k in range(0, j):
+                            ix_j = idxs.index(pos_idxs[j])
+                            ix_k = idxs.index(pos_idxs[k])
+                            percmat[ix_j, ix_k] = percmats[s_index][j,k]         
+                            percmat[ix_k, ix_j] = percmats[s_index][j,k]
+                else: 
+                    # square case
+                    for j in range(len(s[0])):
+                        for k in range(len(s[1])):
+                            ix_j_p = idxs.index(pos_idxs[j])
+                            ix_k_n = idxs.index(neg_idxs[k])
+                            percmat[ix_j_p, ix_k_n] = percmats[s_index][j,k]         
+                            percmat[ix_k_n, ix_j_p] = percmats[s_index][j,k]
                      
     else:
         # empty list of matrices of centers of mass
         all_coms = []
+        # masses of the atoms in the chosen selections
+        masses = [sel.masses.astype(np.float64) for sel in chosenselections]
         # for each frame in the trajectory
         numframe = 1
-        for ts in uni.trajectory:
+        positions_iter = iter_positions(uni, \
+                                        chosenselections, \
+                                        coords_cache, \
+                                        start, \
+                                        stop)
+        for positions in profile_iter("gather", positions_iter):
             # log the progress along the trajectory
             logstr = "Now analyzing: frame {:d} / {:d} ({:3.1f}%)\r"
             sys.stdout.write(logstr.format(\
@@ -596,18 +1449,49 @@ def calc_dist_matrix(uni, \
             numframe += 1
             
             # matrix of centers of mass for the chosen selections
-            coms_list = [sel.center(sel.masses) for sel in chosenselections]
-            coms = np.array(coms_list, dtype = np.float64)
-            all_coms.append(coms)
-
-        # create a matrix of all centers of mass along the trajectory
-        all_coms = np.concatenate(all_coms)
-        # compute the distances within the cut-off
-        inner_loop = il.LoopDistances(all_coms, all_coms, co)
-        percmat = inner_loop.run_triangular_distmatrix(coms.shape[0])
+            # (computed as in AtomGroup.center, so that positions
+            # read from the cache give the same results)
+            with profile_stage("com"):
+                coms_list = [(pos * m[:, None]).sum(axis = 0) / m.sum() \
+                             for pos, m in zip(positions, masses)]
+                coms = np.array(coms_list, dtype = np.float64)
+                all_coms.append(coms)
+
+        with profile_stage("kernel"):
+            # create a matrix of all centers of mass along the trajectory
+            all_coms = np.concatenate(all_coms)
+            # compute the distances within the cut-off
+            inner_loop = il.LoopDistances(all_coms, all_coms, co)
+            percmat = inner_loop.run_triangular_distmatrix(coms.shape[0])
     
-    # convert the matrix into an array
-    percmat = np.array(percmat, dtype = np.float64)/numframes*100.0
+    # convert the matrix into an array of counts
+    counts = np.array(percmat, dtype = np.int64)
+
+    return (counts, numframes)
+
+
+def calc_dist_matrix(uni, \
+                     idxs, \
+                     chosenselections, \
+                     co, \
+                     mindist = False, \
+                     mindist_mode = None, \
+                     pos_char = "p", \
+                     neg_char = "n", \
+                     coords_cache = None):
+    """Compute matrix of distances"""
+
+    counts, numframes = calc_dist_counts(uni = uni, \
+                                         idxs = idxs, \
+                                         chosenselections = chosenselections, \
+                                         co = co, \
+                                         mindist = mindist, \
+                                         mindist_mode = mindist_mode, \
+                                         pos_char = pos_char, \
+                                         neg_char = neg_char, \
+                                         coords_cache = coords_cache)
+    # convert the matrix of counts into a matrix of persistences
+    percmat = np.array(counts, dtype = np.float64)/numframes*100.0
 
     return percmat
 
@@ -869,58 +1753,37 @@ def calc_cg_fullmatrix(identifiers, idxs, percmat, perco):
 
 ############################ INTERACTIONS #############################
 
-def do_interact(identfunc, \
-                pdb, \
-                uni, \
-                co = 5.0, \
-                perco = 0.0, \
-                assignffmassesfunc = assign_ff_masses, \
-                distmatrixfunc = calc_dist_matrix, \
-                ffmasses = None, \
-                fullmatrixfunc = None, \
-                mindist = False, \
-                mindist_mode = None, \
-                **identargs):
-    
-    # get identifiers, indexes and atom selections
-    identifiers, idxs, chosenselections = identfunc(pdb, uni, **identargs)
+def format_interact(identifiers, \
+                    idxs, \
+                    percmat, \
+                    perco = 0.0, \
+                    fullmatrixfunc = None, \
+                    as_records = False):
+    """Build the output records (or string, unless as_records is
+    True) and, if a function to compute it is given, the full matrix
+    from a matrix of persistences."""
 
-    # assign atomic masses to atomic selections if not provided
-    if ffmasses is None:
-        log.info("No force field assigned: masses will be guessed.")
-    else:
-        try:
-            assignffmassesfunc(ffmasses, chosenselections)
-        except IOError:
-            logstr = "Force field file not found or not readable. " \
-                     "Masses will be guessed."
-            log.warning(logstr)     
-    # calculate the matrix of persistences
-    percmat = calc_dist_matrix(uni = uni, \
-                               idxs = idxs,\
-                               chosenselections = chosenselections, \
-                               co = co, \
-                               mindist = mindist, \
-                               mindist_mode = mindist_mode)
     # get shortened indexes and identifiers
     short_idxs = [i[0:3] for i in idxs]
     short_ids = [i[0:3] for i in identifiers]
-    # set output string and output string format
-    outstr = ""
-    outstr_fmt = "{:s}-{:d}{:s}_{:s}:{:s}-{:d}{:s}_{:s}\t{:3.1f}\n"
+    # map each index to its identifier
+    id_positions = {}
+    for pos, short_id in enumerate(short_ids):
+        id_positions.setdefault(short_id, pos)
+    idx_ids = [short_ids[id_positions[short_idx]] \
+               for short_idx in short_idxs]
+    # segment ID, residue ID, residue name and group of each index
+    segids = np.array([i[0] for i in idx_ids], dtype = str)
+    resids = np.array([i[1] for i in idx_ids], dtype = int)
+    resnames = np.array([i[2] for i in idx_ids], dtype = str)
+    groups = np.array([i[3] for i in idxs], dtype = str)
     # get where in the lower triangle of the matrix (it is symmeric)
     # the value is greater than the persistence cut-off
-    where_gt_perco = np.argwhere(np.tril(percmat>perco))
-    for i, j in where_gt_perco:
-        #print(i, j)
-        #print("IDXSi", short_idxs[i])
-        #print("IDXSj", short_idxs[j])
-
-        segid1, resid1, resname1 = short_ids[short_ids.index(short_idxs[i])]
-        segid2, resid2, resname2 = short_ids[short_ids.index(short_idxs[j])]
-        outstr += outstr_fmt.format(segid1, resid1, resname1, idxs[i][3], \
-                                    segid2, resid2, resname2, idxs[j][3], \
-                                    percmat[i,j])
+    i, j = np.nonzero(np.tril(percmat>perco))
+    records = make_records(INTERACT_FIELDS, \
+                           [i, segids[i], resids[i], resnames[i], groups[i], \
+                            j, segids[j], resids[j], resnames[j], groups[j], \
+                            percmat[i,j]])
     # set the full matrix to None
     fullmatrix = None
     # compute the full matrix if requestes
@@ -930,70 +1793,416 @@ def do_interact(identfunc, \
                                     percmat = percmat, \
                                     perco = perco)
     
-    # return output string and fullmatrix
-    return (outstr, fullmatrix)
+    # return output records (or string) and fullmatrix
+    if as_records:
+        return (records, fullmatrix)
+    return (records_to_str(records), fullmatrix)
+
+
+def do_interact(identfunc, \
+                pdb, \
+                uni, \
+                co = 5.0, \
+                perco = 0.0, \
+                assignffmassesfunc = assign_ff_masses, \
+                distmatrixfunc = calc_dist_matrix, \
+                ffmasses = None, \
+                fullmatrixfunc = None, \
+                mindist = False, \
+                mindist_mode = None, \
+                coords_cache = None, \
+                trjs = None, \
+                nprocs = None, \
+                partial_fname = None, \
+                checkpoint_every = None, \
+                resume = False, \
+                as_records = False, \
+                **identargs):
+    """Compute the persistence of the interactions between the
+    groups of atoms generated by identfunc and return the output
+    string (records if as_records is True) and the full matrix. If
+    a list of trajectories is given, each replica is processed
+    separately and a list of per-replica (output string, full matrix)
+    is returned as well.
+    If partial_fname is given, the counts are saved there as partial
+    results (every checkpoint_every frames, resuming from the frames
+    already there if resume is True, for a single trajectory)."""
+
+    if trjs is not None and (checkpoint_every or resume):
+        raise ValueError("Checkpoints are not supported for replicas.")
+    
+    with profile_stage("identifiers"):
+        # get identifiers, indexes and atom selections
+        identifiers, idxs, chosenselections = \
+            identfunc(pdb, uni, **identargs)
+
+        # assign atomic masses to atomic selections if not provided
+        if ffmasses is None:
+            log.info("No force field assigned: masses will be guessed.")
+        else:
+            try:
+                assignffmassesfunc(ffmasses, chosenselections)
+            except IOError:
+                logstr = "Force field file not found or not readable. " \
+                         "Masses will be guessed."
+                log.warning(logstr)     
+    
+    # count the frames in which each interaction is found
+    countfunc = \
+        lambda u, start = None, stop = None: \
+            calc_dist_counts(uni = u, \
+                             idxs = idxs, \
+                             chosenselections = chosenselections, \
+                             co = co, \
+                             mindist = mindist, \
+                             mindist_mode = mindist_mode, \
+                             coords_cache = coords_cache, \
+                             start = start, \
+                             stop = stop)
+
+    # partial results for the counts
+    if partial_fname is not None:
+        params = {"co" : co, \
+                  "perco" : perco, \
+                  "mindist" : mindist, \
+                  "mindist_mode" : mindist_mode, \
+                  "ffmasses" : None if ffmasses is None \
+                               else os.path.basename(ffmasses)}
+        labels = {"identifiers" : identifiers, "idxs" : idxs}
+        fingerprint = get_topology_fingerprint(uni)
+        makefunc = \
+            lambda counts, numframes: \
+                make_partial(kind = "sb" if mindist else "hc", \
+                             counts = counts, \
+                             numframes = numframes, \
+                             params = params, \
+                             fingerprint = fingerprint, \
+                             labels = labels)
+
+    replicas = None
+    if trjs is None and partial_fname is not None:
+        # add the counts of each chunk of frames to the previous ones
+        sumfunc = \
+            lambda start, stop, counts: \
+                countfunc(uni, start, stop)[0] + \
+                (0 if counts is None else counts)
+        counts, numframes = \
+            run_checkpointed(sumfunc = sumfunc, \
+                             makefunc = makefunc, \
+                             numframes = get_numframes(uni, coords_cache), \
+                             fname = partial_fname, \
+                             checkpoint_every = checkpoint_every, \
+                             resume = resume)
+    elif trjs is None:
+        counts, numframes = countfunc(uni)
+    else:
+        results = run_replicas(countfunc, uni, trjs, nprocs)
+        # persistences for each replica
+        replicas = \
+            [format_interact(identifiers = identifiers, \
+                             idxs = idxs, \
+                             percmat = r_counts/r_numframes*100.0, \
+                             perco = perco, \
+                             fullmatrixfunc = fullmatrixfunc, \
+                             as_records = as_records) \
+             for r_counts, r_numframes in results]
+        # sum counts over all the replicas
+        counts = np.sum([r[0] for r in results], axis = 0)
+        numframes = sum([r[1] for r in results])
+        profile_frames(numframes)
+        # save the counts, if requested
+        if partial_fname is not None:
+            save_partial(partial_fname, makefunc(counts, numframes))
+
+    # calculate the matrix of persistences
+    with profile_stage("assembly"):
+        outstr, fullmatrix = \
+            format_interact(identifiers = identifiers, \
+                            idxs = idxs, \
+                            percmat = counts/numframes*100.0, \
+                            perco = perco, \
+                            fullmatrixfunc = fullmatrixfunc, \
+                            as_records = as_records)
+
+    if replicas is None:
+        return (outstr, fullmatrix)
+    # return pooled output string and fullmatrix, and replicas
+    return (outstr, fullmatrix, replicas)
 
 ############################### HBONDS ################################
 
-def do_hbonds(sel1, \
-              sel2, \
-              pdb, \
-              uni, \
-              update_selection1 = True, \
-              update_selection2 = True, \
-              filter_first = False, \
-              distance = 3.0, \
-              angle = 120, \
-              perco = 0.0, \
-              perresidue = False, \
-              do_fullmatrix = False, \
-              other_hbs = None):
+# default donors and acceptors (CHARMM27 atom names)
+HB_DEFAULT_DONORS = ("N", "OH2", "OW", "NE", "NH1", "NH2", "ND2", "SG", \
+                     "NE2", "ND1", "NZ", "OG", "OG1", "NE1", "OH")
+HB_DEFAULT_ACCEPTORS = ("O", "OC1", "OC2", "OH2", "OW", "OD1", "OD2", \
+                        "SG", "OE1", "OE2", "ND1", "NE2", "SD", "OG", \
+                        "OG1", "OH")
+# names of the hydrogen atoms and maximum donor-hydrogen distance,
+# depending on the element (first letter of the name) of the donor
+HB_HYDROGEN_NAMES = ("H", "1H", "2H", "3H")
+HB_COVALENT_RADII = {"N" : 1.31, "O" : 1.31, "P" : 1.58, "S" : 1.55}
+HB_DEFAULT_COVALENT_RADIUS = 1.5
+
+class PairsCounter:
+    def __repr__(self):
+        return "<PairsCounter {:d} pairs>".format(self.used)
+
+    def __init__(self, capacity = 1024):
+        # hash table (see count_pairs in clibinteract.c), whose
+        # capacity must be a power of two
+        self.keys = np.full(capacity, -1, dtype = np.int_)
+        self.counts = np.zeros(capacity, dtype = np.int_)
+        self.order = np.zeros(capacity, dtype = np.int_)
+        self.used = 0
+
+    def __len__(self):
+        return self.used
+
+    def add(self, keys, weights = None):
+        """Add the weights (1 if not given) to the counts of the
+        keys (non-negative integers)."""
+
+        if weights is None:
+            weights = np.ones(len(keys), dtype = np.int_)
+        # keep the table at most half full
+        if 2*(self.used + len(keys)) > len(self.keys):
+            old_keys, old_counts = self.items()
+            capacity = len(self.keys)
+            while 2*(self.used + len(keys)) > capacity:
+                capacity *= 2
+            self.__init__(capacity)
+            self.add(old_keys, old_counts)
+        self.used = il.run_count_pairs(keys, weights, self.keys, \
+                                       self.counts, self.order, self.used)
+
+    def items(self):
+        """Get the keys and their counts, in order of first
+        insertion."""
+
+        occupied = np.nonzero(self.keys != -1)[0]
+        occupied = occupied[np.argsort(self.order[occupied])]
+        return (self.keys[occupied], self.counts[occupied])
+
+
+def get_bonded_hydrogens(donors):
+    """Find the hydrogens bonded to each donor atom, i.e. those of
+    its residue closer than the covalent radius of the donor. Return
+    the list of (donor, hydrogen) pairs."""
+
+    pairs = []
+    for donor in donors:
+        atoms = donor.residue.atoms
+        is_hydrogen = \
+            np.array([name.startswith(HB_HYDROGEN_NAMES) \
+                      for name in atoms.names], dtype = bool)
+        if hasattr(atoms, "types"):
+            is_hydrogen |= atoms.types == "H"
+        hydrogens = atoms[is_hydrogen & (atoms.indices != donor.index)]
+        r_cov = HB_COVALENT_RADII.get(donor.name[0], \
+                                      HB_DEFAULT_COVALENT_RADIUS)
+        dists = np.linalg.norm(hydrogens.positions - donor.position, \
+                               axis = 1)
+        pairs.extend([(donor, h) for h in hydrogens[dists <= r_cov]])
+    return pairs
+
+
+def generate_hbonds_candidates(uni, sel1, sel2, donors, acceptors):
+    """Find the donor-hydrogen pairs and the acceptors which can
+    form hydrogen bonds between two selections, in both directions
+    (donors of the first selection with acceptors of the second and
+    vice versa). Hydrogens are assigned to donors from the current
+    positions. Return the atom group of all the atoms involved and,
+    for each direction, where donors, hydrogens (one element for each
+    donor-hydrogen pair) and acceptors are in the atom group."""
+
+    donors_sel = "name {:s}".format(" ".join(donors))
+    acceptors_sel = "name {:s}".format(" ".join(acceptors))
+    sel1atoms = uni.select_atoms(sel1)
+    sel2atoms = uni.select_atoms(sel2)
+    groups = [(sel1atoms, sel2atoms)]
+    # with the same atoms in both selections, the second direction
+    # would find the same hydrogen bonds again
+    if not np.array_equal(sel1atoms.indices, sel2atoms.indices):
+        groups.append((sel2atoms, sel1atoms))
+    directions = []
+    for donors_group, acceptors_group in groups:
+        dh_pairs = \
+            get_bonded_hydrogens(donors_group.select_atoms(donors_sel))
+        directions.append(\
+            (np.array([d.index for d, h in dh_pairs], dtype = np.int_), \
+             np.array([h.index for d, h in dh_pairs], dtype = np.int_), \
+             acceptors_group.select_atoms(acceptors_sel).indices))
+    # all the atoms involved and where each atom is among them
+    atoms = uni.atoms[np.unique(np.concatenate(\
+                [np.concatenate(direction) for direction in directions]))]
+    directions = [tuple(np.searchsorted(atoms.indices, ixs) \
+                        for ixs in direction) \
+                  for direction in directions]
+    return (atoms, directions)
+
+
+def find_hbonds(positions, donors, hydrogens, acceptors, distance, angle):
+    """Find the hydrogen bonds in a frame, i.e. the pairs of
+    hydrogens and acceptors closer than distance (searched with a
+    cell list) with a donor-hydrogen-acceptor angle of at least
+    angle degrees. Return the hydrogens and the acceptors."""
+
+    h_pos = positions[hydrogens]
+    a_pos = positions[acceptors]
+    pairs = il.run_cell_pairs(h_pos, a_pos, distance)
+    h_ix, a_ix = pairs[:,0], pairs[:,1]
+    # vectors from the hydrogen to the donor and to the acceptor
+    h_d = positions[donors[h_ix]] - h_pos[h_ix]
+    h_a = a_pos[a_ix] - h_pos[h_ix]
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        cosines = np.sum(h_d*h_a, axis = 1) / \
+                  (np.linalg.norm(h_d, axis = 1) * \
+                   np.linalg.norm(h_a, axis = 1))
+    angles = np.rad2deg(np.arccos(np.clip(cosines, -1.0, 1.0)))
+    found = angles >= angle
+    return (hydrogens[h_ix[found]], acceptors[a_ix[found]])
+
+
+def calc_hbonds_counts(candidates, \
+                       uni, \
+                       distance = 3.0, \
+                       angle = 120.0, \
+                       start = None, \
+                       stop = None, \
+                       classes = None):
+    """Find the hydrogen bonds between the candidates generated by
+    generate_hbonds_candidates and count the frames (between the
+    start and stop frames, if given) in which each hydrogen bond,
+    and each pair of residues connected by at least one hydrogen bond,
+    are found. Return the counts and the number of frames.
+    If a list of classes is given, each as a pair of boolean arrays
+    telling which candidate atoms belong to the two groups of the
+    class, the hydrogen bonds between the two groups (the donor heavy
+    atom in one, the acceptor in the other) are counted separately
+    for each class in the same pass, and a list of counts and number
+    of frames is returned, one for each class."""
+
+    atoms, directions = candidates
+    natoms = len(atoms)
+    # donor heavy atom of each hydrogen
+    h_donors = np.zeros(natoms, dtype = np.int_)
+    for donors, hydrogens, acceptors in directions:
+        h_donors[hydrogens] = donors
+    # a single class includes all the hydrogen bonds
+    one_class = classes is None
+    if one_class:
+        everything = np.ones(natoms, dtype = bool)
+        classes = [(everything, everything)]
+    # identifiers of the residues of the atoms, and the position of
+    # the identifier of each atom among them
+    res_identifiers = []
+    res_positions = {}
+    for res in atoms.residues:
+        identifier = (res.segid, res.resid, res.resname, "residue")
+        if identifier not in res_positions:
+            res_positions[identifier] = len(res_identifiers)
+            res_identifiers.append(identifier)
+    atom_res = np.array(\
+        [res_positions[(a.segid, a.resid, a.resname, "residue")] \
+         for a in atoms], dtype = np.int_)
+    nres = len(res_identifiers)
+    # hydrogen bonds are identified by the positions of hydrogen
+    # and acceptor in the atom group, and pairs of residues by the
+    # positions of their identifiers (lower first), packed in a
+    # single integer
+    counters = [(PairsCounter(), PairsCounter()) for cls in classes]
+    numframes = 0
+    for positions, in iter_positions(uni, [atoms], start = start, \
+                                     stop = stop):
+        with profile_stage("kernel"):
+            positions = positions.astype(np.float64)
+            keys = [np.empty(0, dtype = np.int_)]
+            for donors, hydrogens, acceptors in directions:
+                h_found, a_found = find_hbonds(positions = positions, \
+                                               donors = donors, \
+                                               hydrogens = hydrogens, \
+                                               acceptors = acceptors, \
+                                               distance = distance, \
+                                               angle = angle)
+                keys.append(h_found*natoms + a_found)
+            # each hydrogen bond, and each pair of residues, is
+            # counted once per frame
+            keys = np.unique(np.concatenate(keys))
+            d_found = h_donors[keys // natoms]
+            a_found = keys % natoms
+            for (in1, in2), (counter, res_counter) in zip(classes, counters):
+                in_class = (in1[d_found] & in2[a_found]) | \
+                           (in2[d_found] & in1[a_found])
+                class_keys = keys[in_class]
+                counter.add(class_keys)
+                res1 = atom_res[class_keys // natoms]
+                res2 = atom_res[class_keys % natoms]
+                res_counter.add(np.unique(np.minimum(res1, res2)*nres + \
+                                          np.maximum(res1, res2)))
+        numframes += 1
+    profile_frames(numframes)
     
-    # import the hydrogen bonds analysis module
-    from MDAnalysis.analysis.hbonds import hbond_analysis
-    # check if selection 1 is valid
-    try:
-        sel1atoms = uni.select_atoms(sel1)
-    except:
-        log.error("ERROR: selection 1 is invalid")
-    # check if selection 2 is valid
-    try:
-        sel2atoms = uni.select_atoms(sel2)
-    except:
-        log.error("ERROR: selection 2 is invalid")      
-    # check if custom donors and acceptors were provided
-    if other_hbs is None:
-        class Custom_HydrogenBondAnalysis(hbond_analysis.HydrogenBondAnalysis):
-            pass
-        hb_ff = "CHARMM27"
-    else:  
-        # custom names
-        class Custom_HydrogenBondAnalysis(hbond_analysis.HydrogenBondAnalysis):
-            DEFAULT_DONORS = {"customFF" : other_hbs["DONORS"]}
-            DEFAULT_ACCEPTORS = {"customFF" : other_hbs["ACCEPTORS"]}
-        hb_ff = "customFF"
-    # set up the hydrogen bonds analysis
-    h = Custom_HydrogenBondAnalysis(universe = uni, \
-                                    selection1 = sel1, \
-                                    selection2 = sel2, \
-                                    distance = distance, \
-                                    angle = angle, \
-                                    forcefield = hb_ff, \
-                                    update_selection1 = update_selection1, \
-                                    update_selection2 = update_selection2, \
-                                    filter_first = filter_first)
-    # inform the user about the hydrogen bond analysis parameters
-    logstr = "Will use {:s}: {:s}"
-    log.info(logstr.format("acceptors", \
-                           ", ".join(h.DEFAULT_ACCEPTORS[hb_ff])))
-    log.info(logstr.format("donors", \
-                           ", ".join(h.DEFAULT_DONORS[hb_ff])))
-    log.info("Running hydrogen bonds analysis . . .")
-    # run the hydrogen bonds analysis
-    h.run()
-    log.info("Done! Finalizing . . .")
-    # get the hydrogen bonds timeseries
-    data = h.timeseries
+    with profile_stage("assembly"):
+        results = [format_hbonds_counts(atoms = atoms, \
+                                        h_donors = h_donors, \
+                                        res_identifiers = res_identifiers, \
+                                        counter = counter, \
+                                        res_counter = res_counter) \
+                   + (numframes,) \
+                   for counter, res_counter in counters]
+    
+    if one_class:
+        return results[0]
+    return results
+
+
+def format_hbonds_counts(atoms, \
+                         h_donors, \
+                         res_identifiers, \
+                         counter, \
+                         res_counter):
+    """Convert the counts of the packed keys of hydrogen bonds and
+    pairs of residues into the counts by hydrogen bond and by pair
+    of residue identifiers."""
+
+    natoms = len(atoms)
+    nres = len(res_identifiers)
+    names = atoms.names
+    # each hydrogen bond is identified by donor hydrogen index,
+    # acceptor index, donor heavy atom name and acceptor name
+    hb_counts = collections.OrderedDict()
+    keys, counts = counter.items()
+    hs, accs = np.divmod(keys, natoms)
+    for h, acc, count in zip(hs.tolist(), accs.tolist(), counts.tolist()):
+        key = (int(atoms.indices[h]), int(atoms.indices[acc]), \
+               str(names[h_donors[h]]), str(names[acc]))
+        hb_counts[key] = count
+    # number of occurrences for each pair of residues
+    res_counts = collections.Counter()
+    keys, counts = res_counter.items()
+    res1, res2 = np.divmod(keys, nres)
+    for r1, r2, count in zip(res1.tolist(), res2.tolist(), \
+                             counts.tolist()):
+        identifier = frozenset((res_identifiers[r1], \
+                                res_identifiers[r2]))
+        res_counts[identifier] = count
+
+    return (hb_counts, res_counts)
+
+
+def format_hbonds(hb_counts, \
+                  res_counts, \
+                  numframes, \
+                  pdb, \
+                  uni, \
+                  perco = 0.0, \
+                  perresidue = False, \
+                  do_fullmatrix = False, \
+                  as_records = False):
+    """Build the output records (or string, unless as_records is
+    True) and, if requested, the full matrix from the hydrogen bonds
+    counts."""
+
     # create identifiers for the uni Universe
     uni_identifiers = [(res.segid, res.resid, res.resname, "residue") \
                        for res in uni.residues]
@@ -1004,47 +2213,16 @@ def do_hbonds(sel1, \
     # indexes in the matrix
     uni_id2ix = \
         dict([(item, i) for i, item in enumerate(uni_identifiers)])
-    # utility function to get the identifier of a hydrogen bond
-    get_identifier = \
-        lambda uni, hbond: frozenset(((uni.atoms[hbond[0]].segid, \
-                                       uni.atoms[hbond[0]].resid, \
-                                       uni.atoms[hbond[0]].resname, \
-                                       "residue"), \
-                                      (uni.atoms[hbond[1]].segid, \
-                                       uni.atoms[hbond[1]].resid, \
-                                       uni.atoms[hbond[1]].resname, \
-                                       "residue")))
     # initialize the full matrix to None
     fullmatrix = None
     # create the full matrix if requested
     if do_fullmatrix:
         fullmatrix = np.zeros((len(identifiers),len(identifiers)))
-    # set the empty output string
-    outstr = ""
+    # columns of the output records
+    columns = []
     if perresidue or do_fullmatrix:
-        # get the number of frames in the trajectory
-        numframes = len(uni.trajectory)
-        # set the output string format
-        outstr_fmt = "{:s}{:d}:{:s}{:d}\t\t{3.2f}\n"
-        # compatible with Python 3
-        setlist = \
-            list(set(zip(*list(zip(*list(itertools.chain(*data))))[0:2])))
-        # get a list of the unique hydrogen bonds identified (between
-        # pairs of residues)
-        identifiers_setlist = \
-            list(set([get_identifier(uni, hbond) for hbond in setlist]))
-        # initialize an empty counter (number of occurrences
-        # for each hydrogen bond)
-        outdata = collections.Counter(\
-            {identifier : 0 for identifier in identifiers_setlist})
-        # for each frame
-        for frame in data:
-            # update the counter for the occurences of each
-            # hydrogen bond in this frame
-            outdata.update(\
-                set([get_identifier(uni, hbond) for hbond in frame]))
         # for each hydrogen bond identified in the trajectory
-        for identifier, hb_occur in outdata.items():
+        for identifier, hb_occur in res_counts.items():
             # get the persistence of the hydrogen bond
             hb_pers = (float(hb_occur)/float(numframes))*100
             # convert the identifier from a frozenset to a list
@@ -1063,57 +2241,226 @@ def do_hbonds(sel1, \
             if do_fullmatrix:
                 fullmatrix[res1_resix, res2_resix] = hb_pers
                 fullmatrix[res2_resix, res1_resix] = hb_pers
-            # format the output string if requesets
+            # add the pair of residues to the output if requested
             if perresidue:
                 if hb_pers > perco:
-                    outstr += outstr_fmt.format(res1_segid, res1_resid, \
-                                                res1_segid, res1_resid, \
-                                                hb_pers)
+                    columns.append((res1_segid, res1_resid, \
+                                    res2_segid, res2_resid, \
+                                    hb_pers))
+        fields = HBONDS_RES_FIELDS
     
     # do not merge hydrogen bonds per residue
     if not perresidue:
-            # utility function to get the identifier of a hydrogen bond
-        get_list_identifier = \
-            lambda uni, hbond: [ (uni.atoms[hbond[0]].segid, \
-                                           uni.atoms[hbond[0]].resid, \
-                                           uni.atoms[hbond[0]].resname, \
-                                           "residue"), \
-                                          (uni.atoms[hbond[1]].segid, \
-                                           uni.atoms[hbond[1]].resid, \
-                                           uni.atoms[hbond[1]].resname, \
-                                           "residue") ]
-
-        # count hydrogen bonds by type
-        table = h.count_by_type()
-
-        hbonds_identifiers = \
-            [ get_list_identifier(uni, hbond) for hbond in table ]
-        # set output string format
-        outstr_fmt = \
-            "{:s}-{:d}{:s}_{:s}:{:s}-{:d}{:s}_{:s}\t\t{:3.2f}\n"
-        # for each hydrogen bonds identified
-        for i, hbidentifier in enumerate(hbonds_identifiers):
-            # get the hydrogen bond persistence
-            hb_pers = table[i][-1]*100
-            # get donor heavy atom and acceptor atom
-            donor_heavy_atom = table[i][4]
-            acceptor_atom = table[i][8]
-            # consider only those hydrogen bonds whose persistence
-            # is greater than the cut-off
-
-            if hb_pers > perco:
-
-                res1_segid, res1_resid, res1_resname, res1_tag = \
-                    identifiers[uni_id2ix[hbidentifier[0]]]
-
-                res2_segid, res2_resid, res2_resname, res2_tag = \
-                    identifiers[uni_id2ix[hbidentifier[1]]]
-                
-                outstr += outstr_fmt.format(\
-                            res1_segid, res1_resid, res1_resname,
-                            donor_heavy_atom,
-                            res2_segid, res2_resid, res2_resname,
-                            acceptor_atom, hb_pers)
-
-    # return output string and full matrix
-    return (outstr, fullmatrix)
+        # donor and acceptor atom indexes, heavy atom names and
+        # persistences of the hydrogen bonds
+        hbonds = list(hb_counts.keys())
+        donors = np.array([hbond[0] for hbond in hbonds], dtype = int)
+        acceptors = np.array([hbond[1] for hbond in hbonds], dtype = int)
+        hb_pers = np.array(list(hb_counts.values()), dtype = float) \
+                  / float(numframes) * 100
+        # consider only those hydrogen bonds whose persistence
+        # is greater than the cut-off
+        keep = np.nonzero(hb_pers > perco)[0]
+        # utility function to get the reference identifier of the
+        # residue an atom belongs to
+        get_identifier = \
+            lambda atom: identifiers[uni_id2ix[(atom.segid, \
+                                                atom.resid, \
+                                                atom.resname, \
+                                                "residue")]]
+        for k in keep:
+            res1_segid, res1_resid, res1_resname, res1_tag = \
+                get_identifier(uni.atoms[donors[k]])
+            res2_segid, res2_resid, res2_resname, res2_tag = \
+                get_identifier(uni.atoms[acceptors[k]])
+            columns.append((donors[k], res1_segid, res1_resid, \
+                            res1_resname, hbonds[k][2], \
+                            acceptors[k], res2_segid, res2_resid, \
+                            res2_resname, hbonds[k][3], \
+                            hb_pers[k]))
+        fields = HBONDS_FIELDS
+
+    records = make_records(fields, \
+                           zip(*columns) if columns \
+                           else [[] for field in fields])
+    # return output records (or string) and full matrix
+    if as_records:
+        return (records, fullmatrix)
+    return (records_to_str(records), fullmatrix)
+
+
+def do_hbonds(sel1, \
+              sel2, \
+              pdb, \
+              uni, \
+              distance = 3.0, \
+              angle = 120, \
+              perco = 0.0, \
+              perresidue = False, \
+              do_fullmatrix = False, \
+              other_hbs = None, \
+              trjs = None, \
+              nprocs = None, \
+              partial_fname = None, \
+              checkpoint_every = None, \
+              resume = False, \
+              as_records = False, \
+              classes = None):
+    """Compute the persistence of the hydrogen bonds between two
+    selections and return the output string (records if as_records
+    is True) and the full matrix. If a list of trajectories is given,
+    each replica is processed separately and a list of per-replica
+    (output string, full matrix) is returned as well. If partial_fname
+    is given, the counts are saved there as partial results (every
+    checkpoint_every frames, resuming from the frames already there
+    if resume is True, for a single trajectory). If a dictionary of
+    classes of hydrogen bonds is given, each as a pair of selections
+    within the two selections, the hydrogen bonds of all classes are
+    found in a single pass and a dictionary of the results for each
+    class is returned instead."""
+
+    if trjs is not None and (checkpoint_every or resume):
+        raise ValueError("Checkpoints are not supported for replicas.")
+    if classes is not None and partial_fname is not None:
+        errstr = "Partial results are not supported for classes of " \
+                 "hydrogen bonds."
+        raise ValueError(errstr)
+    
+    # check if selection 1 is valid
+    try:
+        sel1atoms = uni.select_atoms(sel1)
+    except:
+        log.error("ERROR: selection 1 is invalid")
+    # check if selection 2 is valid
+    try:
+        sel2atoms = uni.select_atoms(sel2)
+    except:
+        log.error("ERROR: selection 2 is invalid")      
+    # check if custom donors and acceptors were provided
+    if other_hbs is None:
+        donors = HB_DEFAULT_DONORS
+        acceptors = HB_DEFAULT_ACCEPTORS
+    else:
+        donors = other_hbs["DONORS"]
+        acceptors = other_hbs["ACCEPTORS"]
+    # find the atoms which can form hydrogen bonds
+    with profile_stage("identifiers"):
+        candidates = \
+            generate_hbonds_candidates(uni = uni, \
+                                       sel1 = sel1, \
+                                       sel2 = sel2, \
+                                       donors = donors, \
+                                       acceptors = acceptors)
+        # which candidate atoms belong to the groups of each class
+        if classes is not None:
+            indices = candidates[0].indices
+            masks = \
+                [tuple(np.isin(indices, uni.select_atoms(sel).indices) \
+                       for sel in class_sels) \
+                 for class_sels in classes.values()]
+        else:
+            masks = None
+    # inform the user about the hydrogen bond analysis parameters
+    logstr = "Will use {:s}: {:s}"
+    log.info(logstr.format("acceptors", ", ".join(acceptors)))
+    log.info(logstr.format("donors", ", ".join(donors)))
+    log.info("Running hydrogen bonds analysis . . .")
+    
+    countsfunc = \
+        lambda u, start = None, stop = None: \
+            calc_hbonds_counts(candidates = candidates, \
+                               uni = u, \
+                               distance = distance, \
+                               angle = angle, \
+                               start = start, \
+                               stop = stop, \
+                               classes = masks)
+    formatfunc = \
+        lambda hb_counts, res_counts, numframes: \
+            format_hbonds(hb_counts = hb_counts, \
+                          res_counts = res_counts, \
+                          numframes = numframes, \
+                          pdb = pdb, \
+                          uni = uni, \
+                          perco = perco, \
+                          perresidue = perresidue, \
+                          do_fullmatrix = do_fullmatrix, \
+                          as_records = as_records)
+
+    # partial results for the counts
+    if partial_fname is not None:
+        params = {"sel1" : sel1, \
+                  "sel2" : sel2, \
+                  "distance" : distance, \
+                  "angle" : angle, \
+                  "perco" : perco, \
+                  "perresidue" : perresidue}
+        fingerprint = get_topology_fingerprint(uni)
+        makefunc = \
+            lambda counts, numframes: \
+                make_partial(kind = "hb", \
+                             counts = counts, \
+                             numframes = numframes, \
+                             params = params, \
+                             fingerprint = fingerprint, \
+                             labels = {})
+
+    if classes is not None:
+        if trjs is None:
+            results = [countsfunc(uni)]
+        else:
+            results = run_replicas(countsfunc, uni, trjs, nprocs)
+            profile_frames(sum([result[0][2] for result in results]))
+        log.info("Done! Finalizing . . .")
+        outputs = collections.OrderedDict()
+        with profile_stage("assembly"):
+            for i, name in enumerate(classes):
+                class_results = [result[i] for result in results]
+                output = formatfunc(*merge_hbonds_counts(class_results))
+                if trjs is not None:
+                    replicas = [formatfunc(*result) \
+                                for result in class_results]
+                    output += (replicas,)
+                outputs[name] = output
+        return outputs
+
+    replicas = None
+    if trjs is None and partial_fname is not None:
+        # add the counts of each chunk of frames to the previous ones
+        def sumfunc(start, stop, counts):
+            chunk = countsfunc(uni, start, stop)
+            if counts is None:
+                return chunk[:2]
+            return merge_hbonds_counts([counts + (0,), chunk])[:2]
+        counts, numframes = \
+            run_checkpointed(sumfunc = sumfunc, \
+                             makefunc = makefunc, \
+                             numframes = len(uni.trajectory), \
+                             fname = partial_fname, \
+                             checkpoint_every = checkpoint_every, \
+                             resume = resume)
+        hb_counts, res_counts = counts
+        log.info("Done! Finalizing . . .")
+    elif trjs is None:
+        hb_counts, res_counts, numframes = countsfunc(uni)
+        log.info("Done! Finalizing . . .")
+    else:
+        results = run_replicas(countsfunc, uni, trjs, nprocs)
+        log.info("Done! Finalizing . . .")
+        # hydrogen bonds for each replica
+        replicas = [formatfunc(*result) for result in results]
+        # hydrogen bonds over all the replicas
+        hb_counts, res_counts, numframes = merge_hbonds_counts(results)
+        profile_frames(numframes)
+        # save the counts, if requested
+        if partial_fname is not None:
+            save_partial(partial_fname, \
+                         makefunc((hb_counts, res_counts), numframes))
+
+    with profile_stage("assembly"):
+        outstr, fullmatrix = formatfunc(hb_counts, res_counts, numframes)
+
+    if replicas is None:
+        return (outstr, fullmatrix)
+    # return pooled output string and full matrix, and replicas
+    return (outstr, fullmatrix, replicas)
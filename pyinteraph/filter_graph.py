@@ -24,14 +24,15 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import os.path
 import sys
 import logging as log
 
-import matplotlib.pyplot as plt
-import networkx as nx
 import numpy as np
-from scipy.optimize import curve_fit
-from scipy.optimize import fsolve
+from libinteract import libinteract as li
+from pyinteraph import graph_io as gio
+# scipy and matplotlib are slow to import, therefore
+# they are imported only by the functions using them
 
 
 ########################## HELPER FUNCTIONS ###########################
@@ -50,19 +51,19 @@ def seconddevsigmoid(x, x0, k, l, m):
     return y
 
 
-def process_matrices(fnames):
-    """Load and process matrix files. """
+def process_matrices(fnames, cache = False, nprocs = None):
+    """Load and process matrix files (in parallel, see
+    graph_io.load_graphs for cache and nprocs)."""
 
     # empty list to store matrices
     matrices = []
-    for fname in fnames:
-        try:
-            matrices.append(np.loadtxt(fname))
-        except:
-            # catch numpy errors and include the traceback when logging
+    graphs = gio.load_graphs(fnames, cache = cache, nprocs = nprocs)
+    for fname, graph in zip(fnames, graphs):
+        if graph is None:
             errstr = \
                 f"Could not open file {fname}, or file in wrong format."
             raise IOError(errstr)
+        matrices.append(graph[0])
     # get matrix shapes
     shapes = [matrix.shape for matrix in matrices]
     # all matrices must have the same shape
@@ -72,7 +73,7 @@ def process_matrices(fnames):
     for fname, matrix in zip(fnames, matrices):
         if matrix.shape[0] != matrix.shape[1]:
             raise ValueError(f"Matrix {fname} is not square.")
-        if not np.allclose(matrix, matrix.T):
+        if not gio.is_symmetric(matrix):
             raise ValueError(f"Matrix {fname} is not symmetric.")
         # all diagonal elements must be zero
         np.fill_diagonal(matrix, 0.0)
@@ -80,34 +81,100 @@ def process_matrices(fnames):
     return matrices
 
 
+def get_identifiers(fnames):
+    """Get the node identifiers stored in the graph files (None if
+    none of them stores them). Raise ValueError if two files store
+    different identifiers, or the same ones in a different order."""
+
+    identifiers = None
+    for fname in fnames:
+        file_ids = gio.load_identifiers(fname)
+        # files written by other tools do not store them
+        if file_ids is None:
+            continue
+        if identifiers is None:
+            identifiers, first = file_ids, fname
+        elif file_ids != identifiers:
+            errstr = f"The nodes of {fname} are not those of {first}, " \
+                     "in the same order."
+            raise ValueError(errstr)
+    return identifiers
+
+
+def get_clustsize_curve(matrices, lowest = 0.0):
+    """Get the size of the biggest cluster as a function of the
+    persistence cut-off, for all the cut-offs not lower than lowest.
+    Edges are added to a union-find structure from the most to the
+    least persistent one, so that the curve is exact and computed in
+    a single pass. Return the distinct persistence values of the
+    edges in decreasing order and, for each of them, the size of the
+    biggest cluster when the edges at least as persistent are
+    included (i.e. for cut-offs up to the next value)."""
+
+    # in case more than one input matrix was provided, an edge
+    # exceeds a cut-off if it does in any of the matrices
+    allmatrix = np.maximum.reduce(matrices)
+    nnodes = allmatrix.shape[0]
+    rows, cols = np.nonzero(np.triu(allmatrix > lowest, k = 1))
+    weights = allmatrix[rows, cols]
+    # sort the edges from the most to the least persistent
+    order = np.argsort(-weights, kind = "stable")
+    rows, cols, weights = rows[order], cols[order], weights[order]
+    # each node starts as a cluster by itself
+    parents = list(range(nnodes))
+    sizes = [1] * nnodes
+    maxsize = 1 if nnodes else 0
+    values = []
+    maxclustsizes = []
+    for row, col, weight in zip(rows.tolist(), cols.tolist(), \
+                                weights.tolist()):
+        # find the roots of the clusters of both nodes, halving
+        # the paths to the roots along the way
+        while parents[row] != row:
+            parents[row] = parents[parents[row]]
+            row = parents[row]
+        while parents[col] != col:
+            parents[col] = parents[parents[col]]
+            col = parents[col]
+        # merge the smaller cluster into the bigger one
+        if row != col:
+            if sizes[row] < sizes[col]:
+                row, col = col, row
+            parents[col] = row
+            sizes[row] += sizes[col]
+            maxsize = max(maxsize, sizes[row])
+        # only the last edge with a given value defines the point
+        if values and values[-1] == weight:
+            maxclustsizes[-1] = maxsize
+        else:
+            values.append(weight)
+            maxclustsizes.append(maxsize)
+    return np.array(values), np.array(maxclustsizes, dtype = int)
+
+
 def get_maxclustsizes(matrices, interval):
     """Get maximum cluster sizes."""
     
-    # empty list to store maximum cluster sizes
-    maxclustsizes = []
-    # for each value in the interval
-    for val in interval:
-        # boolean matrices indicating where the original
-        # matrices exceed val       
-        boolmatrices = [matrix > val for matrix in matrices]
-        # in case more there was more than one input matrix,
-        # the final matrix will be a matrix resulting from an
-        # element-wise logical OR applied to all matrices
-        allmatrix = np.logical_or.reduce(boolmatrices)
-        # build a graph from the final boolean matrix
-        G = nx.Graph(allmatrix)
-        # get the maximum cluster size from the graph
-        maxclustsizes.append(\
-            len(max(list(\
-                nx.algorithms.components.connected_components(G)), \
-            key = len)))
+    # empty interval
+    if len(interval) == 0:
+        return []
+    # the curve is computed only once, down to the lowest cut-off
+    values, sizes = get_clustsize_curve(matrices = matrices, \
+                                        lowest = min(interval))
+    # size of the biggest cluster without edges
+    nosize = 1 if matrices[0].shape[0] else 0
+    # number of distinct persistence values above each cut-off
+    nabove = np.searchsorted(-values, -np.asarray(interval), \
+                             side = "left")
     # return the list of maximum cluster sizes
-    return maxclustsizes
+    return [int(sizes[n-1]) if n > 0 else nosize for n in nabove]
 
 
 def perform_fitting(f, xdata, ydata, maxfev, p0):
     """Perform curve fitting."""
     
+    from scipy.optimize import curve_fit
+
     # args will be None unless the fitting completes successfully
     args = None
     try:
@@ -148,6 +215,8 @@ def perform_fitting(f, xdata, ydata, maxfev, p0):
 def find_flex(func, x0, args, maxfev):
     """Find the point of inflection."""
 
+    from scipy.optimize import fsolve
+
     # flex will be None unless the calculation completes successfully
     return fsolve(func = seconddevsigmoid,
                   x0 = x0,
@@ -167,6 +236,8 @@ def perform_plotting(x,
     """Plot the dependency between the persistence
     cut-off and the size of the biggest cluster."""
 
+    import matplotlib.pyplot as plt
+
     # plot as dots
     plt.plot(x, y, "o")
     # set X-axis limit
@@ -208,34 +279,103 @@ def write_clusters(out_clusters, interval, maxclustsizes):
             fh.write("{:.3f}\t{:d}\n".format(pmin, maxclustsize))
 
 
+def iter_sparse_matrices(fnames, cache = False):
+    """Load and process matrix files one at a time, as scipy.sparse
+    matrices (see graph_io.load_text_graph for cache)."""
+
+    import scipy.sparse as sp
+
+    shape = None
+    for fname in fnames:
+        try:
+            matrix = gio.load_csr_graph(fname, cache = cache)[0]
+        except:
+            errstr = \
+                f"Could not open file {fname}, or file in wrong format."
+            raise IOError(errstr)
+        # all matrices must have the same shape
+        if shape is not None and matrix.shape != shape:
+            raise ValueError("Matrices do not have the same shape.")
+        shape = matrix.shape
+        # check if the matrix are square and symmetric
+        if matrix.shape[0] != matrix.shape[1]:
+            raise ValueError(f"Matrix {fname} is not square.")
+        if not gio.is_symmetric(matrix):
+            raise ValueError(f"Matrix {fname} is not symmetric.")
+        # all diagonal elements must be zero
+        matrix = matrix - sp.diags(matrix.diagonal(), format = "csr")
+        matrix.eliminate_zeros()
+        yield matrix
+
+
+def get_union_maximum(A, B):
+    """Get the element-wise maximum of two scipy.sparse matrices
+    over the union of their stored elements: elements stored in only
+    one of them are kept as they are (A.maximum(B) would compare
+    them with zero, dropping negative values)."""
+
+    import scipy.sparse as sp
+
+    both = (A != 0).multiply(B != 0)
+    # the three terms have disjoint sets of non-zero elements, so
+    # their sum is exact
+    union = (A - A.multiply(both)) + (B - B.multiply(both)) + \
+            A.maximum(B).multiply(both)
+    union = sp.csr_matrix(union)
+    union.eliminate_zeros()
+    return union
+
+
 def write_dat(matrices,
               matrix_filter,
               out_dat,
-              weights = None):
+              weights = None,
+              identifiers = None,
+              metadata = None,
+              weighted_union = False,
+              cache = False):
 
     """Write matrices to a .dat file (logical OR applied if
-    multiple input matrices provided)"""
-    
-    if len(matrices) == 1:
-        # where the mask is True, the corresponding value 
-        # in the array is invalid    
-        mask = (matrices[0] <= matrix_filter)
-        out_matrix = np.ma.masked_array(data = matrices[0],
-                                        mask = mask,
-                                        fill_value = 0.0).filled()
-    else:
-        # boolean matrices indicating where the original
-        # matrices exceed val  
-        boolmatrices = [matrix > matrix_filter for matrix in matrices]
-        # in case more there was more than one input matrix,
-        # the final matrix will be a matrix resulting from an
-        # element-wise logical OR applied to all matrices
-        out_matrix = np.logical_or.reduce(boolmatrices)
+    multiple input matrices provided, or the maximum value if
+    weighted_union is True). Matrices, either dense or
+    scipy.sparse, are combined one at a time as sparse edge sets,
+    so they can be loaded lazily (e.g. by iter_sparse_matrices).
+    If a matrix of weights is provided, its values are used for
+    the edges of the output matrix. Node identifiers and metadata
+    are saved in either format (see graph_io.save_graph)."""
+
+    import scipy.sparse as sp
+
+    out_matrix = None
+    nmatrices = 0
+    for matrix in matrices:
+        # only the edges exceeding the filter are kept
+        matrix = sp.csr_matrix(matrix, dtype = float)
+        matrix.data[matrix.data <= matrix_filter] = 0.0
+        matrix.eliminate_zeros()
+        if out_matrix is None:
+            out_matrix = matrix
+        elif out_matrix.shape != matrix.shape:
+            raise ValueError("Matrices do not have the same shape.")
+        elif weighted_union:
+            out_matrix = get_union_maximum(out_matrix, matrix)
+        else:
+            # only the edges are needed
+            out_matrix = (out_matrix != 0) + (matrix != 0)
+        nmatrices += 1
+    if out_matrix is None:
+        raise ValueError("No input matrices provided.")
+    # in case more there was more than one input matrix, the
+    # final matrix will be a matrix resulting from an element-wise
+    # logical OR applied to all matrices
+    if nmatrices > 1 and not weighted_union:
+        out_matrix = sp.csr_matrix(out_matrix, dtype = float)
+        out_matrix.data[:] = 1.0
     # if a matrix of weights was provided 
     if weights is not None:
         # try to open the matrix file
         try:
-            weights_matrix = np.loadtxt(weights)
+            weights_matrix = gio.load_csr_graph(weights, cache = cache)[0]
         except:
             raise IOError("Could not read weights matrix.")
         # check the shape of the matrix of weights
@@ -243,13 +383,133 @@ def write_dat(matrices,
             raise ValueError("Output and weight matrix "
                              "have different shapes.")
         # update out matrix
-        out_matrix = np.ma.masked_array(data = weights_matrix,
-                                        mask = out_matrix > 0.0,
-                                        fill_value = 0.0).filled()
+        out_matrix = weights_matrix.multiply(out_matrix != 0).tocsr()
     # save the output matrix
-    np.savetxt(out_dat, out_matrix, fmt = "%3.2f")
+    gio.save_graph(out_dat,
+                   out_matrix,
+                   fmt = "%3.2f",
+                   identifiers = identifiers,
+                   metadata = metadata)
+
+
+############################# BATCH MODE ##############################
+
+def estimate_critical_value(fname, interval, p0, maxfev, cache = False):
+    """Compute the maximum cluster sizes over the interval for a
+    single graph, fit them to a sigmoid and find its inflection
+    point. Return the maximum cluster sizes, the parameters of the
+    fitting (None if it failed) and the critical value (None if no
+    inflection point was found)."""
+
+    matrices = process_matrices(fnames = [fname], \
+                                cache = cache, \
+                                nprocs = 1)
+    maxclustsizes = get_maxclustsizes(matrices = matrices, \
+                                      interval = interval)
+    args = perform_fitting(f = sigmoid, \
+                           xdata = interval, \
+                           ydata = maxclustsizes, \
+                           maxfev = maxfev, \
+                           p0 = p0)
+    if args is None:
+        return maxclustsizes, None, None
+    flex, infodict, ier, mesg = find_flex(func = seconddevsigmoid, \
+                                          x0 = p0[0], \
+                                          args = args, \
+                                          maxfev = 5000)
+    return maxclustsizes, args, (flex[0] if ier == 1 else None)
+
+
+def _run_batch_graph(fname, interval, p0, maxfev, cache):
+    """Run estimate_critical_value on one graph of the batch run,
+    returning None if the graph could not be processed."""
 
+    try:
+        return estimate_critical_value(fname = fname, \
+                                       interval = interval, \
+                                       p0 = p0, \
+                                       maxfev = maxfev, \
+                                       cache = cache)
+    except (IOError, ValueError):
+        log.error(f"Could not process {fname}.", exc_info = True)
+        return None
+
+
+def run_batch(fnames, interval, p0, maxfev, cache = False, nprocs = None):
+    """Estimate the critical value of each graph separately (see
+    estimate_critical_value). Graphs are processed concurrently by
+    forked worker processes (at most nprocs, by default one per
+    graph up to the number of CPUs). Return the list of results,
+    with None for the graphs which could not be processed."""
+
+    return li.run_forked(_run_batch_graph, \
+                         (interval, p0, maxfev, cache), \
+                         fnames, \
+                         nprocs)
+
+
+def write_batch(out_batch, fnames, interval, results):
+    """Write the maximum cluster sizes, the parameters of the
+    fitting and the critical value of each graph of a batch run
+    to a tab-separated table (missing values are written as nan)."""
 
+    try:
+        fh = open(out_batch, "w")
+    except:
+        raise IOError("Could not write batch results file.")
+    nan = float("nan")
+    with fh:
+        header = ["File", "x0", "k", "m", "n", "Critical value"] + \
+                 ["{:.3f}".format(pmin) for pmin in interval]
+        fh.write("\t".join(header) + "\n")
+        for fname, result in zip(fnames, results):
+            if result is None:
+                result = ([nan] * len(interval), None, None)
+            maxclustsizes, args, flex = result
+            values = list(args or (nan,) * 4) + \
+                     [flex if flex is not None else nan]
+            row = [fname] + \
+                  ["{:.5f}".format(value) for value in values] + \
+                  ["{:g}".format(size) for size in maxclustsizes]
+            fh.write("\t".join(row) + "\n")
+
+
+def perform_batch_plotting(x,
+                           fnames,
+                           results,
+                           lower,
+                           upper,
+                           out_plot,
+                           func_sigmoid = None):
+    """Plot the dependency between the persistence cut-off and
+    the size of the biggest cluster for all the graphs of a batch
+    run in a single figure."""
+
+    import matplotlib.pyplot as plt
+
+    xplot = np.linspace(max(x), min(x))
+    for fname, result in zip(fnames, results):
+        if result is None:
+            continue
+        maxclustsizes, args, flex = result
+        # same color for the points, the fitting and the
+        # critical value of each graph
+        points, = plt.plot(x, maxclustsizes, "o", \
+                           label = os.path.basename(fname))
+        color = points.get_color()
+        if args is not None:
+            plt.plot(xplot, func_sigmoid(xplot, *args), color = color)
+            if flex is not None:
+                plt.axvline(x = flex, color = color, linestyle = ":")
+    # set X-axis limit
+    plt.xlim((lower, upper))
+    # set axes labels
+    plt.xlabel("$p_{min}$")
+    plt.ylabel("Size of the biggest cluster")
+    # plot the legend
+    plt.legend(loc = "best", fontsize = "small")
+    # save the figure
+    plt.savefig(out_plot)
 
 
 def main():
@@ -259,14 +519,17 @@ def main():
     parser = argparse.ArgumentParser(description = description)
 
     d_helpstr = \
-        ".dat file matrices (multiple: -d file.dat -d file2.dat ...)"
+        ".dat file matrices, either text or .npz (multiple: " \
+        "-d file.dat -d file2.dat ...)"
     parser.add_argument("-d", "--input-dat",
                         dest = "datfiles",
                         help = d_helpstr,
                         action = "append",
                         default = None)
 
-    o_helpstr = "Output .dat file matrix"
+    o_helpstr = \
+        "Output .dat file matrix (compressed sparse format if the " \
+        "name ends in .npz)"
     parser.add_argument("-o", "--output-dat",
                         dest = "out_dat",
                         help = o_helpstr,
@@ -339,6 +602,15 @@ def main():
                         type = str,
                         default = None)
 
+    wu_helpstr = \
+        "When combining multiple input matrices, weight each edge " \
+        "of the output matrix with its highest value in the input " \
+        "matrices, instead of 1"
+    parser.add_argument("--weighted-union",
+                        dest = "weighted_union",
+                        help = wu_helpstr,
+                        action = "store_true")
+
     x_default = 20.0
     x_helpstr = \
         "Starting x0 parameter for sigmoid fitting (default: {:f})"
@@ -375,6 +647,36 @@ def main():
                         type = float,
                         default = n_default)
 
+    cache_helpstr = \
+        "Keep a binary cache of each text input matrix next to it " \
+        "(file name + {:s}), used as long as the matrix file is not " \
+        "modified"
+    parser.add_argument("--cache",
+                        dest = "cache",
+                        help = cache_helpstr.format(gio.CACHE_SUFFIX),
+                        action = "store_true")
+
+    b_helpstr = \
+        "Batch mode: process each input matrix separately, fitting " \
+        "its curve and finding its critical value, and write the " \
+        "results for all the matrices to this table (the plot, if " \
+        "requested, shows all the curves)"
+    parser.add_argument("-b", "--batch",
+                        dest = "out_batch",
+                        help = b_helpstr,
+                        type = str,
+                        default = None)
+
+    nprocs_helpstr = \
+        "Maximum number of input matrices loaded (or processed, " \
+        "in batch mode) at the same time (default: one process per " \
+        "matrix, up to the number of CPUs)"
+    parser.add_argument("--nprocs",
+                        dest = "nprocs",
+                        help = nprocs_helpstr,
+                        type = int,
+                        default = None)
+
     options = parser.parse_args()
 
 
@@ -395,17 +697,62 @@ def main():
             "[upper_value - lower_value]."
         log.error(logstr)
         exit(1)
-    # process matrices
-    matrices = process_matrices(fnames = options.datfiles)
+    # keep the node identifiers of the input matrices, if any
+    identifiers = None
+    if options.out_dat:
+        try:
+            identifiers = get_identifiers(options.datfiles)
+        except (IOError, ValueError):
+            log.error("Could not combine the nodes of the input " \
+                      "matrices. Exiting ...", exc_info = True)
+            exit(1)
+
+
+    ############################# BATCH MODE ##############################
+
+    if options.out_batch:
+        if options.out_dat or options.out_clusters:
+            log.error("Options -o and -c cannot be used in batch mode.")
+            exit(1)
+        interval = np.arange(options.lower, options.upper, options.step)
+        results = run_batch(fnames = options.datfiles,
+                            interval = interval,
+                            p0 = (options.x0, options.k,
+                                  options.m, options.n),
+                            maxfev = 100000,
+                            cache = options.cache,
+                            nprocs = options.nprocs)
+        write_batch(out_batch = options.out_batch,
+                    fnames = options.datfiles,
+                    interval = interval,
+                    results = results)
+        if options.out_plot:
+            perform_batch_plotting(x = interval,
+                                   fnames = options.datfiles,
+                                   results = results,
+                                   lower = options.lower,
+                                   upper = options.upper,
+                                   out_plot = options.out_plot,
+                                   func_sigmoid = sigmoid)
+        return
+
 
 
     ####################### MAXIMUM CLUSTER SIZES #########################
 
     # set the interval of persistence cut-offs
     interval = np.arange(options.lower, options.upper, options.step)
-    # find the maximum cluster size at each cut-off
-    maxclustsizes = get_maxclustsizes(matrices = matrices,
-                                      interval = interval)
+    # the matrices are all loaded at once only if the maximum
+    # cluster sizes are needed
+    matrices = None
+    if options.out_clusters or options.out_plot or options.do_fit:
+        # process matrices
+        matrices = process_matrices(fnames = options.datfiles,
+                                    cache = options.cache,
+                                    nprocs = options.nprocs)
+        # find the maximum cluster size at each cut-off
+        maxclustsizes = get_maxclustsizes(matrices = matrices,
+                                          interval = interval)
 
 
     ############################## FITTING ################################
@@ -480,10 +827,23 @@ def main():
     ############################# OUTPUT DAT ##############################
 
     if options.out_dat:
+        metadata = {"kind" : "filtered",
+                    "command" : sys.argv,
+                    "filter_threshold" : options.filter,
+                    "weighted_union" : options.weighted_union}
+        # otherwise, load the matrices one at a time while
+        # combining them
+        if matrices is None:
+            matrices = iter_sparse_matrices(fnames = options.datfiles,
+                                            cache = options.cache)
         write_dat(matrices = matrices,
                   matrix_filter = options.filter,
                   out_dat = options.out_dat,
-                  weights = options.weights)
+                  weights = options.weights,
+                  identifiers = identifiers,
+                  metadata = metadata,
+                  weighted_union = options.weighted_union,
+                  cache = options.cache)
 
 
 if __name__ == "__main__":
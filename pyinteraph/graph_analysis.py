@@ -25,16 +25,28 @@
 
 
 import argparse
+import glob
+import heapq
+import json
 import logging as log
 import os
 import os.path
 import re
+import shutil
 import sys
+import tempfile
 
-from Bio import PDB
-import MDAnalysis as mda
-import networkx as nx
 import numpy as np
+from libinteract import libinteract as li
+from pyinteraph import graph_io as gio
+# MDAnalysis and networkx are slow to import, therefore they are
+# imported only by the functions using them
+
+
+############################## CONSTANTS ##############################
+
+# columns of the occupancy and B-factor fields of PDB atom records
+PDB_COLUMNS = {"occupancy" : (54, 60), "bfactor" : (60, 66)}
 
 
 ############################## FUNCTIONS ##############################
@@ -51,70 +63,239 @@ def get_resnum(resstring):
     return re.findall(r"\d+", resstring)[0]
 
 
+def write_table(header, rows, fmts, outfile = None, note = None):
+    """Write a table to a file, as JSON (a list of objects mapping
+    the column names in header to the values of each row) if the
+    file name ends in .json, tab-separated otherwise (also to the
+    standard output if no file is given). fmts are the formats of
+    the values of the columns in the tab-separated table, where
+    lists of values are written comma-separated. A note on the
+    table, if any, follows the rows, as a line starting with # or
+    as an object with the "Note" key."""
+
+    if outfile and outfile.lower().endswith(".json"):
+        with open(outfile, "w") as out:
+            json.dump([dict(zip(header, row)) for row in rows] + \
+                      ([{"Note" : note}] if note else []), out)
+            out.write("\n")
+        return
+    out = open(outfile, "w") if outfile else sys.stdout
+    try:
+        out.write("\t".join(header) + "\n")
+        out.writelines(\
+            "\t".join(fmt.format(",".join(map(str, value)) \
+                                 if isinstance(value, list) else value) \
+                      for fmt, value in zip(fmts, row)) + "\n" \
+            for row in rows)
+        if note:
+            out.write(f"# {note}\n")
+    finally:
+        if outfile:
+            out.close()
+
+
+def index_pdb_residues(lines):
+    """Get the index of the residue each line of a PDB file belongs
+    to (-1 for lines which are not atom records). Residues are
+    numbered in order of appearance, from 0 in each model."""
+
+    residues = np.full(len(lines), -1)
+    current, key = -1, None
+    for i, line in enumerate(lines):
+        if line.startswith("MODEL"):
+            current, key = -1, None
+        elif line.startswith(("ATOM", "HETATM")):
+            # a new residue starts when the residue name, chain,
+            # residue number or insertion code change
+            if line[17:27] != key:
+                current, key = current + 1, line[17:27]
+            residues[i] = current
+    return residues
+
+
+def write_annotated_pdbs(pdb, annotations):
+    """Write copies of a PDB file with the occupancy and/or B-factor
+    columns of the atom records replaced with custom per-residue
+    values. annotations maps the name of each output file to the
+    values by column ("occupancy" or "bfactor"). The input file is
+    read only once."""
+
+    with open(pdb) as f:
+        lines = [line.rstrip("\r\n") for line in f]
+    residues = index_pdb_residues(lines)
+    atoms = np.flatnonzero(residues >= 0)
+    numres = residues.max() + 1
+    for pdb_out, columns in annotations.items():
+        out_lines = list(lines)
+        for column, vals in columns.items():
+            start, end = PDB_COLUMNS[column]
+            if len(vals) < numres:
+                errstr = \
+                    "{:s} has {:d} residues but only {:d} values " \
+                    "were given."
+                raise ValueError(errstr.format(pdb, numres, len(vals)))
+            # the fixed-width text of the value of each residue
+            fields = ["{:6.2f}".format(float(val)) for val in vals]
+            for i in atoms:
+                line = out_lines[i].ljust(end)
+                out_lines[i] = \
+                    line[:start] + fields[residues[i]] + line[end:]
+        with open(pdb_out, "w") as out:
+            out.write("\n".join(out_lines) + "\n")
+
+
 def replace_bfac_column(pdb, vals, pdb_out):
     """Replace the column containing B-factors in a PDB with
     custom values."""
 
-    # create tthe PDB parser
-    parser = PDB.PDBParser()
-    # get the protein structure
-    structure = parser.get_structure("protein", pdb)
-    io = PDB.PDBIO()
-    chain_offset = 0
-    for model in structure:
-        for chain in model:
-            for i, residue in enumerate(chain):
-                for atom in residue:
-                    # set the custom value
-                    atom.set_bfactor(float(vals[i+chain_offset]))
-            chain_offset += len(chain)
-    # set the structure for the output
-    io.set_structure(structure)
-    # save the structure to a new PDB file
-    io.save(pdb_out)
-
-
-def build_graph(fname, pdb = None):
-    """Build a graph from the provided matrix"""
+    write_annotated_pdbs(pdb = pdb, \
+                         annotations = {pdb_out : {"bfactor" : vals}})
+
+
+def get_reference_identifiers(pdb):
+    """Get the identifiers of the residues of a reference
+    structure."""
 
+    import MDAnalysis as mda
     try:
-        data = np.loadtxt(fname)
+        # generate a Universe object from the PDB file
+        u = mda.Universe(pdb)
+    except Exception:
+        errstr = \
+            "Exception caught during creation of the Universe."
+        raise ValueError(errstr)
+    return gio.get_residue_identifiers(u.residues)
+
+
+def load_graph_matrix(fname, pdb = None, cache = False, \
+                      check_pdb = False, ref_identifiers = None):
+    """Load the weight matrix of a graph as a scipy.sparse CSR
+    matrix, together with the identifiers of its nodes (rows), taken
+    from the graph file if it stores them, from the reference
+    structure if provided, or numbered from 1 otherwise (see
+    graph_io.load_text_graph for cache). If check_pdb is True, the
+    identifiers stored in the file must also be those of the residues
+    of the reference structure, in the same order (as needed to write
+    per-node values to it). The identifiers of the residues of the
+    reference structure may be given as ref_identifiers instead, so
+    that it is read only once for several graphs."""
+
+    try:
+        A, file_ids = gio.load_csr_graph(fname, cache = cache)
     except:
         errstr = "Could not load file {:s} or wrong file format."
         raise ValueError(errstr.format(fname))
+    # explicit zeros are not edges
+    A.eliminate_zeros()
+    # if the graph file stores the identifiers of its nodes, the
+    # reference structure is only needed to check them
+    if ref_identifiers is None and pdb is not None and \
+            (file_ids is None or check_pdb):
+        ref_identifiers = get_reference_identifiers(pdb)
+    if file_ids is not None:
+        identifiers = file_ids
+        if check_pdb and ref_identifiers is not None and \
+                ref_identifiers != identifiers:
+            errstr = \
+                "The residues of the reference structure are not " \
+                "the nodes stored in {:s}, in the same order."
+            raise ValueError(errstr.format(fname))
     # if the user provided a reference structure
-    if pdb is not None:
-        try:
-            # generate a Universe object from the PDB file
-            u = mda.Universe(pdb)
-        except Exception:
+    elif ref_identifiers is not None:
+        # identifiers for the nodes of the graph
+        identifiers = ref_identifiers
+        if len(identifiers) != A.shape[0]:
             errstr = \
-                "Exception caught during creation of the Universe."
-            raise ValueError(errstr)      
-        # generate identifiers for the nodes of the graph
-        idfmt = "{:s}-{:d}{:s}"
-        identifiers = \
-            [idfmt.format(r.segment.segid, r.resnum, r.resname) \
-             for r in u.residues]
+                "The graph has {:d} nodes but the reference " \
+                "structure has {:d} residues."
+            raise ValueError(errstr.format(A.shape[0], len(identifiers)))
     # if the user did not provide a reference structure
     else:
         # generate automatic identifiers going from 1 to the
         # total number of residues considered
-        identifiers = [str(i) for i in range(1, data.shape[0]+1)]
-    
-    # generate a graph from the data loaded
-    G = nx.Graph(data)
-    # set the names of the graph nodes (in place)
-    node_names = dict(zip(range(data.shape[0]), identifiers))
-    nx.relabel_nodes(G, mapping = node_names, copy = False)
+        identifiers = [str(i) for i in range(1, A.shape[0]+1)]
+    return identifiers, A
+
+
+def csr_to_graph(A, identifiers):
+    """Build a networkx Graph from the weight matrix of a graph, with
+    nodes named after the identifiers."""
+
+    import networkx as nx
+
+    A = A.tocsr()
+    ids = np.array(identifiers, dtype = object)
+    rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+    G = nx.Graph()
+    G.add_nodes_from(identifiers)
+    # add the edges in row-major order, as networkx does for
+    # dense matrices
+    G.add_weighted_edges_from(zip(ids[rows].tolist(), \
+                                  ids[A.indices].tolist(), \
+                                  A.data.tolist()))
+    return G
+
+
+def build_graph(fname, pdb = None, cache = False):
+    """Build a networkx Graph from the provided matrix (see
+    load_graph_matrix)."""
+
+    identifiers, A = load_graph_matrix(fname, pdb = pdb, cache = cache)
     # return the idenfiers and the graph
-    return identifiers, G
+    return identifiers, csr_to_graph(A, identifiers)
+
+
+def get_graph_matrix(G, nodes = None):
+    """Get the weight matrix of a graph, given either as a networkx
+    Graph or already as a scipy.sparse matrix, as a new CSR matrix.
+    Rows and columns follow the order of nodes (by default, the order
+    of the nodes of the Graph, or identifiers numbered from 1 for a
+    matrix). Return the matrix and the nodes."""
+
+    import scipy.sparse as sp
+
+    if gio.is_scipy_sparse(G):
+        if nodes is None:
+            nodes = [str(i) for i in range(1, G.shape[0]+1)]
+        return sp.csr_matrix(G, dtype = float, copy = True), list(nodes)
+    import networkx as nx
+    nodes = list(G.nodes()) if nodes is None else list(nodes)
+    A = nx.to_scipy_sparse_array(G, nodelist = nodes, format = "csr")
+    return sp.csr_matrix(A, dtype = float), nodes
+
+
+def get_adjacency_matrix(A):
+    """Get the binary adjacency matrix of the undirected graph having
+    weight matrix A."""
+
+    adj = (abs(A) + abs(A.T)).tocsr()
+    adj.eliminate_zeros()
+    adj.data[:] = 1.0
+    return adj
+
+
+def get_num_edges(A):
+    """Get the number of edges of the undirected graph having weight
+    matrix A."""
+
+    import scipy.sparse as sp
 
+    return sp.triu(get_adjacency_matrix(A)).nnz
 
-def get_connected_components(G):
-    """Get the connected components of the graph."""
-    print(list(nx.connected_components(G)))
-    return list(nx.connected_components(G))
+
+def get_connected_components(G, identifiers = None):
+    """Get the connected components of the graph (see
+    get_graph_matrix for G and identifiers)."""
+
+    from scipy.sparse.csgraph import connected_components
+
+    A, nodes = get_graph_matrix(G, identifiers)
+    # components are numbered in order of their first node
+    ncc, labels = connected_components(A, directed = False)
+    ccs = [set() for i in range(ncc)]
+    for node, label in zip(nodes, labels):
+        ccs[label].add(node)
+    return ccs
 
 
 def write_connected_components(ccs, outfile = None):
@@ -132,8 +313,12 @@ def write_connected_components(ccs, outfile = None):
                 len(cc), \
                 ", ".join(sorted(cc, key = get_resnum))))
     else:
-        ### TODO: output to a file, not standard output
-        raise NotImplementedError
+        write_table(header = ["Component", "Size", "Residues"],
+                    rows = [[numcc + 1, len(cc), \
+                             sorted(cc, key = get_resnum)] \
+                            for numcc, cc in enumerate(ccs)],
+                    fmts = ["{:d}", "{:d}", "{:s}"],
+                    outfile = outfile)
 
 
 def write_connected_components_pdb(identifiers,
@@ -147,9 +332,10 @@ def write_connected_components_pdb(identifiers,
     
     # create an empty array for the custom B factors
     conn_comp_array = np.zeros(len(identifiers))
+    index = {node : i for i, node in enumerate(identifiers)}
     for i, cc in enumerate(ccs):
         for res in cc:
-            conn_comp_array[identifiers.index(res)] = i+1
+            conn_comp_array[index[res]] = i+1
     # write a PDB file identical to the reference PDB file
     # but with the b-factor column filled with the number of
     # the connected component a residue belongs to
@@ -158,11 +344,17 @@ def write_connected_components_pdb(identifiers,
                       pdb_out = components_pdb)
 
 
-def get_hubs(G, min_k = 3, sorting = None):
-    """Get hubs in the graph."""
+def get_hubs(G, min_k = 3, sorting = None, identifiers = None):
+    """Get hubs in the graph (see get_graph_matrix for G and
+    identifiers)."""
 
+    A, nodes = get_graph_matrix(G, identifiers)
+    adj = get_adjacency_matrix(A)
+    # self-loops count twice in the degree of a node
+    degrees = np.diff(adj.indptr) + (adj.diagonal() != 0)
     # get the hubs
-    hubs = {node : k for node, k in G.degree() if k >= min_k}
+    hubs = {node : k for node, k in zip(nodes, degrees.tolist()) \
+            if k >= min_k}
     # if no hubs were found
     if len(list(hubs.keys())) == 0:
         # warn the user that no hubs have been found
@@ -184,7 +376,6 @@ def get_hubs(G, min_k = 3, sorting = None):
                              key = lambda item: item[1],
                              reverse = True)
     # return the sorted list of hubs
-    print(sorted_hubs)
     return sorted_hubs
 
 
@@ -198,8 +389,10 @@ def write_hubs(hubs, outfile = None):
         for hub, k in hubs:
             sys.stdout.write("\t{:s}\t{:d}\n".format(hub, k))
     else:
-        ### TODO: output to a file, not print
-        raise NotImplementedError
+        write_table(header = ["Node", "k"],
+                    rows = [[hub, k] for hub, k in hubs],
+                    fmts = ["{:s}", "{:d}"],
+                    outfile = outfile)
 
 
 def write_hubs_pdb(identifiers,
@@ -226,10 +419,21 @@ def write_hubs_pdb(identifiers,
                       pdb_out = hubs_pdb) 
 
 
+def get_path_stats(G, path):
+    """Get a path together with its length (number of nodes), the
+    sum and the average of the weights of its edges."""
+
+    weights = [G[path[i]][path[i+1]]["weight"] \
+               for i in range(len(path)-1)]
+    return (path, len(path), np.sum(weights), np.average(weights))
+
+
 def get_paths(G, source, target, maxl, sort_paths_by):
     """Get all the shortest paths between a source and a target
     node in the graph."""
     
+    import networkx as nx
+
     # both nodes must be in the graph
     if not source in G.nodes() or not target in G.nodes():
         errstr = "Source or target residues have been badly specified."
@@ -255,24 +459,15 @@ def get_paths(G, source, target, maxl, sort_paths_by):
         # length were found
         return
 
-    # calculate all the paths
-    paths = list(nx.algorithms.simple_paths.all_simple_paths(\
-                    G = G,
-                    source = source,
-                    target = target,
-                    cutoff = maxl))
-    # get the length of each path
-    lengths = [len(p) for p in paths]         
-    # calculate the sum of the each path's weights
-    sum_weights = \
-        [np.sum([G[p[i]][p[i+1]]["weight"] for i in range(len(p)-1)]) \
-         for p in paths]           
-    # calculate the average of each path's weights
-    avg_weights = \
-        [np.average([G[p[i]][p[i+1]]["weight"] for i in range(len(p)-1)]) \
-         for p in paths]
-    # sort the paths
-    full_paths = zip(paths, lengths, sum_weights, avg_weights)
+    # calculate all the paths, each with its length and the sum
+    # and average of its weights
+    full_paths = \
+        [get_path_stats(G, p) \
+         for p in nx.algorithms.simple_paths.all_simple_paths(\
+            G = G,
+            source = source,
+            target = target,
+            cutoff = maxl)]
     # sort by length (ascending, shortest paths first)
     if sort_paths_by == "length":
         key = lambda x: x[1]
@@ -291,8 +486,567 @@ def get_paths(G, source, target, maxl, sort_paths_by):
     return sorted(full_paths, key = key, reverse = reverse)
 
 
-def write_paths(paths, outfile = None):
-    """Write the paths."""
+# default maximum number of paths longer than the cut-off skipped
+# while searching for the best paths by persistence
+KBEST_MAX_SKIPPED = 10000
+
+
+def collect_generator(generator):
+    """Get the list of the items yielded by a generator, together
+    with the value it returns."""
+
+    items = []
+    while True:
+        try:
+            items.append(next(generator))
+        except StopIteration as stop:
+            return items, stop.value
+
+
+def get_kbest_paths(G, source, target, k, maxl, weight_by = "length", \
+                    max_skipped = KBEST_MAX_SKIPPED):
+    """Yield the k best simple paths between a source and a target
+    node in the graph, in order, each with its statistics as in
+    get_paths. The best paths are either the shortest ones
+    (weight_by = "length") or those with the highest product of
+    persistences (weight_by = "persistence", i.e. the shortest ones
+    when each edge weighs -log(persistence/100)), found lazily with
+    Yen's algorithm. Paths longer than maxl edges are skipped. If
+    max_skipped of them are (a non-positive value or None set no
+    limit), the search stops and the generator returns True (fewer
+    than k paths may have been found), False otherwise."""
+
+    import networkx as nx
+
+    # both nodes must be in the graph
+    if not source in G.nodes() or not target in G.nodes():
+        errstr = "Source or target residues have been badly specified."
+        log.error(errstr)
+        raise ValueError(errstr)
+    if weight_by == "length":
+        H, weight = G, None
+    elif weight_by == "persistence":
+        weights = [w for u, v, w in G.edges(data = "weight")]
+        if any(w <= 0.0 or w > 100.0 for w in weights):
+            errstr = "Persistence weights must be in the (0, 100] range."
+            log.error(errstr)
+            raise ValueError(errstr)
+        # the edge costs are stored in a separate graph, so that
+        # the input graph is not modified
+        H, weight = nx.Graph(), "cost"
+        H.add_nodes_from(G)
+        H.add_weighted_edges_from(\
+            [(u, v, -np.log(w / 100.0)) \
+             for u, v, w in G.edges(data = "weight")], \
+            weight = weight)
+    else:
+        raise ValueError(f"Unknown path weight: {weight_by}.")
+    if k <= 0:
+        return False
+    # only the nodes on some path of at most maxl edges can be part
+    # of the paths found
+    from_source = nx.single_source_shortest_path_length(\
+                    G, source, cutoff = maxl)
+    from_target = nx.single_source_shortest_path_length(\
+                    G, target, cutoff = maxl)
+    nodes = [node for node in from_source \
+             if node in from_target and \
+                from_source[node] + from_target[node] <= maxl]
+    if not target in nodes:
+        log.warning(\
+            "No paths were found between the given nodes at the " \
+            "given cut-off.")
+        return False
+    H = H.subgraph(nodes)
+    found = skipped = 0
+    try:
+        for path in nx.shortest_simple_paths(G = H, \
+                                             source = source, \
+                                             target = target, \
+                                             weight = weight):
+            if len(path) - 1 > maxl:
+                # all the following paths are at least as long
+                if weight_by == "length":
+                    return False
+                skipped += 1
+                if skipped == max_skipped:
+                    logstr = \
+                        "Stopped the search after skipping {:d} " \
+                        "paths longer than {:d} edges: {:d} paths " \
+                        "were found."
+                    log.warning(logstr.format(skipped, maxl, found))
+                    return True
+                continue
+            yield get_path_stats(G, path)
+            found += 1
+            if found == k:
+                return False
+    except nx.NetworkXNoPath:
+        log.warning("No paths exist between selected residues.")
+    return False
+
+
+def get_path_sortkey(path, sort_paths_by):
+    """Get the key sorting paths in ascending order as get_paths
+    does."""
+
+    if sort_paths_by == "length":
+        return path[1]
+    elif sort_paths_by == "cumulative_weight":
+        return -path[2]
+    elif sort_paths_by == "avg_weight":
+        return -path[3]
+    raise ValueError(f"Unknown path sorting: {sort_paths_by}.")
+
+
+def format_path_line(path):
+    """Format a path as a line of the file of all the paths."""
+
+    return "{:d}\t{:.1f}\t{:.1f}\t{:s}\n".format(\
+                path[1], path[2], path[3], ",".join(path[0]))
+
+
+def _enumerate_paths_from(task, G, source, target, maxl, sort_paths_by, \
+                          top, where):
+    """Enumerate all the simple paths starting with the given first
+    hop from the source, writing them to a temporary file as they
+    are found. Return the name of the file, the number of paths and
+    the best paths found, each with its sort key."""
+
+    import networkx as nx
+
+    index, first = task
+    if first == target:
+        # any longer path would pass through the target again
+        subpaths = iter([[target]])
+    else:
+        # the other paths cannot pass through the source again
+        H = G.subgraph([node for node in G if node != source])
+        subpaths = nx.algorithms.simple_paths.all_simple_paths(\
+                        G = H,
+                        source = first,
+                        target = target,
+                        cutoff = maxl - 1)
+    # heap of the best paths, worst first
+    best = []
+    numpaths = 0
+    fd, tmp_fname = tempfile.mkstemp(dir = where, suffix = ".paths")
+    with os.fdopen(fd, "w") as out:
+        for subpath in subpaths:
+            path = get_path_stats(G, [source] + subpath)
+            out.write(format_path_line(path))
+            # ties are broken by the order of all_simple_paths
+            key = (get_path_sortkey(path, sort_paths_by), index, numpaths)
+            item = (tuple(-k for k in key), path)
+            if len(best) < top:
+                heapq.heappush(best, item)
+            elif best and item > best[0]:
+                heapq.heapreplace(best, item)
+            numpaths += 1
+    return tmp_fname, numpaths, best
+
+
+def enumerate_paths(G,
+                    source,
+                    target,
+                    maxl,
+                    sort_paths_by,
+                    out_paths,
+                    top = 100,
+                    nprocs = None):
+    """Enumerate all the simple paths between a source and a target
+    node in the graph (the same as get_paths), writing them to the
+    out_paths file in the same order as all_simple_paths. The search
+    is split by first hop from the source over forked worker
+    processes (at most nprocs, by default one per neighbor up to the
+    number of CPUs), and the paths through each first hop are
+    written once they have all been found (they are kept in a
+    temporary directory meanwhile). Only the top best paths are kept
+    in memory. Return the number of paths found and the top paths,
+    sorted as in get_paths."""
+
+    # both nodes must be in the graph
+    if not source in G.nodes() or not target in G.nodes():
+        errstr = "Source or target residues have been badly specified."
+        log.error(errstr)
+        raise ValueError(errstr)
+    tasks = list(enumerate(G.neighbors(source))) if maxl > 0 else []
+    numpaths = 0
+    best = []
+    # the temporary files left by failed or interrupted searches are
+    # removed together with the directory (after the workers exit)
+    with tempfile.TemporaryDirectory(\
+            dir = os.path.dirname(os.path.abspath(out_paths))) as where, \
+         open(out_paths, "w") as out, \
+         li.forked_map(_enumerate_paths_from, \
+                       (G, source, target, maxl, sort_paths_by, top, \
+                        where), \
+                       li.get_nprocs(nprocs, len(tasks))) as fmap:
+        out.write("Length\tSum of weights\tAverage weight\tPath\n")
+        # the paths of each first hop are appended as soon as they
+        # are all found
+        for tmp_fname, task_numpaths, task_best in fmap(tasks):
+            with open(tmp_fname) as tmp:
+                shutil.copyfileobj(tmp, out)
+            os.remove(tmp_fname)
+            numpaths += task_numpaths
+            best = heapq.nlargest(top, best + task_best)
+    if numpaths == 0:
+        log.warning("No paths exist between selected residues.")
+    return numpaths, [path for key, path in sorted(best, reverse = True)]
+
+
+def get_selection_nodes(selection, identifiers, ref = None):
+    """Get the graph nodes corresponding to a selection, given
+    either as comma-separated node identifiers or as an MDAnalysis
+    selection string applied to the reference structure."""
+
+    names = [name.strip() for name in selection.split(",")]
+    if all(name in identifiers for name in names):
+        return names
+    if ref is None:
+        errstr = f"Residues {selection} are not in the graph."
+        raise ValueError(errstr)
+    import MDAnalysis as mda
+    try:
+        residues = mda.Universe(ref).select_atoms(selection).residues
+    except Exception:
+        errstr = f"Invalid selection: {selection}."
+        raise ValueError(errstr)
+    # only the residues which are nodes of the graph
+    nodes = set(identifiers)
+    return [node for node in gio.get_residue_identifiers(residues) \
+            if node in nodes]
+
+
+def get_csgraph(G, nodes, weight_by = "length"):
+    """Get the matrix of the costs of the edges of the graph, with
+    rows and columns in the order of nodes, as a scipy.sparse CSR
+    matrix (see get_graph_matrix for G; the cost of each edge is
+    either 1 or, if weight_by is "persistence",
+    -log(persistence/100))."""
+
+    A, nodes = get_graph_matrix(G, nodes)
+    weights = A.data
+    if weight_by == "length":
+        costs = np.ones(len(weights))
+    elif weight_by == "persistence":
+        if np.any((weights <= 0.0) | (weights > 100.0)):
+            errstr = "Persistence weights must be in the (0, 100] range."
+            raise ValueError(errstr)
+        # explicit zeros would be taken as missing edges
+        costs = np.maximum(-np.log(weights / 100.0), \
+                           np.finfo(float).tiny)
+    else:
+        raise ValueError(f"Unknown path weight: {weight_by}.")
+    A.data = costs
+    return A
+
+
+def _shortest_paths_from(source, A, csgraph, nodes, targets, unweighted):
+    """Find the shortest paths from a source to all the targets,
+    from a single shortest-path tree."""
+
+    from scipy.sparse.csgraph import dijkstra
+
+    index = {node : i for i, node in enumerate(nodes)}
+    dists, predecessors = dijkstra(csgraph, \
+                                   indices = index[source], \
+                                   unweighted = unweighted, \
+                                   return_predecessors = True)
+    results = []
+    for target in targets:
+        if target == source:
+            continue
+        i = index[target]
+        if np.isinf(dists[i]):
+            results.append((source, target, None))
+            continue
+        # walk the tree back from the target to the source
+        path = [i]
+        while path[-1] != index[source]:
+            path.append(predecessors[path[-1]])
+        path = path[::-1]
+        # the same statistics as get_path_stats, from the matrix
+        weights = np.asarray(A[path[:-1], path[1:]]).ravel()
+        results.append((source, target, \
+                        ([nodes[j] for j in path], len(path), \
+                         np.sum(weights), np.average(weights))))
+    return results
+
+
+def get_pairs_paths(G, sources, targets, weight_by = "length", \
+                    nprocs = None, identifiers = None):
+    """Find a shortest path (by number of edges or by persistence,
+    as in get_kbest_paths) between each source and each target node
+    in the graph (see get_graph_matrix for G and identifiers), using
+    one shortest-path tree for each source. Sources are processed by
+    forked worker processes (at most nprocs, by default one per
+    source up to the number of CPUs). Return a list of (source,
+    target, path statistics as in get_paths, or None if there are no
+    paths)."""
+
+    A, nodes = get_graph_matrix(G, identifiers)
+    # all nodes must be in the graph
+    node_set = set(nodes)
+    for node in list(sources) + list(targets):
+        if not node in node_set:
+            errstr = f"Residue {node} is not in the graph."
+            log.error(errstr)
+            raise ValueError(errstr)
+    csgraph = get_csgraph(G = A, nodes = nodes, weight_by = weight_by)
+    results = li.run_forked(_shortest_paths_from, \
+                            (A, csgraph, nodes, targets, \
+                             weight_by == "length"), \
+                            sources, \
+                            nprocs)
+    return [pair for source_results in results for pair in source_results]
+
+
+def write_pairs_paths(pairs, outfile):
+    """Write the shortest path between each pair of residues to a
+    table (see write_table)."""
+
+    rows = []
+    for source, target, path in pairs:
+        # pairs without paths have no nodes and undefined weights
+        if path is None:
+            path = ([], 0, float("nan"), float("nan"))
+        rows.append([source, target, path[1], path[2], path[3], \
+                     list(path[0])])
+    write_table(header = ["Source", "Target", "Length", \
+                          "Sum of weights", "Average weight", "Path"],
+                rows = rows,
+                fmts = ["{:s}", "{:s}", "{:d}", "{:.1f}", "{:.1f}", \
+                        "{:s}"],
+                outfile = outfile)
+
+
+# maximum number of (edge, source) values computed at a time
+BETWEENNESS_BLOCKSIZE = 2**22
+
+
+def _betweenness_from(sources, A):
+    """Accumulate the dependencies of the nodes and edges of the
+    graph on the shortest paths (by number of edges) from the given
+    sources, with Brandes' algorithm. The breadth-first searches from
+    all the sources run together as products of the sparse adjacency
+    matrix with one column per source. Return the sums over the
+    sources of the node dependencies, of their squares and of the
+    edge dependencies (for each stored element of the matrix)."""
+
+    nnodes = A.shape[0]
+    rows = np.repeat(np.arange(nnodes), np.diff(A.indptr))
+    cols = A.indices
+    nsources = len(sources)
+    columns = np.arange(nsources)
+    # number of shortest paths from each source and distance from it
+    sigma = np.zeros((nnodes, nsources))
+    sigma[sources, columns] = 1.0
+    dist = np.full((nnodes, nsources), -1)
+    dist[sources, columns] = 0
+    # breadth-first search, one level at a time
+    levels = [sigma > 0.0]
+    frontier = sigma.copy()
+    while True:
+        paths = A @ frontier
+        found = (paths > 0.0) & (dist < 0)
+        if not found.any():
+            break
+        dist[found] = len(levels)
+        frontier = np.where(found, paths, 0.0)
+        sigma += frontier
+        levels.append(found)
+    # dependencies, from the farthest level back to the sources
+    delta = np.zeros((nnodes, nsources))
+    for level in range(len(levels)-1, 0, -1):
+        coef = np.where(levels[level], (1.0 + delta) / \
+                        np.where(levels[level], sigma, 1.0), 0.0)
+        delta += np.where(levels[level-1], sigma * (A @ coef), 0.0)
+    coef = (1.0 + delta) / np.where(sigma > 0.0, sigma, 1.0)
+    # edges from a node to the next level of the search
+    edges = np.zeros(len(cols))
+    step = max(1, BETWEENNESS_BLOCKSIZE // max(1, nsources))
+    for start in range(0, len(cols), step):
+        r, c = rows[start:start+step], cols[start:start+step]
+        forward = dist[c] == dist[r] + 1
+        edges[start:start+step] = \
+            np.sum(np.where(forward, sigma[r] * coef[c], 0.0), axis = 1)
+    # the sources do not depend on themselves
+    delta[sources, columns] = 0.0
+    return delta.sum(axis = 1), (delta**2).sum(axis = 1), edges
+
+
+def get_betweenness(A,
+                    normalized = True,
+                    samples = None,
+                    tolerance = None,
+                    seed = None,
+                    batchsize = 64,
+                    nprocs = None):
+    """Compute the betweenness centrality of the nodes and the edges
+    of an unweighted graph, given as a symmetric scipy.sparse CSR
+    matrix, scaled as networkx does. The exact values use all the
+    nodes as sources. They are approximated from a random sample of
+    sources if the number of samples is given or, if a tolerance is
+    given, by adding random sources in batches until the estimated
+    standard error of the betweenness of each node is within the
+    tolerance. Batches of sources are split over forked worker
+    processes (at most nprocs, by default one per CPU). Return the
+    node betweenness, the edge betweenness (as a CSR matrix with
+    the same structure as A) and the number of sources used."""
+
+    A = A.tocsr()
+    nnodes = A.shape[0]
+    rng = np.random.RandomState(seed)
+    if samples is not None:
+        order = rng.choice(nnodes, min(samples, nnodes), replace = False)
+    elif tolerance is not None:
+        order = rng.permutation(nnodes)
+    else:
+        order = np.arange(nnodes)
+    nprocs = li.get_nprocs(nprocs)
+    # scale of the sums over the sources
+    if normalized:
+        node_scale = 1.0 / ((nnodes-1) * (nnodes-2)) if nnodes > 2 else 1.0
+        edge_scale = 1.0 / (nnodes * (nnodes-1)) if nnodes > 1 else 1.0
+    else:
+        node_scale = edge_scale = 0.5
+    node_sum = np.zeros(nnodes)
+    node_sqsum = np.zeros(nnodes)
+    edge_sum = np.zeros(A.nnz)
+    with li.forked_map(_betweenness_from, (A,), nprocs) as fmap:
+        # with a tolerance, one batch per worker process at a time
+        # (all the sources at once otherwise)
+        step = batchsize * nprocs if tolerance is not None \
+               else len(order)
+        nsources = 0
+        for start in range(0, len(order), max(1, step)):
+            sources = order[start:start+step]
+            chunks = [sources[i:i+batchsize] \
+                      for i in range(0, len(sources), batchsize)]
+            for chunk_sum, chunk_sqsum, chunk_edges in fmap(chunks):
+                node_sum += chunk_sum
+                node_sqsum += chunk_sqsum
+                edge_sum += chunk_edges
+            nsources += len(sources)
+            if tolerance is None or nsources == nnodes:
+                continue
+            # standard error of the estimated betweenness, from the
+            # sample variance of the node dependencies (sampling
+            # without replacement)
+            mean = node_sum / nsources
+            var = np.maximum(node_sqsum / nsources - mean**2, 0.0) * \
+                  nsources / max(1, nsources-1)
+            stderr = nnodes * node_scale * \
+                     np.sqrt(var / nsources * (1.0 - nsources / nnodes))
+            if np.max(stderr) <= tolerance:
+                break
+    # sums over a sample of sources are scaled to all the sources
+    sample_scale = nnodes / nsources if nsources else 0.0
+    nodes_bc = node_sum * node_scale * sample_scale
+    edges_bc = A.copy().astype(float)
+    # each edge is stored in both directions
+    edges_bc.data = edge_sum
+    edges_bc = (edges_bc + edges_bc.T) * edge_scale * sample_scale
+    return nodes_bc, edges_bc.tocsr(), nsources
+
+
+def get_closeness(A, batchsize = 256):
+    """Compute the closeness centrality of the nodes of an
+    unweighted graph, given as a scipy.sparse CSR matrix, as
+    networkx does (scaled by the fraction of reachable nodes)."""
+
+    from scipy.sparse.csgraph import shortest_path
+
+    nnodes = A.shape[0]
+    closeness = np.zeros(nnodes)
+    for start in range(0, nnodes, batchsize):
+        indices = np.arange(start, min(start+batchsize, nnodes))
+        dists = shortest_path(A, unweighted = True, indices = indices)
+        reachable = np.isfinite(dists)
+        nreach = reachable.sum(axis = 1) - 1
+        total = np.where(reachable, dists, 0.0).sum(axis = 1)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            values = nreach / total * nreach / max(1, nnodes-1)
+        closeness[indices] = np.where(total > 0.0, values, 0.0)
+    return closeness
+
+
+def get_current_flow(A, normalized = True):
+    """Compute the current-flow betweenness centrality of the nodes
+    of a graph, given as a scipy.sparse CSR matrix of conductances,
+    as networkx does, within each connected component (networkx
+    requires connected graphs)."""
+
+    from scipy.sparse.csgraph import connected_components, laplacian
+
+    nnodes = A.shape[0]
+    betweenness = np.zeros(nnodes)
+    ncomps, labels = connected_components(A, directed = False)
+    for comp in range(ncomps):
+        nodes = np.flatnonzero(labels == comp)
+        ncomp = len(nodes)
+        if ncomp < 3:
+            continue
+        B = A[nodes][:,nodes].tocoo()
+        # potentials for unit currents, with the first node grounded
+        L = laplacian(B).toarray()
+        C = np.zeros((ncomp, ncomp))
+        C[1:,1:] = np.linalg.inv(L[1:,1:])
+        values = np.zeros(ncomp)
+        positions = np.arange(ncomp)
+        upper = B.row < B.col
+        for s, t, w in zip(B.row[upper], B.col[upper], B.data[upper]):
+            # current on the edge for each node as source (the
+            # sums over the pairs only need the ranks of the values)
+            row = w * (C[s] - C[t])
+            pos = np.empty(ncomp, dtype = int)
+            pos[np.argsort(row, kind = "stable")[::-1]] = positions
+            values[s] += np.sum((positions - pos) * row)
+            values[t] += np.sum((ncomp - positions - 1 - pos) * row)
+        scale = (ncomp-1.0) * (ncomp-2.0) if normalized else 2.0
+        betweenness[nodes] = (values - positions) * 2.0 / scale
+    return betweenness
+
+
+def write_centrality(identifiers, centrality, outfile = None):
+    """Write the centrality measures of the nodes to a table (see
+    write_table)."""
+
+    write_table(header = ["Node"] + list(centrality),
+                rows = [[node] + [values[i] \
+                                  for values in centrality.values()] \
+                        for i, node in enumerate(identifiers)],
+                fmts = ["{:s}"] + ["{:.6g}"] * len(centrality),
+                outfile = outfile)
+
+
+def get_upper_items(matrix):
+    """Get the (row, column, value) of the stored elements in the
+    upper triangle of a scipy.sparse matrix, in row-major order."""
+
+    matrix = matrix.tocoo()
+    upper = matrix.row < matrix.col
+    order = np.lexsort((matrix.col[upper], matrix.row[upper]))
+    return zip(matrix.row[upper][order].tolist(), \
+               matrix.col[upper][order].tolist(), \
+               matrix.data[upper][order].tolist())
+
+
+def write_edge_betweenness(identifiers, edges_bc, outfile):
+    """Write the betweenness centrality of the edges to a table (see
+    write_table)."""
+
+    write_table(header = ["Node 1", "Node 2", "Betweenness"],
+                rows = [[identifiers[i], identifiers[j], value] \
+                        for i, j, value in get_upper_items(edges_bc)],
+                fmts = ["{:s}", "{:s}", "{:.6g}"],
+                outfile = outfile)
+
+
+def write_paths(paths, outfile = None, note = None):
+    """Write the paths (see write_table for note)."""
 
     # write the paths found to the output in a human-readable format
     if not outfile:
@@ -304,28 +1058,181 @@ def write_paths(paths, outfile = None):
                 pathfmt_str.format(\
                     index+1, path[1], path[2], path[3], \
                     ",".join(path[0])))
+        if note:
+            sys.stdout.write(f"# {note}\n")
     else:
-        ### TODO: output to a file, not print
-        raise NotImplementedError
+        write_table(header = ["Path #", "Length", "Sum of weights", \
+                              "Average weight", "Path"],
+                    rows = [[index+1, path[1], path[2], path[3], \
+                             list(path[0])] \
+                            for index, path in enumerate(paths)],
+                    fmts = ["{:d}", "{:d}", "{:.1f}", "{:.1f}", "{:s}"],
+                    outfile = outfile,
+                    note = note)
+
+
+def get_paths_edges(identifiers, G, paths):
+    """Get the edges of the paths, in order, as arrays of the index
+    of the path each edge belongs to, of its two nodes (as indexes
+    of identifiers) and of its weight."""
+
+    index = {node : i for i, node in enumerate(identifiers)}
+    edges = [(num, index[u], index[v], G[u][v]["weight"]) \
+             for num, path in enumerate(paths) \
+             for u, v in zip(path[0][:-1], path[0][1:])]
+    edges = np.array(edges, dtype = float).reshape(-1, 4)
+    return tuple(edges[:,i].astype(int) for i in range(3)) + \
+           (edges[:,3],)
+
+
+def write_paths_dat(path_ids, rows, cols, weights, size, fmt, where):
+    """Write a matrix file (path1.dat, path2.dat, ...) for each path
+    given by the arrays of its edges (see get_paths_edges), with all
+    edges erased apart from those constituting the path."""
+
+    numpaths = path_ids[-1] + 1 if len(path_ids) else 0
+    # where the edges of each path start
+    bounds = np.searchsorted(path_ids, np.arange(numpaths+1))
+    for num in range(numpaths):
+        edges = slice(bounds[num], bounds[num+1])
+        path_mat = np.zeros((size, size))
+        path_mat[rows[edges], cols[edges]] = weights[edges]
+        path_mat[cols[edges], rows[edges]] = weights[edges]
+        # save the matrix
+        mat_file = os.path.join(where, "path{:d}.dat".format(num+1))
+        np.savetxt(mat_file, path_mat, fmt = fmt)
 
 
 def write_paths_matrices(identifiers, G, paths, fmt, where):
     """For each path, write a matrix with all edges erased apart
     from those constituting the path."""
     
-    for index, path in enumerate(paths):
-        # for each path...
-        path_mat = np.zeros(nx.adjacency_matrix(G).shape)
-        for node in range(len(path[0])-1):
-            # for each node in the path...
-            x = identifiers.index(path[0][node])
-            y = identifiers.index(path[0][node+1])
-            path_mat[x,y] = G[path[0][node]][path[0][node+1]]["weight"]
-            path_mat[y,x] = G[path[0][node+1]][path[0][node]]["weight"]
-        # save the matrix
-        mat_file = os.path.join(where, "path{:d}.dat".format(index+1))
-        np.savetxt(mat_file, path_mat, fmt = fmt)
-    
+    write_paths_dat(*get_paths_edges(identifiers, G, paths), \
+                    size = len(identifiers), \
+                    fmt = fmt, \
+                    where = where)
+
+
+def write_paths_edges(identifiers, G, paths, fname, metadata = None):
+    """Write the matrices of all the paths to a single file, as the
+    lists of the edges of the paths (see graph_io.save_paths)."""
+
+    path_ids, rows, cols, weights = get_paths_edges(identifiers, G, paths)
+    gio.save_paths(fname = fname,
+                   path_ids = path_ids,
+                   rows = rows,
+                   cols = cols,
+                   weights = weights,
+                   identifiers = identifiers,
+                   metadata = metadata)
+
+
+def export_paths_matrices(fname, fmt, where):
+    """Convert a file written by write_paths_edges to one matrix file
+    per path, as written by write_paths_matrices."""
+
+    edges, identifiers, _ = gio.load_paths(fname)
+    write_paths_dat(*edges, \
+                    size = len(identifiers), \
+                    fmt = fmt, \
+                    where = where)
+
+
+def analyse_graph(fname, pdb = None, cache = False, min_k = 3, \
+                  ref_identifiers = None):
+    """Summarize the connected components and the hubs of a graph
+    for batch runs (see load_graph_matrix for pdb, cache and
+    ref_identifiers). Return
+    the node identifiers, the number of edges, the sizes of the
+    connected components (largest first) and the degrees of the hubs
+    by node."""
+
+    identifiers, A = load_graph_matrix(fname, \
+                                       pdb = pdb, \
+                                       cache = cache, \
+                                       ref_identifiers = ref_identifiers)
+    ccs = get_connected_components(G = A, identifiers = identifiers)
+    hubs = get_hubs(G = A, min_k = min_k, identifiers = identifiers)
+    return identifiers, get_num_edges(A), \
+           sorted([len(cc) for cc in ccs], reverse = True), \
+           dict(hubs or {})
+
+
+def _analyse_batch_graph(fname, pdb, cache, min_k, ref_identifiers):
+    """Run analyse_graph on one graph of the batch run, returning
+    None if the graph could not be analysed."""
+
+    try:
+        return analyse_graph(fname = fname, \
+                             pdb = pdb, \
+                             cache = cache, \
+                             min_k = min_k, \
+                             ref_identifiers = ref_identifiers)
+    except (IOError, ValueError):
+        log.error(f"Could not analyse {fname}.", exc_info = True)
+        return None
+
+
+def run_graphs_batch(fnames, pdb = None, cache = False, min_k = 3, \
+                     nprocs = None):
+    """Analyse each graph separately (see analyse_graph). Graphs are
+    processed concurrently by forked worker processes (at most
+    nprocs, by default one per graph up to the number of CPUs).
+    The reference structure, if any, is read only once. Return the
+    list of results, with None for the graphs which could not be
+    analysed. Raise ValueError if the reference structure cannot be
+    read."""
+
+    ref_identifiers = get_reference_identifiers(pdb) \
+                      if pdb is not None else None
+    return li.run_forked(_analyse_batch_graph, \
+                         (pdb, cache, min_k, ref_identifiers), \
+                         fnames, \
+                         nprocs)
+
+
+def write_components_batch(fnames, results, outfile = None):
+    """Write the number and the sizes of the connected components of
+    each graph of a batch run to a table (see write_table). Graphs
+    which could not be analysed are left out."""
+
+    rows = []
+    for fname, result in zip(fnames, results):
+        if result is None:
+            continue
+        identifiers, numedges, sizes, _ = result
+        rows.append([fname, len(identifiers), numedges, len(sizes), \
+                     sizes[0] if sizes else 0, sizes])
+    write_table(header = ["File", "Nodes", "Edges", "Components", \
+                          "Largest component", "Component sizes"],
+                rows = rows,
+                fmts = ["{:s}", "{:d}", "{:d}", "{:d}", "{:d}", "{:s}"],
+                outfile = outfile)
+
+
+def write_hubs_batch(fnames, results, outfile = None):
+    """Write, for each node which is a hub in at least one graph of a
+    batch run, the fraction of the graphs in which it is a hub and
+    its degree in each graph (0 where it is not a hub), most frequent
+    hubs first, to a table (see write_table). Graphs which could not
+    be analysed are left out."""
+
+    hubs = [(fname, result[3]) for fname, result in zip(fnames, results) \
+            if result is not None]
+    # the hubs in order of first appearance
+    nodes = list(dict.fromkeys(node for _, degrees in hubs \
+                                    for node in degrees))
+    rows = []
+    for node in nodes:
+        ks = [degrees.get(node, 0) for _, degrees in hubs]
+        frequency = sum(k > 0 for k in ks) / len(hubs)
+        rows.append([node, frequency] + ks)
+    rows.sort(key = lambda row: row[1], reverse = True)
+    write_table(header = ["Node", "Frequency"] + \
+                         [fname for fname, _ in hubs],
+                rows = rows,
+                fmts = ["{:s}", "{:.3f}"] + ["{:d}"] * len(hubs),
+                outfile = outfile)
 
 
 def main():
@@ -334,7 +1241,10 @@ def main():
     description = "PyInteraph network analysis module."
     parser = argparse.ArgumentParser(description = description)
 
-    r_helpstr = "Reference topology file"
+    r_helpstr = \
+        "Reference topology file (only needed to name the nodes of " \
+        "graph files not storing their identifiers, for the PDB " \
+        "outputs and for selection strings)"
     parser.add_argument("-r", "--reference",
                         metavar = "TOPOLOGY",
                         dest = "top",
@@ -342,11 +1252,17 @@ def main():
                         default = None,
                         help = r_helpstr)
 
-    a_helpstr = "Input graph file"
+    a_helpstr = \
+        "Input graph file (text matrix or .npz sparse graph). With " \
+        "more than one file, or patterns matching more than one " \
+        "file, each graph is analysed separately (only options -c " \
+        "and -u) and the results are aggregated (see options " \
+        "--components-out and --hubs-out)"
     parser.add_argument("-a", "--adj-matrix",
                         metavar = "DAT",
                         dest = "dat",
                         type = str,
+                        nargs = "+",
                         default = None,
                         help = a_helpstr)
 
@@ -412,6 +1328,211 @@ def main():
                         help = \
                             s_helpstr.format(", ".join(s_choices), s_default))
 
+    kb_helpstr = \
+        "Only find the K best paths (see option -p), in order of " \
+        "length or persistence (see option --k-best-by), without " \
+        "enumerating all the paths first. Option -s is not used"
+    parser.add_argument("--k-best",
+                        metavar = "K",
+                        dest = "kbest",
+                        default = None,
+                        type = int,
+                        help = kb_helpstr)
+
+    kbby_choices = ["length", "persistence"]
+    kbby_default = "length"
+    kbby_helpstr = \
+        "How to rank the K best paths: shortest first, or highest " \
+        "product of the edge persistences first. Possible choices " \
+        "are {:s} (default: {:s})"
+    parser.add_argument("--k-best-by",
+                        dest = "kbest_by",
+                        choices = kbby_choices,
+                        default = kbby_default,
+                        help = kbby_helpstr.format(\
+                            ", ".join(kbby_choices), kbby_default))
+
+    kbms_helpstr = \
+        "When ranking the K best paths by persistence, stop the " \
+        "search after skipping this many paths longer than the " \
+        "cut-off (see option -l), so that fewer than K paths may be " \
+        "found (this is then noted after the paths), or 0 to never " \
+        "stop (default: {:d})"
+    parser.add_argument("--k-best-max-skipped",
+                        metavar = "N",
+                        dest = "kbest_max_skipped",
+                        default = KBEST_MAX_SKIPPED,
+                        type = int,
+                        help = kbms_helpstr.format(KBEST_MAX_SKIPPED))
+
+    po_helpstr = \
+        "Write all the paths (see option -p) to this file, searching " \
+        "in parallel from each neighbor of the source, and only " \
+        "output the best ones (see option --top-paths). The paths " \
+        "through each neighbor are written once they have all been " \
+        "found"
+    parser.add_argument("--paths-out",
+                        dest = "paths_out",
+                        default = None,
+                        type = str,
+                        help = po_helpstr)
+
+    tp_default = 100
+    tp_helpstr = \
+        "Number of best paths to output when writing all the paths " \
+        "to a file (see option --paths-out) (default: {:d})"
+    parser.add_argument("--top-paths",
+                        dest = "top_paths",
+                        default = tp_default,
+                        type = int,
+                        help = tp_helpstr.format(tp_default))
+
+    np_helpstr = \
+        "Maximum number of processes searching paths or analysing " \
+        "graphs at the same time (see options --paths-out, " \
+        "--pairs-out and -a) (default: one per neighbor of the " \
+        "source, per source or per graph, up to the number of CPUs)"
+    parser.add_argument("--nprocs",
+                        dest = "nprocs",
+                        default = None,
+                        type = int,
+                        help = np_helpstr)
+
+    pairs_helpstr = \
+        "Find a shortest path between each residue of --sources " \
+        "and each residue of --targets, and write them to this table"
+    parser.add_argument("--pairs-out",
+                        dest = "pairs_out",
+                        default = None,
+                        type = str,
+                        help = pairs_helpstr)
+
+    sources_helpstr = \
+        "Source residues for option --pairs-out, either as " \
+        "comma-separated residues or as a selection string " \
+        "applied to the reference structure"
+    parser.add_argument("--sources",
+                        dest = "sources",
+                        default = None,
+                        type = str,
+                        help = sources_helpstr)
+
+    targets_helpstr = \
+        "Target residues for option --pairs-out (see option --sources)"
+    parser.add_argument("--targets",
+                        dest = "targets",
+                        default = None,
+                        type = str,
+                        help = targets_helpstr)
+
+    pairsby_choices = ["length", "persistence"]
+    pairsby_default = "length"
+    pairsby_helpstr = \
+        "How to find the shortest paths for option --pairs-out: " \
+        "fewest edges, or highest product of the edge persistences. " \
+        "Possible choices are {:s} (default: {:s})"
+    parser.add_argument("--pairs-by",
+                        dest = "pairs_by",
+                        choices = pairsby_choices,
+                        default = pairsby_default,
+                        help = pairsby_helpstr.format(\
+                            ", ".join(pairsby_choices), pairsby_default))
+
+    ce_choices = ["betweenness", "closeness", "current_flow"]
+    ce_helpstr = \
+        "Calculate this node centrality measure (can be repeated). " \
+        "Possible choices are {:s}"
+    parser.add_argument("--centrality",
+                        dest = "centrality",
+                        choices = ce_choices,
+                        action = "append",
+                        default = None,
+                        help = ce_helpstr.format(", ".join(ce_choices)))
+
+    ceout_helpstr = \
+        "Write the node centrality measures to this table instead " \
+        "of the standard output"
+    parser.add_argument("--centrality-out",
+                        dest = "centrality_out",
+                        default = None,
+                        type = str,
+                        help = ceout_helpstr)
+
+    ebout_helpstr = \
+        "Write the edge betweenness centrality to this table " \
+        "(requires --centrality betweenness)"
+    parser.add_argument("--edge-betweenness-out",
+                        dest = "edge_betweenness_out",
+                        default = None,
+                        type = str,
+                        help = ebout_helpstr)
+
+    cepdb_helpstr = \
+        "Save the node centrality in PDB file (the name of the " \
+        "measure is appended to the file name if there are more)"
+    parser.add_argument("--centrality-pdb",
+                        dest = "centrality_pdb",
+                        default = None,
+                        type = str,
+                        help = cepdb_helpstr)
+
+    cesamples_helpstr = \
+        "Approximate the betweenness centrality using this number " \
+        "of random source nodes"
+    parser.add_argument("--centrality-samples",
+                        dest = "centrality_samples",
+                        default = None,
+                        type = int,
+                        help = cesamples_helpstr)
+
+    cetol_helpstr = \
+        "Approximate the betweenness centrality adding random " \
+        "source nodes until its estimated standard error is " \
+        "within this tolerance for all nodes"
+    parser.add_argument("--centrality-tolerance",
+                        dest = "centrality_tolerance",
+                        default = None,
+                        type = float,
+                        help = cetol_helpstr)
+
+    seed_helpstr = "Seed for the random source nodes"
+    parser.add_argument("--seed",
+                        dest = "seed",
+                        default = None,
+                        type = int,
+                        help = seed_helpstr)
+
+    table_helpstr = \
+        "Write the {:s} to this table (JSON if the file name ends " \
+        "in .json, tab-separated otherwise) instead of the standard " \
+        "output"
+    parser.add_argument("--components-out",
+                        dest = "components_out",
+                        default = None,
+                        type = str,
+                        help = table_helpstr.format(\
+                            "connected components"))
+
+    parser.add_argument("--hubs-out",
+                        dest = "hubs_out",
+                        default = None,
+                        type = str,
+                        help = table_helpstr.format("hubs"))
+
+    parser.add_argument("--paths-table-out",
+                        dest = "paths_table_out",
+                        default = None,
+                        type = str,
+                        help = table_helpstr.format(\
+                            "paths found (see option -p)"))
+
+    q_helpstr = "Do not write the list of the nodes of the graph"
+    parser.add_argument("-q", "--quiet",
+                        dest = "quiet",
+                        default = False,
+                        action = "store_true",
+                        help = q_helpstr)
+
     cb_helpstr = "Save connected components ID in PDB file"
     parser.add_argument("-cb", "--components-pdb",
                         dest = "components_pdb",
@@ -431,82 +1552,183 @@ def main():
                         action = "store_true",
                         help = d_helpstr)
 
+    pm_helpstr = \
+        "Write the paths found as matrices, all in this single " \
+        "file storing the edges of each path with their weights"
+    parser.add_argument("--paths-matrices",
+                        dest = "paths_matrices",
+                        default = None,
+                        type = str,
+                        help = pm_helpstr)
+
+    ep_helpstr = \
+        "Convert a file written with option --paths-matrices to " \
+        "one matrix file per path, as written by option -d, and exit"
+    parser.add_argument("--export-paths-matrices",
+                        metavar = "PATHS_MATRICES",
+                        dest = "export_paths_matrices",
+                        default = None,
+                        type = str,
+                        help = ep_helpstr)
+
+    cache_helpstr = \
+        "Keep a binary cache of a text adjacency matrix next to it " \
+        "(file name + {:s}), used as long as the matrix file is not " \
+        "modified"
+    parser.add_argument("--cache",
+                        dest = "cache",
+                        default = False,
+                        action = "store_true",
+                        help = cache_helpstr.format(gio.CACHE_SUFFIX))
+
     args = parser.parse_args()
 
+    # convert the path matrices without loading any graph
+    if args.export_paths_matrices:
+        try:
+            export_paths_matrices(fname = args.export_paths_matrices,
+                                  fmt = "%.1f",
+                                  where = os.getcwd())
+        except Exception:
+            log.error("Could not convert the path matrices. Exiting ...", \
+                      exc_info = True)
+            exit(1)
+        return
+
     # check the presence of the adjacency matrix (or matrices)
     if not args.dat:
         # exit if the adjacency matrix was not speficied
         log.error("Graph adjacency matrix must be specified. Exiting ...")
         exit(1)
+    # expand the patterns of the graph files (file names which match
+    # no files are kept, and reported as missing later)
+    fnames = []
+    for pattern in args.dat:
+        fnames.extend(sorted(glob.glob(pattern)) or [pattern])
     # check the presence of the reference structure if the output
     # PDBs have been requested
-    if (args.components_pdb or args.hubs_pdb) and (not args.top):
+    if (args.components_pdb or args.hubs_pdb or args.centrality_pdb) \
+            and (not args.top):
         # exit if the user requested the PDB files with connected
         # components and hubs but did not provide a reference PDB
         # file
         log.error(\
             "A PDB reference file must be supplied if using options " \
-            "-cb and -ub. Exiting ...")
+            "-cb, -ub and --centrality-pdb. Exiting ...")
         exit(1)
-    # build the graph
+
+
+    ############################ BATCH RUN ############################
+
+    if len(fnames) > 1:
+        if args.do_paths or args.centrality or args.pairs_out or \
+                args.components_pdb or args.hubs_pdb:
+            log.error(\
+                "Only options -c and -u can be used with more than " \
+                "one graph. Exiting ...")
+            exit(1)
+        if not args.do_components and not args.do_hubs:
+            log.error(\
+                "Options -c and/or -u must be used with more than " \
+                "one graph. Exiting ...")
+            exit(1)
+        try:
+            results = run_graphs_batch(fnames = fnames,
+                                       pdb = args.top,
+                                       cache = args.cache,
+                                       min_k = args.hubs_cutoff,
+                                       nprocs = args.nprocs)
+        except ValueError:
+            log.error("Could not read the reference structure. " \
+                      "Exiting ...", exc_info = True)
+            exit(1)
+        if all(result is None for result in results):
+            log.error("None of the graphs could be analysed. Exiting ...")
+            exit(1)
+        if args.do_components:
+            write_components_batch(fnames = fnames,
+                                   results = results,
+                                   outfile = args.components_out)
+        if args.do_hubs:
+            write_hubs_batch(fnames = fnames,
+                             results = results,
+                             outfile = args.hubs_out)
+        return
+
+
+    ########################### SINGLE GRAPH ##########################
+
+    # load the weight matrix of the graph
     try:
-        identifiers, G = build_graph(args.dat, pdb = args.top)
+        identifiers, A = \
+            load_graph_matrix(fnames[0], \
+                              pdb = args.top, \
+                              cache = args.cache, \
+                              check_pdb = bool(args.components_pdb or \
+                                               args.hubs_pdb or \
+                                               args.centrality_pdb))
     except ValueError:
         errstr = \
             "Could not build the graph from the files provided. " \
             "Exiting ..."
         log.error(errstr, exc_info = True)
         exit(1)
-    # get graph nodes and edges
-    nodes = G.nodes()
-    edges = G.edges()
     # log about the graph building
     outstr = "Graph loaded! {:d} nodes, {:d} edges\n"
-    sys.stdout.write(outstr.format(len(nodes), len(edges)))
-    outstr = "Node list: \n{:s}\n"
-    sys.stdout.write(outstr.format(\
-        "\n".join([node for node in sorted(nodes, key = get_resnum)])))
+    sys.stdout.write(outstr.format(len(identifiers), get_num_edges(A)))
+    if not args.quiet:
+        outstr = "Node list: \n{:s}\n"
+        sys.stdout.write(outstr.format(\
+            "\n".join(sorted(identifiers, key = get_resnum))))
+    # values of the annotated PDB files requested, by file name,
+    # all written at once after reading the reference a single time
+    pdb_annotations = {}
+
+    def annotate_pdb(pdb, vals, pdb_out):
+        pdb_annotations[pdb_out] = {"bfactor" : vals}
 
 
     ###################### CONNECTED COMPONENTS #######################
 
     if args.do_components: 
         # calculate the connected components
-        ccs = get_connected_components(G)
+        ccs = get_connected_components(G = A, identifiers = identifiers)
         # write the connected components
-        write_connected_components(ccs = ccs, outfile = None)
+        write_connected_components(ccs = ccs,
+                                   outfile = args.components_out)
         # if the user requested the PDB file with the connected
         # components
         if args.components_pdb:
-            # write PDB file with B-factor column replaced
+            # PDB file with B-factor column replaced (see below)
             write_connected_components_pdb(
                 identifiers = identifiers,
                 ccs = ccs,
                 ref = args.top,
                 components_pdb = args.components_pdb,
-                replace_bfac_func = replace_bfac_column)
+                replace_bfac_func = annotate_pdb)
 
 
     ############################## HUBS ###############################
             
     if args.do_hubs:
         # calculate the hubs
-        hubs = get_hubs(G = G,
+        hubs = get_hubs(G = A,
                         min_k = args.hubs_cutoff,
-                        sorting = "descending")
+                        sorting = "descending",
+                        identifiers = identifiers)
         # if hubs have been found
         if hubs:
             # write the hubs
-            write_hubs(hubs = hubs, outfile = None)
+            write_hubs(hubs = hubs, outfile = args.hubs_out)
             # if the user requested the PDB file with the hubs
             if args.hubs_pdb:
-                # write PDB file with B-factor column replaced
+                # PDB file with B-factor column replaced (see below)
                 write_hubs_pdb(\
                     identifiers = identifiers,
                     hubs = hubs,
                     ref = args.top,
                     hubs_pdb = args.hubs_pdb,
-                    replace_bfac_func = replace_bfac_column)
+                    replace_bfac_func = annotate_pdb)
         else:
             log.warning("No hubs were found")
 
@@ -520,13 +1742,55 @@ def main():
                 "You must specify source and target residues. " \
                 "Exiting...")
             exit(1)
+        if args.kbest is not None and args.paths_out:
+            log.error(\
+                "Options --k-best and --paths-out cannot be used " \
+                "together. Exiting...")
+            exit(1)
+        # only the path searches need a networkx Graph
+        G = csr_to_graph(A, identifiers)
+        # note on the paths written, if the search stopped early
+        note = None
         try:
+            # write all the paths between a pair of residues,
+            # keeping only the best ones
+            if args.paths_out:
+                numpaths, paths = \
+                    enumerate_paths(G = G,
+                                    source = args.source,
+                                    target = args.target,
+                                    maxl = args.maxl,
+                                    sort_paths_by = args.sort_paths_by,
+                                    out_paths = args.paths_out,
+                                    top = args.top_paths,
+                                    nprocs = args.nprocs)
+                paths = paths if paths else None
+            # calculate the best paths between a pair of residues
+            elif args.kbest is not None:
+                paths, truncated = collect_generator(\
+                    get_kbest_paths(G = G,
+                                    source = args.source,
+                                    target = args.target,
+                                    k = args.kbest,
+                                    maxl = args.maxl,
+                                    weight_by = args.kbest_by,
+                                    max_skipped = args.kbest_max_skipped))
+                if truncated:
+                    note = \
+                        "The search stopped after skipping {:d} paths " \
+                        "longer than {:d} edges (see option " \
+                        "--k-best-max-skipped): fewer than {:d} paths " \
+                        "may have been found."
+                    note = note.format(args.kbest_max_skipped, \
+                                       args.maxl, args.kbest)
+                paths = paths if paths else None
             # calculate paths between a pair of residues
-            paths = get_paths(G = G,
-                              source = args.source,
-                              target = args.target,
-                              maxl = args.maxl,
-                              sort_paths_by = args.sort_paths_by)
+            else:
+                paths = get_paths(G = G,
+                                  source = args.source,
+                                  target = args.target,
+                                  maxl = args.maxl,
+                                  sort_paths_by = args.sort_paths_by)
         except ValueError:
             errstr = "Could not compute paths."
             log.error(errstr)
@@ -534,7 +1798,9 @@ def main():
         # if paths have been found
         if paths is not None:
             # write the paths
-            write_paths(paths = paths, outfile = None)
+            write_paths(paths = paths, \
+                        outfile = args.paths_table_out, \
+                        note = note)
             # if path matrices have been requested           
             if args.write_paths:
                 # write paths as matrices
@@ -543,6 +1809,97 @@ def main():
                                      paths = paths,
                                      fmt = "%.1f",
                                      where = os.getcwd())
+            # if a single file with the path matrices has been
+            # requested
+            if args.paths_matrices:
+                write_paths_edges(identifiers = identifiers,
+                                  G = G,
+                                  paths = paths,
+                                  fname = args.paths_matrices,
+                                  metadata = {"source" : args.source,
+                                              "target" : args.target})
+
+
+    ########################### CENTRALITY ############################
+
+    if args.centrality:
+        if args.edge_betweenness_out and \
+                "betweenness" not in args.centrality:
+            log.error(\
+                "Option --edge-betweenness-out requires --centrality " \
+                "betweenness. Exiting...")
+            exit(1)
+        # all the measures are calculated on the unweighted graph
+        costs = get_csgraph(G = A, nodes = identifiers)
+        centrality = {}
+        for measure in args.centrality:
+            if measure == "betweenness":
+                centrality[measure], edges_bc, nsources = \
+                    get_betweenness(A = costs,
+                                    samples = args.centrality_samples,
+                                    tolerance = args.centrality_tolerance,
+                                    seed = args.seed,
+                                    nprocs = args.nprocs)
+                if nsources < len(identifiers):
+                    logstr = "Betweenness approximated from {:d} sources."
+                    log.info(logstr.format(nsources))
+            elif measure == "closeness":
+                centrality[measure] = get_closeness(A = costs)
+            elif measure == "current_flow":
+                centrality[measure] = get_current_flow(A = costs)
+        # write the centrality measures
+        write_centrality(identifiers = identifiers,
+                         centrality = centrality,
+                         outfile = args.centrality_out)
+        if args.edge_betweenness_out:
+            write_edge_betweenness(identifiers = identifiers,
+                                   edges_bc = edges_bc,
+                                   outfile = args.edge_betweenness_out)
+        # if the user requested the PDB files with the centrality
+        if args.centrality_pdb:
+            root, ext = os.path.splitext(args.centrality_pdb)
+            for measure, values in centrality.items():
+                pdb_out = args.centrality_pdb if len(centrality) == 1 \
+                          else f"{root}_{measure}{ext}"
+                # B-factor column replaced with the centrality
+                annotate_pdb(pdb = args.top,
+                             vals = values,
+                             pdb_out = pdb_out)
+
+
+    ####################### ANNOTATED PDB FILES #######################
+
+    if pdb_annotations:
+        write_annotated_pdbs(pdb = args.top, annotations = pdb_annotations)
+
+
+    ######################## PAIRS OF RESIDUES ########################
+
+    if args.pairs_out:
+        # sources and targets must be specified
+        if not args.sources or not args.targets:
+            log.error(\
+                "You must specify source and target residues " \
+                "(options --sources and --targets). Exiting...")
+            exit(1)
+        try:
+            sources = get_selection_nodes(selection = args.sources,
+                                          identifiers = identifiers,
+                                          ref = args.top)
+            targets = get_selection_nodes(selection = args.targets,
+                                          identifiers = identifiers,
+                                          ref = args.top)
+            # calculate the shortest paths between all the pairs
+            pairs = get_pairs_paths(G = A,
+                                    sources = sources,
+                                    targets = targets,
+                                    weight_by = args.pairs_by,
+                                    nprocs = args.nprocs,
+                                    identifiers = identifiers)
+        except ValueError:
+            log.error("Could not compute paths.", exc_info = True)
+            exit(1)
+        write_pairs_paths(pairs = pairs, outfile = args.pairs_out)
 
 if __name__ == "__main__":
     main()
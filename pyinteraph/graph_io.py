@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; coding:utf-8 -*-
+
+#    PyInteraph, a software suite to analyze interactions and
+#    interaction network in structural ensembles.
+#    Copyright (C) 2013 Matteo Tiberti <matteo.tiberti@gmail.com>,
+#                       Gaetano Invernizzi, Yuval Inbar,
+#                       Matteo Lambrughi, Gideon Schreiber,
+#                       Elena Papaleo <elena.papaleo@unimib.it>
+#                                     <elena.papaleo@bio.ku.dk>
+#
+#    This program is free software: you can redistribute it
+#    and/or modify it under the terms of the GNU General Public
+#    License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.
+#    If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging as log
+import os
+import tempfile
+import numpy as np
+from libinteract import libinteract as li
+
+
+############################## CONSTANTS ##############################
+
+# version of the sparse graph format
+GRAPH_VERSION = 1
+# version of the format of the files storing the edges of paths
+PATHS_VERSION = 1
+# extension selecting the sparse graph format when writing
+GRAPH_EXT = ".npz"
+# .npz files are zip archives, which start with this signature
+ZIP_MAGIC = b"PK\x03\x04"
+# start of the comment line (after "# ") storing the node
+# identifiers and the metadata of graphs in the plain text format
+TEXT_HEADER = "pyinteraph graph"
+# suffix of the binary cache files of plain text graphs
+CACHE_SUFFIX = ".cache.npz"
+# number of matrix elements compared at a time in symmetry checks
+SYMMETRY_BLOCKSIZE = 2**20
+
+
+############################## IDENTIFIERS ############################
+
+def get_residue_identifiers(residues):
+    """Get the identifiers of the graph nodes for a group of
+    residues."""
+
+    idfmt = "{:s}-{:d}{:s}"
+    return [idfmt.format(r.segment.segid, r.resnum, r.resname) \
+            for r in residues]
+
+
+############################### FORMAT ################################
+
+def is_sparse_fname(fname):
+    """Whether a graph should be written in the sparse format,
+    based on its file name."""
+
+    return fname.lower().endswith(GRAPH_EXT)
+
+
+def is_sparse_file(fname):
+    """Whether an existing graph file is in the sparse format."""
+
+    with open(fname, "rb") as f:
+        return f.read(len(ZIP_MAGIC)) == ZIP_MAGIC
+
+
+############################### WRITING ###############################
+
+def is_scipy_sparse(matrix):
+    """Whether a matrix is a scipy.sparse matrix (checked without
+    importing scipy)."""
+
+    return hasattr(matrix, "tocsr")
+
+
+def save_graph(fname, matrix, fmt, identifiers = None, metadata = None):
+    """Save an interaction graph, given as a dense or scipy.sparse
+    matrix. The sparse format is used if the file name ends in .npz,
+    the plain text matrix format otherwise (in that case, fmt is the
+    format of the matrix values, and identifiers and metadata, if
+    any, are saved in a comment line before the matrix)."""
+
+    if identifiers is not None and \
+            len(identifiers) != np.shape(matrix)[0]:
+        errstr = "The number of identifiers does not match the " \
+                 "size of the graph matrix."
+        raise ValueError(errstr)
+    if not is_sparse_fname(fname):
+        if is_scipy_sparse(matrix):
+            matrix = matrix.toarray()
+        header = ""
+        if identifiers is not None or metadata is not None:
+            header = TEXT_HEADER + " " + \
+                json.dumps({"version" : GRAPH_VERSION, \
+                            "identifiers" : list(identifiers or []), \
+                            "metadata" : metadata or {}})
+        # the header is written as a comment, which np.loadtxt skips
+        np.savetxt(fname, matrix, fmt = fmt, header = header)
+        return
+    if is_scipy_sparse(matrix):
+        matrix = matrix.tocsr().astype(float)
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        data, cols, indptr = matrix.data, matrix.indices, matrix.indptr
+    else:
+        matrix = np.asarray(matrix, dtype = float)
+        if matrix.ndim != 2:
+            raise ValueError("The graph matrix must be two-dimensional.")
+        # compressed sparse rows: values and column indexes of the
+        # non-zero elements, row by row, and where each row starts
+        rows, cols = np.nonzero(matrix)
+        data = matrix[rows, cols]
+        indptr = np.zeros(matrix.shape[0]+1, dtype = np.int64)
+        np.cumsum(np.bincount(rows, minlength = matrix.shape[0]), \
+                  out = indptr[1:])
+    if identifiers is None:
+        identifiers = []
+    # np.savez_compressed would add .npz to names without it
+    with open(fname, "wb") as f:
+        np.savez_compressed(f, \
+                            version = GRAPH_VERSION, \
+                            shape = np.array(matrix.shape), \
+                            data = data, \
+                            indices = cols.astype(np.int32), \
+                            indptr = indptr.astype(np.int64), \
+                            identifiers = np.array(identifiers, \
+                                                   dtype = str), \
+                            metadata = json.dumps(metadata or {}))
+
+
+############################### READING ###############################
+
+def load_text_header(fname):
+    """Load the node identifiers (None if not available) and the
+    metadata stored in the header line of a graph in the plain text
+    format, without reading the matrix."""
+
+    prefix = "# " + TEXT_HEADER + " "
+    with open(fname) as f:
+        line = f.readline()
+    if not line.startswith(prefix):
+        return None, {}
+    header = json.loads(line[len(prefix):])
+    if int(header["version"]) > GRAPH_VERSION:
+        errstr = f"Unsupported graph format version in {fname}."
+        raise ValueError(errstr)
+    return (header["identifiers"] or None), header["metadata"]
+
+
+def load_sparse_graph(fname):
+    """Load a graph in the sparse format. Return the compressed
+    sparse rows arrays (data, indices, indptr), the shape of the
+    matrix, the node identifiers (None if not available) and the
+    metadata."""
+
+    with np.load(fname) as arch:
+        if int(arch["version"]) > GRAPH_VERSION:
+            errstr = f"Unsupported graph format version in {fname}."
+            raise ValueError(errstr)
+        csr = (arch["data"], arch["indices"], arch["indptr"])
+        shape = tuple(int(x) for x in arch["shape"])
+        identifiers = [str(x) for x in arch["identifiers"]]
+        metadata = json.loads(str(arch["metadata"]))
+    return csr, shape, (identifiers if identifiers else None), metadata
+
+
+def csr_to_dense(csr, shape):
+    """Convert compressed sparse rows arrays to a dense matrix."""
+
+    data, indices, indptr = csr
+    matrix = np.zeros(shape)
+    rows = np.repeat(np.arange(shape[0]), np.diff(indptr))
+    matrix[rows, indices] = data
+    return matrix
+
+
+def get_cache_fname(fname):
+    """Get the name of the binary cache file of a plain text graph."""
+
+    return fname + CACHE_SUFFIX
+
+
+def load_text_graph(fname, cache = False):
+    """Load the matrix of a graph in the plain text format (the
+    header line, if any, is skipped as a comment). If cache is True,
+    the matrix is read from a binary cache file next to the graph
+    file, if one exists for the same size and modification time of
+    the graph file, and the cache file is written otherwise."""
+
+    if not cache:
+        return np.loadtxt(fname)
+    stat = os.stat(fname)
+    cache_fname = get_cache_fname(fname)
+    try:
+        with np.load(cache_fname) as arch:
+            if int(arch["size"]) == stat.st_size and \
+               int(arch["mtime_ns"]) == stat.st_mtime_ns:
+                return arch["matrix"]
+    except Exception:
+        # missing, stale or unreadable cache
+        pass
+    matrix = np.loadtxt(fname)
+    # write the cache under a temporary name first, so that
+    # concurrent readers never see a partial file
+    try:
+        fd, tmp_fname = \
+            tempfile.mkstemp(dir = os.path.dirname(cache_fname) or ".", \
+                             suffix = CACHE_SUFFIX)
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, \
+                     size = stat.st_size, \
+                     mtime_ns = stat.st_mtime_ns, \
+                     matrix = matrix)
+        os.replace(tmp_fname, cache_fname)
+    except OSError:
+        # the graph can still be used without a cache (e.g. in
+        # read-only directories)
+        pass
+    return matrix
+
+
+def load_graph(fname, cache = False):
+    """Load an interaction graph in either the sparse or the plain
+    text format, detected from the file contents (see load_text_graph
+    for cache). Return the dense matrix, the node identifiers (None
+    if not available) and the metadata."""
+
+    if not is_sparse_file(fname):
+        return (load_text_graph(fname, cache = cache),) + \
+               load_text_header(fname)
+    csr, shape, identifiers, metadata = load_sparse_graph(fname)
+    return csr_to_dense(csr, shape), identifiers, metadata
+
+
+def load_csr_graph(fname, cache = False):
+    """Load an interaction graph in either format as a scipy.sparse
+    CSR matrix (graphs in the sparse format are never converted to
+    dense matrices, see load_text_graph for cache). Return the
+    matrix and the node identifiers (None if not available)."""
+
+    import scipy.sparse as sp
+
+    if not is_sparse_file(fname):
+        return sp.csr_matrix(load_text_graph(fname, cache = cache)), \
+               load_text_header(fname)[0]
+    csr, shape, identifiers, _ = load_sparse_graph(fname)
+    return sp.csr_matrix(csr, shape = shape), identifiers
+
+
+def _load_graph_job(fname, cache):
+    """Load a graph for load_graphs, returning None on failure."""
+
+    try:
+        return load_graph(fname, cache = cache)
+    except Exception:
+        # the cause is only known to the (worker) process loading it
+        log.error(f"Could not load {fname}.", exc_info = True)
+        return None
+
+
+def load_graphs(fnames, cache = False, nprocs = None):
+    """Load several graphs as load_graph does, in parallel worker
+    processes (at most nprocs, by default one per file up to the
+    number of CPUs). Return the list of results, with None for the
+    files which could not be loaded."""
+
+    return li.run_forked(_load_graph_job, (cache,), fnames, nprocs)
+
+
+def is_symmetric(matrix, blocksize = SYMMETRY_BLOCKSIZE):
+    """Whether a square (dense or scipy.sparse) matrix is symmetric
+    (within the tolerance of np.allclose). Blocks of rows of dense
+    matrices are compared with the corresponding columns, so that
+    the transpose of the whole matrix is never built."""
+
+    if is_scipy_sparse(matrix):
+        # only the elements which differ exactly need to be compared
+        matrix = matrix.tocsr()
+        transpose = matrix.T.tocsr()
+        diff = (matrix - transpose).tocoo()
+        if diff.nnz == 0:
+            return True
+        return np.allclose(\
+            np.asarray(matrix[diff.row, diff.col]).ravel(), \
+            np.asarray(transpose[diff.row, diff.col]).ravel())
+    nrows = matrix.shape[0]
+    step = max(1, blocksize // max(1, nrows))
+    for start in range(0, nrows, step):
+        stop = min(start + step, nrows)
+        if not np.allclose(matrix[start:stop], matrix[:,start:stop].T):
+            return False
+    return True
+
+
+def load_identifiers(fname):
+    """Load only the node identifiers stored in a graph file (None
+    if not available)."""
+
+    if not is_sparse_file(fname):
+        return load_text_header(fname)[0]
+    with np.load(fname) as arch:
+        identifiers = [str(x) for x in arch["identifiers"]]
+    return identifiers if identifiers else None
+
+
+################################ PATHS ################################
+
+def save_paths(fname, path_ids, rows, cols, weights, identifiers, \
+               metadata = None):
+    """Save the edges of several paths in a graph to a single
+    compressed file: for each edge, the index of the path it belongs
+    to (paths are numbered from 0 and their edges are contiguous),
+    its two nodes (as indexes of identifiers) and its weight."""
+
+    # np.savez_compressed would add .npz to names without it
+    with open(fname, "wb") as f:
+        np.savez_compressed(f, \
+                            version = PATHS_VERSION, \
+                            path = np.asarray(path_ids, dtype = np.int32), \
+                            row = np.asarray(rows, dtype = np.int32), \
+                            col = np.asarray(cols, dtype = np.int32), \
+                            weight = np.asarray(weights, dtype = float), \
+                            identifiers = np.array(identifiers, \
+                                                   dtype = str), \
+                            metadata = json.dumps(metadata or {}))
+
+
+def load_paths(fname):
+    """Load the edges of paths saved by save_paths. Return the arrays
+    (path indexes, rows, columns, weights) of the edges, the node
+    identifiers and the metadata."""
+
+    with np.load(fname) as arch:
+        if int(arch["version"]) > PATHS_VERSION:
+            errstr = f"Unsupported paths format version in {fname}."
+            raise ValueError(errstr)
+        edges = (arch["path"], arch["row"], arch["col"], arch["weight"])
+        identifiers = [str(x) for x in arch["identifiers"]]
+        metadata = json.loads(str(arch["metadata"]))
+    return edges, identifiers, metadata
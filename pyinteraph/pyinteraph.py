@@ -24,17 +24,195 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import collections
+import copy
+import json
 import logging as log
 import os
 import os.path
 import sys
-import pkg_resources
-import MDAnalysis as mda
-import numpy as np
 from libinteract import libinteract as li
+from pyinteraph import graph_io as gio
+# MDAnalysis is slow to import, therefore it is imported only
+# once the arguments have been parsed
+
+
+def get_data_fname(fname):
+    """Get the path to a data file distributed with PyInteraph."""
+
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
+
+
+def get_replica_fname(fname, replica):
+    """Get the name of an output file for a single replica."""
+
+    root, ext = os.path.splitext(fname)
+    return f"{root}_rep{replica+1:d}{ext}"
+
+
+def get_class_fname(fname, hb_class):
+    """Get the name of an output file for a single class of
+    hydrogen bonds, when all the classes are analyzed together."""
+
+    if fname is None or hb_class in (None, "all"):
+        return fname
+    root, ext = os.path.splitext(fname)
+    return f"{root}_{hb_class}{ext}"
+
+
+def get_graph_metadata(kind, **kwargs):
+    """Get the provenance metadata stored in graph files."""
+
+    return dict(kind = kind, command = sys.argv, **kwargs)
+
+
+def write_replicas(replicas, dat, graph, fmt, identifiers, metadata):
+    """Write the output files for each replica."""
+
+    for replica, (records, mat_out) in enumerate(replicas):
+        # Save .dat
+        with open(get_replica_fname(dat, replica), "w") as out:
+            li.write_records(records, out)
+        # Save .mat (if available)
+        if mat_out is not None:
+            gio.save_graph(get_replica_fname(graph, replica), \
+                           mat_out, \
+                           fmt = fmt, \
+                           identifiers = identifiers, \
+                           metadata = dict(metadata, replica = replica+1))
+
+
+def main_merge(argv):
+    """Merge partial results into the usual output files."""
+
+    ########################### ARGUMENT PARSER ###########################
+
+    description = \
+        "Merge partial results (see the --*-partial options) computed " \
+        "on different trajectories or trajectory chunks of the same system"
+    parser = argparse.ArgumentParser(prog = "pyinteraph merge", \
+                                     description = description)
+
+    partials_helpstr = "Partial results files (.npz)"
+    parser.add_argument("partials", \
+                        type = str, \
+                        nargs = "+", \
+                        help = partials_helpstr)
+
+    s_helpstr = "Topology file"
+    parser.add_argument("-s", "--top", \
+                        action = "store", \
+                        type = str, \
+                        dest = "top", \
+                        default = None, \
+                        help = s_helpstr)
+
+    r_helpstr = "Reference structure"
+    parser.add_argument("-r", "--ref", \
+                        action = "store", \
+                        type = str, \
+                        dest = "ref", \
+                        default = None, \
+                        help = r_helpstr)
+
+    d_helpstr = "Name of the file where to store the merged results"
+    parser.add_argument("-d", "--dat", \
+                        action = "store", \
+                        type = str, \
+                        dest = "dat", \
+                        default = None, \
+                        help = d_helpstr)
+
+    g_helpstr = \
+        "Name of the file where to store adjacency matrix " \
+        "for interaction graph; the compressed sparse format " \
+        "is used if the name ends in .npz"
+    parser.add_argument("-g", "--graph", \
+                        action = "store", \
+                        type = str, \
+                        dest = "graph", \
+                        default = None, \
+                        help = g_helpstr)
+
+    v_helpstr = "Verbose mode"
+    parser.add_argument("-v", "--verbose", \
+                        action = "store_true", \
+                        dest = "verbose", \
+                        help = v_helpstr)
+
+    args = parser.parse_args(argv)
+
+    # Logging format
+    LOGFMT = "%(levelname)s: %(message)s"
+    # Verbose mode?
+    if args.verbose:
+        log.basicConfig(level = log.INFO, format = LOGFMT)
+    else:
+        log.basicConfig(level = log.WARNING, format = LOGFMT)
+
+    # default output files and graph format for each kind of analysis
+    dat_defaults = {"hc" : "hydrophobic-clusters.dat", \
+                    "sb" : "salt-bridges.dat", \
+                    "hb" : "hydrogen-bonds.dat", \
+                    "kbp" : "kb-potential.dat"}
+    graph_fmts = {"hc" : "%.1f", "sb" : "%.1f", "hb" : "%.1f", "kbp" : "%.3f"}
+
+    # topology is needed to check and format the partial results
+    if not args.top:
+        log.error("Topology is required.")
+        exit(1)
+    ref = args.ref if args.ref else args.top
+    import MDAnalysis as mda
+    try:
+        pdb = mda.Universe(ref)
+        uni = mda.Universe(args.top)
+    except ValueError:
+        log.error("Could not read one of the input files.")
+        exit(1)
+    # load and merge the partial results
+    try:
+        partials = [li.load_partial(fname) for fname in args.partials]
+        merged = li.merge_partials(partials)
+    except (IOError, KeyError, ValueError):
+        log.error("Could not merge the partial results.", exc_info = True)
+        exit(1)
+    if merged["fingerprint"] != li.get_topology_fingerprint(uni):
+        log.error("The partial results do not refer to this topology.")
+        exit(1)
+    logstr = "Merged {:d} partial results ({:s}, {:d} frames)."
+    log.info(logstr.format(len(partials), \
+                           merged["kind"], \
+                           merged["numframes"]))
+
+    do_fullmatrix = True if args.graph else False
+    records, mat_out = li.format_partial(partial = merged, \
+                                         pdb = pdb, \
+                                         uni = uni, \
+                                         do_fullmatrix = do_fullmatrix, \
+                                         as_records = True)
+    # Save .dat
+    dat = args.dat if args.dat else dat_defaults[merged["kind"]]
+    with open(dat, "w") as out:
+        li.write_records(records, out)
+    # Save .mat (if available)
+    if mat_out is not None:
+        graph_ids = gio.get_residue_identifiers(pdb.residues)
+        metadata = get_graph_metadata(merged["kind"], \
+                                      numframes = merged["numframes"])
+        gio.save_graph(args.graph, \
+                       mat_out, \
+                       fmt = graph_fmts[merged["kind"]], \
+                       identifiers = graph_ids, \
+                       metadata = metadata)
+
 
 def main():
 
+    # partial results are merged by a dedicated entry point
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        main_merge(sys.argv[2:])
+        return
+
     ########################### ARGUMENT PARSER ###########################
 
     description = "Interaction calculator"
@@ -50,14 +228,28 @@ def main():
                         default = None, \
                         help = s_helpstr)
 
-    t_helpstr = "Trajectory file"
+    t_helpstr = \
+        "Trajectory file(s). If more than one is given, each " \
+        "replica is processed in parallel and per-replica results " \
+        "are written next to the pooled ones"
     parser.add_argument("-t", "--trj", \
                         action = "store", \
                         type = str, \
+                        nargs = "+", \
                         dest = "trj", \
                         default = None, \
                         help = t_helpstr)
 
+    nprocs_helpstr = \
+        "Maximum number of replicas to be processed at the same " \
+        "time (default: one process per replica)"
+    parser.add_argument("--nprocs", \
+                        action = "store", \
+                        type = int, \
+                        dest = "nprocs", \
+                        default = None, \
+                        help = nprocs_helpstr)
+
     r_helpstr = "Reference structure"
     parser.add_argument("-r", "--ref", \
                         action = "store", \
@@ -66,6 +258,46 @@ def main():
                         default = None, \
                         help = r_helpstr)
 
+    wcache_helpstr = \
+        "Store the coordinates of the atoms needed by the requested " \
+        "analyses in this memory-mapped .npy file (plus an atom " \
+        "index file) and run the analyses from it"
+    parser.add_argument("--write-coords-cache", \
+                        action = "store", \
+                        type = str, \
+                        dest = "write_cache", \
+                        default = None, \
+                        help = wcache_helpstr)
+
+    cache_helpstr = \
+        "Read coordinates from this .npy coordinates cache " \
+        "(frames x atoms x 3) instead of the trajectory"
+    parser.add_argument("--coords-cache", \
+                        action = "store", \
+                        type = str, \
+                        dest = "coords_cache", \
+                        default = None, \
+                        help = cache_helpstr)
+
+    checkpoint_helpstr = \
+        "Save the partial results (see the --*-partial options) " \
+        "every this many frames while analyzing the trajectory"
+    parser.add_argument("--checkpoint-every", \
+                        action = "store", \
+                        type = int, \
+                        dest = "checkpoint_every", \
+                        default = None, \
+                        help = checkpoint_helpstr)
+
+    resume_helpstr = \
+        "Resume from existing partial results (see the --*-partial " \
+        "options), analyzing only the frames they do not cover yet " \
+        "(e.g. after a crash, or when the trajectory has been extended)"
+    parser.add_argument("--resume", \
+                        action = "store_true", \
+                        dest = "resume", \
+                        help = resume_helpstr)
+
     #------------------------------ Analyses -----------------------------#
 
     b_helpstr = "Analyze salt-bridges"
@@ -138,7 +370,8 @@ def main():
 
     hcgraph_helpstr = \
         "Name of the file where to store adjacency matrix " \
-        "for interaction graph (hydrophobic contacts)"
+        "for interaction graph (hydrophobic contacts); the compressed sparse " \
+        "format is used if the name ends in .npz"
     parser.add_argument("--hc-graph", \
                         action = "store", \
                         dest = "hc_graph", \
@@ -146,6 +379,17 @@ def main():
                         default = None, \
                         help = hcgraph_helpstr)
 
+    hcpartial_helpstr = \
+        "Name of the file where to store the raw counts " \
+        "as partial results (.npz), to be merged later with " \
+        "'pyinteraph merge'"
+    parser.add_argument("--hc-partial", \
+                        action = "store", \
+                        type = str, \
+                        dest = "hc_partial", \
+                        default = None, \
+                        help = hcpartial_helpstr)
+
     #---------------------------- Salt bridges ---------------------------#
 
     sbco_default = 4.5
@@ -181,7 +425,8 @@ def main():
 
     sbgraph_helpstr = \
         "Name of the file where to store adjacency matrix " \
-        "for interaction graph (salt bridges)"
+        "for interaction graph (salt bridges); the compressed sparse " \
+        "format is used if the name ends in .npz"
     parser.add_argument("--sb-graph", \
                         action = "store", \
                         type = str, \
@@ -189,7 +434,18 @@ def main():
                         default = None, \
                         help = sbgraph_helpstr)
 
-    sbcgfile_default = pkg_resources.resource_filename('pyinteraph', "charged_groups.ini")
+    sbpartial_helpstr = \
+        "Name of the file where to store the raw counts " \
+        "as partial results (.npz), to be merged later with " \
+        "'pyinteraph merge'"
+    parser.add_argument("--sb-partial", \
+                        action = "store", \
+                        type = str, \
+                        dest = "sb_partial", \
+                        default = None, \
+                        help = sbpartial_helpstr)
+
+    sbcgfile_default = get_data_fname("charged_groups.ini")
     sbcgfile_helpstr = "Default charged groups file (default: {:s})"
     parser.add_argument("--sb-cg-file", \
                         action = "store", \
@@ -246,7 +502,8 @@ def main():
 
     hbgraph_helpstr = \
         "Name of the file where to store adjacency matrix " \
-        "for interaction graph (hydrogen bonds)"
+        "for interaction graph (hydrogen bonds); the compressed sparse " \
+        "format is used if the name ends in .npz"
     parser.add_argument("--hb-graph", \
                         action = "store", \
                         type = str, \
@@ -254,6 +511,17 @@ def main():
                         default = None, \
                         help = hbgraph_helpstr)
 
+    hbpartial_helpstr = \
+        "Name of the file where to store the raw counts " \
+        "as partial results (.npz), to be merged later with " \
+        "'pyinteraph merge'"
+    parser.add_argument("--hb-partial", \
+                        action = "store", \
+                        type = str, \
+                        dest = "hb_partial", \
+                        default = None, \
+                        help = hbpartial_helpstr)
+
     hbperco_default = 0.0
     hbperco_helpstr = \
         "Minimum persistence for hydrogen bonds (default: {:f})"
@@ -264,11 +532,13 @@ def main():
                         default = hbperco_default, \
                         help = hbperco_helpstr.format(hbperco_default))
 
-    hbclass_choices = ["all", "mc-mc", "mc-sc", "sc-sc", "custom"]
+    hbclass_choices = ["all", "mc-mc", "mc-sc", "sc-sc", "custom", "each"]
     hbclass_default = "all"
     hbclass_helpstr = \
         "Class of hydrogen bonds to analyze. Accepted classes are {:s} " \
-        "(default: {:s})"
+        "(default: {:s}). 'each' analyzes all, mc-mc, mc-sc and sc-sc " \
+        "in a single pass, adding the class to the names of the " \
+        "output files (e.g. hydrogen-bonds_mc-mc.dat)"
     parser.add_argument("--hb-class", \
                         action = "store", \
                         type = str, \
@@ -279,7 +549,7 @@ def main():
                                 ", ".join(hbclass_choices), \
                                 hbclass_default))
 
-    hbadfile_default = pkg_resources.resource_filename('pyinteraph', "hydrogen_bonds.ini")
+    hbadfile_default = get_data_fname("hydrogen_bonds.ini")
     hbadfile_helpstr = \
         "File defining hydrogen bonds donor and acceptor atoms " \
         "(default: {:s})"
@@ -308,7 +578,7 @@ def main():
 
     #----------------------------- Potential -----------------------------#
 
-    kbpff_default = pkg_resources.resource_filename('pyinteraph', "ff.S050.bin64")
+    kbpff_default = get_data_fname("ff.S050.bin64")
     kbpff_helpstr = "Statistical potential definition file (default: {:s})"
     parser.add_argument("--kbp-ff", "--force-field", \
                         action = "store", \
@@ -317,7 +587,7 @@ def main():
                         default = kbpff_default, \
                         help = kbpff_helpstr.format(kbpff_default))
 
-    kbpatom_default = pkg_resources.resource_filename('pyinteraph', "kbp_atomlist")
+    kbpatom_default = get_data_fname("kbp_atomlist")
     kbpatom_helpstr = \
         "Ordered, force-field specific list of atom names (default: {:s})"
     parser.add_argument("--kbp-atomlist", \
@@ -340,7 +610,8 @@ def main():
 
     kbpgraph_helpstr = \
         "Name of the file where to store adjacency matrix " \
-        "for interaction graph (statistical potential)"
+        "for interaction graph (statistical potential); the compressed sparse " \
+        "format is used if the name ends in .npz"
     parser.add_argument('--kbp-graph', \
                         action = "store", \
                         type = str, \
@@ -348,6 +619,17 @@ def main():
                         default = None, \
                         help = kbpgraph_helpstr)
 
+    kbppartial_helpstr = \
+        "Name of the file where to store the raw counts (sums of scores) " \
+        "as partial results (.npz), to be merged later with " \
+        "'pyinteraph merge'"
+    parser.add_argument("--kbp-partial", \
+                        action = "store", \
+                        type = str, \
+                        dest = "kbp_partial", \
+                        default = None, \
+                        help = kbppartial_helpstr)
+
     kbpkbt_default = 1.0
     kbpkbt_helpstr = \
         "kb*T value used in the inverse-Boltzmann relation " \
@@ -362,24 +644,31 @@ def main():
     #---------------------------- Miscellanea ----------------------------#
 
     ff_masses_dir = "ff_masses"
-    masses_dir = pkg_resources.resource_filename('pyinteraph', ff_masses_dir)
-
-    masses_files = os.listdir(masses_dir)
+    masses_dir = get_data_fname(ff_masses_dir)
 
     ffmasses_default = "charmm27"
     ffmasses_helpstr = \
         "Force field to be used (for masses calculation only). " \
-        "Accepted force fields are {:s} (default: {:s})"
+        "Accepted force fields are those in {:s} (default: {:s})"
     parser.add_argument("--ff-masses", \
                         action = "store", \
                         type = str, \
-                        choices = masses_files, 
                         dest = "ffmasses", \
                         default = ffmasses_default, \
                         help = ffmasses_helpstr.format(\
-                                ", ".join(masses_files), \
+                                masses_dir, \
                                 ffmasses_default))
 
+    profile_helpstr = \
+        "Write the wall and CPU time spent in each stage of the " \
+        "analyses, and their frames per second, to this JSON file"
+    parser.add_argument("--profile", \
+                        action = "store", \
+                        type = str, \
+                        dest = "profile", \
+                        default = None, \
+                        help = profile_helpstr)
+
     v_helpstr = "Verbose mode"
     parser.add_argument("-v", "--verbose", \
                         action = "store_true", \
@@ -405,7 +694,12 @@ def main():
     # input files
     top = args.top
     trj = args.trj
+    nprocs = args.nprocs
     ref = args.ref
+    write_cache = args.write_cache
+    cache_file = args.coords_cache
+    checkpoint_every = args.checkpoint_every
+    resume = args.resume
     # hydrophobic contacts
     do_hc = args.do_hc
     if type(args.hc_reslist) is str:
@@ -417,6 +711,7 @@ def main():
     hc_co = args.hc_co
     hc_perco = args.hc_perco
     hc_dat = args.hc_dat
+    hc_partial = args.hc_partial
     # salt bridges
     do_sb = args.do_sb
     cgs_file = args.cgs_file
@@ -425,6 +720,7 @@ def main():
     sb_co = args.sb_co
     sb_perco = args.sb_perco
     sb_dat = args.sb_dat
+    sb_partial = args.sb_partial
     # hydrogen bonds
     do_hb = args.do_hb
     hbs_file = args.hbs_file
@@ -436,6 +732,7 @@ def main():
     hb_perco = args.hb_perco
     hb_angle = args.hb_angle
     hb_dat = args.hb_dat
+    hb_partial = args.hb_partial
     # potential
     do_kbp = args.do_kbp
     kbp_atomlist = args.kbp_atomlist
@@ -443,56 +740,101 @@ def main():
     kbp_ff = args.kbp_ff
     kbp_kbt = args.kbp_kbt
     kbp_dat = args.kbp_dat
+    kbp_partial = args.kbp_partial
+    # Residue list for potential calculation - all canonical but GLY
+    kbp_reslist = \
+        ["ALA", "ARG", "ASN", "ASP", "CYS", "GLN", "GLU", "HIS", \
+         "ILE", "LEU", "LYS", "MET", "PHE", "PRO", "SER", "THR", \
+         "TRP", "TYR", "VAL"]
     # miscellanea
     ffmasses = os.path.join(masses_dir, args.ffmasses)
+    profile = args.profile
+    if profile:
+        li.enable_profiling()
 
 
     ############################ CHECK INPUTS #############################
 
-    # top and trj must be present
-    if not top or not trj:
+    # the force field must be one of those available
+    if not os.path.isfile(ffmasses):
+        masses_files = sorted(os.listdir(masses_dir))
+        logstr = \
+            f"Force field {args.ffmasses} not found. Accepted force " \
+            f"fields are {', '.join(masses_files)}."
+        log.error(logstr)
+        exit(1)
+    # top and trj (or a coordinates cache) must be present
+    if not top or not (trj or cache_file):
         log.error("Topology and trajectory are required.")
         exit(1)
+    # the cache is either read or written
+    if cache_file and write_cache:
+        log.error("A coordinates cache cannot be both read and written.")
+        exit(1)
+    # replicas are read from their trajectories
+    trjs = None
+    if trj and len(trj) > 1:
+        if cache_file or write_cache:
+            log.error("Coordinates caches do not support multiple " \
+                      "trajectories.")
+            exit(1)
+        trjs = trj
+    # checkpoints are the partial results of a single trajectory
+    if checkpoint_every or resume:
+        if trjs:
+            log.error("Checkpoints do not support multiple trajectories.")
+            exit(1)
+        if checkpoint_every is not None and checkpoint_every < 1:
+            log.error("Checkpoints must be at least one frame apart.")
+            exit(1)
+        partials = [(do_hc, hc_partial), (do_sb, sb_partial), \
+                    (do_hb, hb_partial), (do_kbp, kbp_partial)]
+        if not any([do and partial for do, partial in partials]):
+            log.error("Checkpoints require the partial results files " \
+                      "of the requested analyses.")
+            exit(1)
+    # hydrogen bonds are always computed on the trajectory
+    if do_hb and not trj:
+        log.error("The hydrogen bonds analysis requires a trajectory.")
+        exit(1)
     # if no reference, topology is reference
     if not ref:
         ref = top
         log.info("Using topology as reference structure.")
     # Load systems
-    try:
-        pdb = mda.Universe(ref)
-        uni = mda.Universe(top, trj)
-    except ValueError:
-        logstr = \
-            "Could not read one of the input files, or trajectory " \
-            "and topology are not compatible."
-        log.error(logstr)
-        exit(1)
-
-
-    ######################## HYDROPHOBIC CONTACTS #########################
-
-    if do_hc:
-        fmfunc = None if not hc_graph else li.calc_sc_fullmatrix
-        str_out, hc_mat_out = li.do_interact(li.generate_sc_identifiers,
-                                             pdb = pdb,
-                                             uni = uni,
-                                             co = hc_co, 
-                                             perco = hc_perco,
-                                             ffmasses = ffmasses, 
-                                             fullmatrixfunc = fmfunc,
-                                             mindist = False,
-                                             reslist = hc_reslist)
-
-        # Save .dat
-        with open(hc_dat, "w") as out:
-            out.write(str_out)
-        # Save .mat (if available)
-        if hc_mat_out is not None:
-            np.savetxt(hc_graph, hc_mat_out, fmt = "%.1f")
-
-
-    ############################ SALT BRIDGES #############################
-
+    with li.profile_stage("topology"):
+        import MDAnalysis as mda
+        try:
+            pdb = mda.Universe(ref)
+            if trj:
+                # topology and selections are built on the first replica
+                uni = mda.Universe(top, trj[0])
+            else:
+                uni = mda.Universe(top)
+        except ValueError:
+            logstr = \
+                "Could not read one of the input files, or trajectory " \
+                "and topology are not compatible."
+            log.error(logstr)
+            exit(1)
+    # identifiers of the graph nodes, stored in graph files
+    graph_ids = gio.get_residue_identifiers(pdb.residues)
+    # load the coordinates cache
+    coords_cache = None
+    if cache_file:
+        try:
+            coords_cache = li.load_coords_cache(cache_file)
+        except (IOError, ValueError):
+            logstr = f"Could not read the coordinates cache {cache_file}."
+            log.error(logstr, exc_info = True)
+            exit(1)
+        if coords_cache.indices[-1] >= len(uni.atoms):
+            logstr = \
+                f"The coordinates cache {cache_file} is not " \
+                f"compatible with the topology."
+            log.error(logstr)
+            exit(1)
+    # parse the charged groups file
     if do_sb:
         try:
             cgs = li.parse_cgs_file(cgs_file)
@@ -506,7 +848,86 @@ def main():
                 f"Are there any inconsistencies?"
             log.error(logstr, exc_info = True)
             exit(1)
-        
+
+
+    ######################### COORDINATES CACHE ###########################
+
+    if write_cache:
+        # atom selections needed by the requested analyses
+        cache_sels = []
+        if do_hc:
+            cache_sels.extend(\
+                li.generate_sc_identifiers(pdb = pdb,
+                                           uni = uni,
+                                           reslist = hc_reslist)[2])
+        if do_sb:
+            # identifiers generation modifies the charged groups
+            cache_sels.extend(\
+                li.generate_cg_identifiers(pdb = pdb,
+                                           uni = uni,
+                                           cgs = copy.deepcopy(cgs))[2])
+        if do_kbp:
+            cache_sels.extend(\
+                li.generate_kbp_selections(\
+                    kbp_atomlist = li.parse_atomlist(kbp_atomlist),
+                    residues_list = kbp_reslist,
+                    sparses = li.parse_sparse(kbp_ff),
+                    uni = uni)[1])
+        if do_hb:
+            log.info("Hydrogen bonds will be computed on the trajectory.")
+        if not cache_sels:
+            log.error("No atoms to be cached for the requested analyses.")
+            exit(1)
+        with li.profile_stage("coords_cache"):
+            coords_cache = li.write_coords_cache(uni = uni,
+                                                 selections = cache_sels,
+                                                 fname = write_cache)
+
+
+    ######################## HYDROPHOBIC CONTACTS #########################
+
+    if do_hc:
+        fmfunc = None if not hc_graph else li.calc_sc_fullmatrix
+        with li.profile_stage("hc"):
+            results = li.do_interact(li.generate_sc_identifiers,
+                                     pdb = pdb,
+                                     uni = uni,
+                                     co = hc_co, 
+                                     perco = hc_perco,
+                                     ffmasses = ffmasses, 
+                                     fullmatrixfunc = fmfunc,
+                                     mindist = False,
+                                     coords_cache = coords_cache,
+                                     trjs = trjs,
+                                     nprocs = nprocs,
+                                     partial_fname = hc_partial,
+                                     checkpoint_every = checkpoint_every,
+                                     resume = resume,
+                                     as_records = True,
+                                     reslist = hc_reslist)
+            records, hc_mat_out = results[:2]
+
+            with li.profile_stage("write"):
+                # Save .dat
+                with open(hc_dat, "w") as out:
+                    li.write_records(records, out)
+                # Save .mat (if available)
+                metadata = get_graph_metadata("hc")
+                if hc_mat_out is not None:
+                    gio.save_graph(hc_graph, \
+                                   hc_mat_out, \
+                                   fmt = "%.1f", \
+                                   identifiers = graph_ids, \
+                                   metadata = metadata)
+                # Save per-replica results
+                if trjs:
+                    write_replicas(results[2], hc_dat, hc_graph, "%.1f", \
+                                   graph_ids, metadata)
+
+
+    ############################ SALT BRIDGES #############################
+
+    if do_sb:
         if sb_mode == "same_charge":
             sb_mode = "same"
         elif sb_mode == "different_charge":
@@ -515,23 +936,42 @@ def main():
             sb_mode = "both"
 
         fmfunc = None if not sb_graph else li.calc_cg_fullmatrix
-        str_out, sb_mat_out = li.do_interact(li.generate_cg_identifiers,
-                                             pdb = pdb,
-                                             uni = uni,
-                                             co = sb_co, 
-                                             perco = sb_perco,
-                                             ffmasses = ffmasses, 
-                                             fullmatrixfunc = fmfunc, 
-                                             mindist = True,
-                                             mindist_mode = sb_mode,
-                                             cgs = cgs)
-
-        # Save .dat
-        with open(sb_dat, "w") as out:
-            out.write(str_out)
-        # Save .mat (if available)
-        if sb_mat_out is not None:
-            np.savetxt(sb_graph, sb_mat_out, fmt = "%.1f")
+        with li.profile_stage("sb"):
+            results = li.do_interact(li.generate_cg_identifiers,
+                                     pdb = pdb,
+                                     uni = uni,
+                                     co = sb_co, 
+                                     perco = sb_perco,
+                                     ffmasses = ffmasses, 
+                                     fullmatrixfunc = fmfunc, 
+                                     mindist = True,
+                                     mindist_mode = sb_mode,
+                                     coords_cache = coords_cache,
+                                     trjs = trjs,
+                                     nprocs = nprocs,
+                                     partial_fname = sb_partial,
+                                     checkpoint_every = checkpoint_every,
+                                     resume = resume,
+                                     as_records = True,
+                                     cgs = cgs)
+            records, sb_mat_out = results[:2]
+
+            with li.profile_stage("write"):
+                # Save .dat
+                with open(sb_dat, "w") as out:
+                    li.write_records(records, out)
+                # Save .mat (if available)
+                metadata = get_graph_metadata("sb")
+                if sb_mat_out is not None:
+                    gio.save_graph(sb_graph, \
+                                   sb_mat_out, \
+                                   fmt = "%.1f", \
+                                   identifiers = graph_ids, \
+                                   metadata = metadata)
+                # Save per-replica results
+                if trjs:
+                    write_replicas(results[2], sb_dat, sb_graph, "%.1f", \
+                                   graph_ids, metadata)
 
 
     ########################### HYDROGEN BONDS ############################
@@ -576,6 +1016,23 @@ def main():
             hb_group1 = mc_sel
             hb_group2 = sc_sel
 
+        # all the classes are found among the protein hydrogen bonds
+        hb_classes = None
+        if hb_class == "each":
+            hb_group1 = "protein"
+            hb_group2 = "protein"
+            hb_classes = collections.OrderedDict(\
+                [("all", ("protein", "protein")), \
+                 ("mc-mc", (mc_sel, mc_sel)), \
+                 ("mc-sc", (mc_sel, sc_sel)), \
+                 ("sc-sc", (sc_sel, sc_sel))])
+            if hb_partial is not None:
+                errstr = \
+                    "Partial results are not supported for hydrogen " \
+                    "bond class 'each'."
+                log.error(errstr)
+                exit(1)
+
         # check if selection 1 is valid
         try:
             uni.select_atoms(hb_group1)
@@ -602,51 +1059,98 @@ def main():
 
         do_fullmatrix = True if hb_graph else False
         perresidue = False    
-        str_out, hb_mat_out = li.do_hbonds(sel1 = hb_group1, \
-                                           sel2 = hb_group2, \
-                                           pdb = pdb, \
-                                           uni = uni, \
-                                           distance = hb_co, \
-                                           angle = hb_angle, \
-                                           perco = hb_perco, \
-                                           do_fullmatrix = do_fullmatrix, \
-                                           other_hbs = hbs, \
-                                           perresidue = perresidue)                                    
-
-        # Save .dat
-        with open(hb_dat, "w") as out:
-            out.write(str_out)
-        # Save .mat (if available)
-        if hb_mat_out is not None:
-            np.savetxt(hb_graph, hb_mat_out, fmt = "%.1f")
+        with li.profile_stage("hb"):
+            results = li.do_hbonds(sel1 = hb_group1, \
+                                   sel2 = hb_group2, \
+                                   pdb = pdb, \
+                                   uni = uni, \
+                                   distance = hb_co, \
+                                   angle = hb_angle, \
+                                   perco = hb_perco, \
+                                   do_fullmatrix = do_fullmatrix, \
+                                   other_hbs = hbs, \
+                                   perresidue = perresidue, \
+                                   trjs = trjs, \
+                                   nprocs = nprocs, \
+                                   partial_fname = hb_partial, \
+                                   checkpoint_every = checkpoint_every, \
+                                   resume = resume, \
+                                   as_records = True, \
+                                   classes = hb_classes)
+            # results for each class of hydrogen bonds
+            if hb_classes is None:
+                results = {None : results}
+
+            with li.profile_stage("write"):
+                for name, class_results in results.items():
+                    records, hb_mat_out = class_results[:2]
+                    class_dat = get_class_fname(hb_dat, name)
+                    class_graph = get_class_fname(hb_graph, name)
+                    # Save .dat
+                    with open(class_dat, "w") as out:
+                        li.write_records(records, out)
+                    # Save .mat (if available)
+                    metadata = get_graph_metadata("hb", \
+                                                  hb_class = name or hb_class)
+                    if hb_mat_out is not None:
+                        gio.save_graph(class_graph, \
+                                       hb_mat_out, \
+                                       fmt = "%.1f", \
+                                       identifiers = graph_ids, \
+                                       metadata = metadata)
+                    # Save per-replica results
+                    if trjs:
+                        write_replicas(class_results[2], class_dat, \
+                                       class_graph, "%.1f", graph_ids, \
+                                       metadata)
 
 
     ######################## STATISTICAL POTENTIAL ########################
 
     if do_kbp:
-        # Residue list for potential calculation - all canonical but GLY
-        kbp_reslist = \
-            ["ALA", "ARG", "ASN", "ASP", "CYS", "GLN", "GLU", "HIS", \
-             "ILE", "LEU", "LYS", "MET", "PHE", "PRO", "SER", "THR", \
-             "TRP", "TYR", "VAL"]
-        
         kbp_atomlist = li.parse_atomlist(kbp_atomlist)
         do_fullmatrix = True if kbp_graph else False
-        str_out, kbp_mat_out = li.do_potential(kbp_atomlist = kbp_atomlist, \
-                                               residues_list = kbp_reslist, \
-                                               potential_file = kbp_ff, \
-                                               uni = uni, \
-                                               pdb = pdb, \
-                                               do_fullmatrix = do_fullmatrix, \
-                                               kbT = kbp_kbt, \
-                                               seq_dist_co = 0)
-
-        # Save .dat
-        with open(kbp_dat, "w") as out:
-            out.write(str_out)
-        # Save .mat (if available)
-        if kbp_mat_out is not None:
-            np.savetxt(kbp_graph, kbp_mat_out, fmt = "%.3f")
+        with li.profile_stage("kbp"):
+            results = li.do_potential(kbp_atomlist = kbp_atomlist, \
+                                      residues_list = kbp_reslist, \
+                                      potential_file = kbp_ff, \
+                                      uni = uni, \
+                                      pdb = pdb, \
+                                      do_fullmatrix = do_fullmatrix, \
+                                      kbT = kbp_kbt, \
+                                      seq_dist_co = 0, \
+                                      coords_cache = coords_cache, \
+                                      trjs = trjs, \
+                                      nprocs = nprocs, \
+                                      partial_fname = kbp_partial, \
+                                      checkpoint_every = checkpoint_every, \
+                                      resume = resume, \
+                                      as_records = True)
+            records, kbp_mat_out = results[:2]
+
+            with li.profile_stage("write"):
+                # Save .dat
+                with open(kbp_dat, "w") as out:
+                    li.write_records(records, out)
+                # Save .mat (if available)
+                metadata = get_graph_metadata("kbp")
+                if kbp_mat_out is not None:
+                    gio.save_graph(kbp_graph, \
+                                   kbp_mat_out, \
+                                   fmt = "%.3f", \
+                                   identifiers = graph_ids, \
+                                   metadata = metadata)
+                # Save per-replica results
+                if trjs:
+                    write_replicas(results[2], kbp_dat, kbp_graph, "%.3f", \
+                                   graph_ids, metadata)
+
+
+    ############################### PROFILE ###############################
+
+    if profile:
+        with open(profile, "w") as out:
+            json.dump(li.get_profile_report(), out, indent = 4)
 
 if __name__ == "__main__":
     main()
@@ -20,7 +20,7 @@ setup(name = 'pyinteraph',
                          "parse_masses = pyinteraph.parse_masses:main" ] 
                    },
       install_requires=["biopython",
-                        "MDAnalysis==1.0.0",
+                        "MDAnalysis>=1.0.0",
                         "numpy",
                         "matplotlib",
                         "networkx",
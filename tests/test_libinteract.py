@@ -1,7 +1,9 @@
 import pytest
 import numpy as np
+import io
 import os
 from libinteract import libinteract as li
+from libinteract import innerloops as il
 from numpy.testing import *
 import MDAnalysis as mda
 import pkg_resources
@@ -151,6 +153,16 @@ def charged_groups(cg_file):
 def hb_don_acc(hb_file):
     return li.parse_hbs_file(hb_file)
 
+@pytest.fixture
+def hc_coords_cache(simulation, hc_residues_list, tmpdir):
+    identifiers, idxs, sels = \
+        li.generate_sc_identifiers(pdb = simulation['pdb'],
+                                   uni = simulation['uni'],
+                                   reslist = hc_residues_list)
+    fname = str(tmpdir.join('cache.npy'))
+    li.write_coords_cache(simulation['uni'], sels, fname)
+    return li.load_coords_cache(fname)
+
 class TestSparse:
     def test_Sparse_constructor(self, sparse_list, sparse_obj):
         data = np.array([   sparse_obj.r1,
@@ -236,6 +248,28 @@ def test_do_interact_sb(simulation, charged_groups, ref_sb_graph, ref_sb):
     for i, s in enumerate(split_str):
         assert(s == ref_sb[i].strip())
 
+def test_do_interact_sb_records(simulation, charged_groups, ref_sb):
+    records, sb_mat_out = li.do_interact(li.generate_cg_identifiers,
+                                         pdb = simulation['pdb'],
+                                         uni = simulation['uni'],
+                                         co = 4.5,
+                                         perco = 0,
+                                         ffmasses = 'charmm27',
+                                         fullmatrixfunc = None,
+                                         mindist = True,
+                                         mindist_mode = 'diff',
+                                         as_records = True,
+                                         cgs = charged_groups)
+
+    assert(len(records) == len(ref_sb))
+    assert((records.persistence > 0).all())
+    assert((records.index1 >= records.index2).all())
+    out = io.StringIO()
+    li.write_records(records, out)
+    split_str = out.getvalue().split("\n")[:-1]
+    for i, s in enumerate(split_str):
+        assert(s == ref_sb[i].strip())
+
 def test_do_interact_hc(simulation, hc_residues_list, ref_hc_graph, ref_hc):
     str_out, hc_mat_out = li.do_interact(li.generate_sc_identifiers,
                                      pdb = simulation['pdb'],
@@ -273,3 +307,178 @@ def test_do_interact_hb(simulation, hb_don_acc, ref_hb, ref_hb_graph):
     for i, s in enumerate(split_str):
         assert(s == sorted_ref_hb[i].strip())
 
+
+def test_do_hbonds_classes(simulation, hb_don_acc):
+    mc = 'backbone or name H'
+    sc = 'protein and not (backbone or name H)'
+    classes = {'mc-mc' : (mc, mc), 'mc-sc' : (mc, sc), 'sc-sc' : (sc, sc)}
+    kwargs = dict(pdb = simulation['pdb'],
+                  uni = simulation['uni'],
+                  distance = 3.5,
+                  angle = 120.0,
+                  do_fullmatrix = True,
+                  other_hbs = hb_don_acc)
+    results = li.do_hbonds(sel1 = 'protein', sel2 = 'protein',
+                           classes = classes, **kwargs)
+    assert(list(results) == list(classes))
+    for name, (sel1, sel2) in classes.items():
+        str_out, hb_mat_out = li.do_hbonds(sel1 = sel1, sel2 = sel2,
+                                           **kwargs)
+        assert(results[name][0] == str_out)
+        assert_equal(results[name][1], hb_mat_out)
+
+
+def test_cell_pairs():
+    rng = np.random.RandomState(0)
+    coords1 = rng.uniform(0.0, 30.0, (300, 3))
+    coords2 = rng.uniform(0.0, 30.0, (400, 3))
+    pairs = il.run_cell_pairs(coords1, coords2, 3.0)
+    dists = np.linalg.norm(coords1[:,None,:] - coords2[None,:,:], axis=2)
+    assert(set(map(tuple, pairs.tolist())) == \
+           set(zip(*np.nonzero(dists <= 3.0))))
+
+def test_pairs_counter():
+    counter = li.PairsCounter(capacity = 4)
+    counter.add(np.arange(10))
+    counter.add(np.array([7, 3, 100]))
+    keys, counts = counter.items()
+    assert_equal(keys, list(range(10)) + [100])
+    assert_equal(counts, [1, 1, 1, 2, 1, 1, 1, 2, 1, 1, 1])
+
+def test_coords_cache(simulation, hc_coords_cache):
+    uni = simulation['uni']
+    atoms = uni.atoms[hc_coords_cache.indices]
+    assert(len(hc_coords_cache) == len(uni.trajectory))
+    for ts_i, ts in enumerate(uni.trajectory):
+        assert_equal(hc_coords_cache.coords[ts_i], atoms.positions)
+
+def test_coords_cache_missing_atoms(simulation, hc_coords_cache):
+    with pytest.raises(ValueError):
+        hc_coords_cache.get_columns(simulation['uni'].select_atoms("backbone"))
+
+def test_do_interact_hc_cache(simulation, hc_residues_list, hc_coords_cache, ref_hc_graph, ref_hc):
+    str_out, hc_mat_out = li.do_interact(li.generate_sc_identifiers,
+                                     pdb = simulation['pdb'],
+                                     uni = simulation['uni'],
+                                     co = 5.0, 
+                                     perco = 0.0,
+                                     ffmasses = 'charmm27', 
+                                     fullmatrixfunc = li.calc_sc_fullmatrix, 
+                                     reslist = hc_residues_list,
+                                     mindist = False,
+                                     coords_cache = hc_coords_cache)
+    assert_almost_equal(hc_mat_out, ref_hc_graph, decimal=1)
+    split_str = str_out.split("\n")[:-1]
+    for i, s in enumerate(split_str):
+        assert(s == ref_hc[i].strip())
+
+def test_do_interact_sb_replicas(simulation, data_files, charged_groups, ref_sb_graph, ref_sb):
+    str_out, sb_mat_out, replicas = \
+        li.do_interact(li.generate_cg_identifiers,
+                       pdb = simulation['pdb'],
+                       uni = simulation['uni'],
+                       co = 4.5,
+                       perco = 0,
+                       ffmasses = 'charmm27',
+                       fullmatrixfunc = li.calc_cg_fullmatrix,
+                       mindist = True,
+                       mindist_mode = 'diff',
+                       trjs = [data_files['xtc'], data_files['xtc']],
+                       cgs = charged_groups)
+
+    assert(len(replicas) == 2)
+    for replica_str_out, replica_mat_out in replicas:
+        assert(replica_str_out == str_out)
+        assert_equal(replica_mat_out, sb_mat_out)
+    assert_almost_equal(sb_mat_out, ref_sb_graph, decimal=1)
+    split_str = str_out.split("\n")[:-1]
+    for i, s in enumerate(split_str):
+        assert(s == ref_sb[i].strip())
+
+def test_do_interact_sb_partial(simulation, charged_groups, ref_sb_graph, ref_sb, tmpdir):
+    partial_fname = str(tmpdir.join("sb.npz"))
+    str_out, sb_mat_out = \
+        li.do_interact(li.generate_cg_identifiers,
+                       pdb = simulation['pdb'],
+                       uni = simulation['uni'],
+                       co = 4.5,
+                       perco = 0,
+                       ffmasses = 'charmm27',
+                       fullmatrixfunc = li.calc_cg_fullmatrix,
+                       mindist = True,
+                       mindist_mode = 'diff',
+                       partial_fname = partial_fname,
+                       cgs = charged_groups)
+
+    partial = li.load_partial(partial_fname)
+    assert(partial['kind'] == 'sb')
+    assert(partial['counts'].dtype == np.int64)
+    assert(partial['fingerprint'] == \
+           li.get_topology_fingerprint(simulation['uni']))
+    # merging the same chunk twice doubles the counts only
+    merged = li.merge_partials([partial, partial])
+    assert(merged['numframes'] == 2*partial['numframes'])
+    merged_str_out, merged_mat_out = \
+        li.format_partial(merged,
+                          pdb = simulation['pdb'],
+                          uni = simulation['uni'],
+                          do_fullmatrix = True)
+    assert(merged_str_out == str_out)
+    assert_equal(merged_mat_out, sb_mat_out)
+    # partial results of different analyses cannot be merged
+    other = dict(partial, params = dict(partial['params'], co = 5.0))
+    with pytest.raises(ValueError):
+        li.merge_partials([partial, other])
+
+def test_do_interact_hc_resume(simulation, hc_residues_list, hc_coords_cache, ref_hc_graph, ref_hc, tmpdir):
+    partial_fname = str(tmpdir.join("hc.npz"))
+    # the trajectory before being extended
+    short_cache = li.CoordinatesCache(hc_coords_cache.coords[:10],
+                                      hc_coords_cache.indices)
+    for coords_cache in (short_cache, hc_coords_cache):
+        str_out, hc_mat_out = \
+            li.do_interact(li.generate_sc_identifiers,
+                           pdb = simulation['pdb'],
+                           uni = simulation['uni'],
+                           co = 5.0,
+                           perco = 0.0,
+                           ffmasses = 'charmm27',
+                           fullmatrixfunc = li.calc_sc_fullmatrix,
+                           reslist = hc_residues_list,
+                           mindist = False,
+                           coords_cache = coords_cache,
+                           partial_fname = partial_fname,
+                           checkpoint_every = 7,
+                           resume = True)
+        partial = li.load_partial(partial_fname)
+        assert(partial['numframes'] == len(coords_cache))
+
+    assert_almost_equal(hc_mat_out, ref_hc_graph, decimal=1)
+    split_str = str_out.split("\n")[:-1]
+    for i, s in enumerate(split_str):
+        assert(s == ref_hc[i].strip())
+
+def test_profiling(simulation, hc_residues_list):
+    li.enable_profiling()
+    try:
+        with li.profile_stage("hc"):
+            li.do_interact(li.generate_sc_identifiers,
+                           pdb = simulation['pdb'],
+                           uni = simulation['uni'],
+                           co = 5.0,
+                           perco = 0.0,
+                           ffmasses = 'charmm27',
+                           reslist = hc_residues_list,
+                           mindist = False)
+        report = li.get_profile_report()
+    finally:
+        li.disable_profiling()
+
+    stages = dict([(s['stage'], s) for s in report['stages']])
+    numframes = len(simulation['uni'].trajectory)
+    for stage in ("hc", "hc/identifiers", "hc/gather", "hc/gather/read",
+                  "hc/com", "hc/kernel", "hc/assembly"):
+        assert(stage in stages)
+    assert(stages['hc']['frames'] == numframes)
+    assert(stages['hc/gather']['calls'] == numframes)
+    assert(li.get_profile_report() is None)
@@ -3,12 +3,15 @@
 
 import os
 import os.path
+import subprocess
+import sys
 import numpy as np
 import pytest
 from numpy.testing import assert_almost_equal, assert_equal
 
 from pyinteraph import filter_graph as fg
 from pyinteraph import graph_analysis as ga
+from pyinteraph import graph_io as gio
 
 
 ######################## MODULE-LEVEL FIXTURES ########################
@@ -108,6 +111,81 @@ class TestFilterGraph(object):
         assert_almost_equal(actual = seconddev,
                             desired = expected)
 
+    def test_clustsize_curve(self):
+        matrix = np.zeros((5, 5))
+        for i, j, p in [(0, 1, 80.0), (1, 2, 40.0), (3, 4, 40.0),
+                        (2, 3, 10.0)]:
+            matrix[i, j] = matrix[j, i] = p
+        values, sizes = fg.get_clustsize_curve(matrices = [matrix])
+        assert_equal(values, [80.0, 40.0, 10.0])
+        assert_equal(sizes, [2, 3, 5])
+        maxclustsizes = fg.get_maxclustsizes(matrices = [matrix],
+                                             interval = [0, 10, 50, 80])
+        assert_equal(maxclustsizes, [5, 3, 2, 1])
+
+    def test_run_batch(self, matrices_fnames, interval, p0, maxfev,
+                       tmpdir):
+        fnames = matrices_fnames + ["missing.dat"]
+        results = fg.run_batch(fnames = fnames,
+                               interval = interval,
+                               p0 = p0,
+                               maxfev = maxfev,
+                               nprocs = 2)
+        assert results[-1] is None
+        for fname, (maxclustsizes, args, flex) in zip(matrices_fnames,
+                                                      results):
+            matrices = fg.process_matrices(fnames = [fname])
+            assert_equal(maxclustsizes,
+                         fg.get_maxclustsizes(matrices = matrices,
+                                              interval = interval))
+        out_batch = str(tmpdir.join("batch.tsv"))
+        fg.write_batch(out_batch = out_batch,
+                       fnames = fnames,
+                       interval = interval,
+                       results = results)
+        with open(out_batch) as f:
+            lines = f.readlines()
+        assert len(lines) == len(fnames) + 1
+        assert len(lines[0].split("\t")) == 6 + len(interval)
+
+    def test_get_identifiers(self, matrices_fnames, tmpdir):
+        # files without identifiers are not compared
+        assert fg.get_identifiers(matrices_fnames) is None
+        matrix = np.zeros((3, 3))
+        fnames = [str(tmpdir.join(f"graph{i}.dat")) for i in range(3)]
+        for fname, identifiers in zip(fnames, (["A", "B", "C"],
+                                               ["A", "B", "C"],
+                                               ["C", "B", "A"])):
+            gio.save_graph(fname = fname,
+                           matrix = matrix,
+                           fmt = "%.1f",
+                           identifiers = identifiers)
+        assert_equal(fg.get_identifiers(matrices_fnames[:1] + fnames[:2]),
+                     ["A", "B", "C"])
+        with pytest.raises(ValueError):
+            fg.get_identifiers(fnames)
+
+    def test_write_dat_negative(self, tmpdir):
+        # energies, with edges below zero
+        first, second = np.zeros((3, 3)), np.zeros((3, 3))
+        first[0, 1] = first[1, 0] = -1.0
+        second[0, 1] = second[1, 0] = -3.0
+        second[1, 2] = second[2, 1] = -2.0
+        second[0, 2] = second[2, 0] = -7.0
+        out_dat = str(tmpdir.join("outmatrix.npz"))
+        fg.write_dat(matrices = [first, second],
+                     matrix_filter = -5.0,
+                     out_dat = out_dat)
+        expected = np.zeros((3, 3))
+        expected[[0, 1, 1, 2], [1, 0, 2, 1]] = 1.0
+        assert_equal(gio.load_graph(out_dat)[0], expected)
+        fg.write_dat(matrices = [first, second],
+                     matrix_filter = -5.0,
+                     out_dat = out_dat,
+                     weighted_union = True)
+        expected[[0, 1, 1, 2], [1, 0, 2, 1]] = [-1.0, -1.0, -2.0, -2.0]
+        assert_equal(gio.load_graph(out_dat)[0], expected)
+
     def test_perform_plotting(self, interval, maxclustsizes,
                               args, flex, results_dir):
         out_plot = os.path.join(results_dir, "test_plot.pdf")
@@ -136,6 +214,25 @@ class TestFilterGraph(object):
                             out_dat = out_dat,
                             weights = weights)
 
+    def test_write_dat_sparse(self, matrices_fnames, matrices,
+                              matrix_filter, tmpdir):
+        out_dat = str(tmpdir.join("outmatrix.npz"))
+        # matrices combined one at a time
+        fg.write_dat(matrices = fg.iter_sparse_matrices(matrices_fnames),
+                     matrix_filter = matrix_filter,
+                     out_dat = out_dat,
+                     weights = matrices_fnames[0])
+        edges = np.logical_or.reduce([m > matrix_filter for m in matrices])
+        assert_equal(gio.load_graph(out_dat)[0],
+                     np.where(edges, matrices[0], 0.0))
+        fg.write_dat(matrices = fg.iter_sparse_matrices(matrices_fnames),
+                     matrix_filter = matrix_filter,
+                     out_dat = out_dat,
+                     weighted_union = True)
+        maxmatrix = np.maximum.reduce(matrices)
+        assert_equal(gio.load_graph(out_dat)[0],
+                     np.where(edges, maxmatrix, 0.0))
+
 
 ######################## GRAPH ANALYSIS TESTS #########################
 
@@ -235,6 +332,20 @@ class TestGraphAnalysis(object):
                      {'A-144TRP'}, {'A-145THR'}, {'A-146ARG'}, {'A-148TYR'}, {'A-150SER'}]
         assert_equal(ccs, expected)
 
+    def test_graph_matrix(self, G, ccs, hubs, matrices_fnames, pdb_fname):
+        identifiers, A = ga.load_graph_matrix(fname = matrices_fnames[0],
+                                              pdb = pdb_fname)
+        assert_equal(identifiers, list(G.nodes()))
+        assert ga.get_num_edges(A) == G.number_of_edges()
+        assert_equal(ga.get_connected_components(G = A,
+                                                 identifiers = identifiers),
+                     ccs)
+        assert_equal(ga.get_hubs(G = A,
+                                 min_k = 3,
+                                 sorting = "descending",
+                                 identifiers = identifiers),
+                     hubs)
+
     def test_paths(self, paths):
         expected = [(['A-56ILE', 'A-69MET', 'A-92LEU'], 3, 97.4, 48.7),
                     (['A-56ILE', 'A-69MET', 'A-105ALA', 'A-92LEU'], 4, 93.4, 31.133333333333336),
@@ -245,6 +356,128 @@ class TestGraphAnalysis(object):
         print(paths)
         assert_equal(paths, expected)
 
+    @pytest.mark.parametrize("weight_by", ["length", "persistence"])
+    def test_kbest_paths(self, G, source, target, paths, weight_by):
+        kbest = list(ga.get_kbest_paths(G = G,
+                                        source = source,
+                                        target = target,
+                                        k = 3,
+                                        maxl = 3,
+                                        weight_by = weight_by))
+        assert len(kbest) == 3
+        assert all(path in paths for path in kbest)
+        if weight_by == "length":
+            assert_equal([path[1] for path in kbest], [3, 4, 4])
+        else:
+            # highest product of persistences first
+            assert_equal([path[0] for path in kbest],
+                         [path[0] for path in paths[:3]])
+
+    @pytest.mark.parametrize("weight_by", ["length", "persistence"])
+    def test_kbest_paths_cutoff(self, weight_by):
+        import networkx as nx
+        # only two paths of at most two edges between opposite
+        # corners of a square in a grid
+        G = nx.grid_2d_graph(6, 6)
+        nx.set_edge_attributes(G, 50.0, "weight")
+        kbest = list(ga.get_kbest_paths(G = G,
+                                        source = (0, 0),
+                                        target = (1, 1),
+                                        k = 5,
+                                        maxl = 2,
+                                        weight_by = weight_by))
+        assert_equal(sorted(path[0] for path in kbest),
+                     [[(0, 0), (0, 1), (1, 1)], [(0, 0), (1, 0), (1, 1)]])
+
+    def test_kbest_paths_skipped(self):
+        import networkx as nx
+        # the most persistent path is longer than the cut-off
+        G = nx.Graph()
+        G.add_weighted_edges_from([("s", "a", 100.0), ("a", "b", 100.0),
+                                   ("b", "t", 100.0), ("s", "b", 10.0),
+                                   ("a", "t", 10.0)])
+        for max_skipped, expected in [(None, False), (1, True)]:
+            kbest, truncated = ga.collect_generator(\
+                ga.get_kbest_paths(G = G,
+                                   source = "s",
+                                   target = "t",
+                                   k = 2,
+                                   maxl = 2,
+                                   weight_by = "persistence",
+                                   max_skipped = max_skipped))
+            assert truncated == expected
+            assert len(kbest) == (0 if truncated else 2)
+
+    def test_enumerate_paths(self, G, source, target, paths, tmpdir):
+        out_paths = str(tmpdir.join("paths.txt"))
+        numpaths, top = ga.enumerate_paths(G = G,
+                                           source = source,
+                                           target = target,
+                                           maxl = 3,
+                                           sort_paths_by = "cumulative_weight",
+                                           out_paths = out_paths,
+                                           top = 2,
+                                           nprocs = 2)
+        assert numpaths == len(paths)
+        assert_equal(top, paths[:2])
+        with open(out_paths) as f:
+            lines = f.readlines()[1:]
+        assert_equal(sorted(lines),
+                     sorted([ga.format_path_line(path) for path in paths]))
+        # no temporary files are left, even if the search fails
+        with pytest.raises(ValueError):
+            ga.enumerate_paths(G = G,
+                               source = source,
+                               target = target,
+                               maxl = 3,
+                               sort_paths_by = "unknown",
+                               out_paths = out_paths,
+                               nprocs = 2)
+        assert_equal(os.listdir(str(tmpdir)), ["paths.txt"])
+
+    def test_pairs_paths(self, G, identifiers, source, target, pdb_fname):
+        sources = ga.get_selection_nodes(selection = "resid 54 56",
+                                         identifiers = identifiers,
+                                         ref = pdb_fname)
+        assert_equal(sources, ["A-54VAL", source])
+        targets = ga.get_selection_nodes(selection = f"{target},A-2SER",
+                                         identifiers = identifiers)
+        pairs = ga.get_pairs_paths(G = G,
+                                   sources = sources,
+                                   targets = targets,
+                                   nprocs = 2)
+        assert_equal([pair[:2] for pair in pairs],
+                     [(s, t) for s in sources for t in targets])
+        # no paths to the isolated residue
+        assert_equal([pair[2] is None for pair in pairs],
+                     [False, True, False, True])
+        assert_equal(pairs[2][2],
+                     (["A-56ILE", "A-69MET", "A-92LEU"], 3, 97.4, 48.7))
+
+    def test_centrality(self, G):
+        import networkx as nx
+        nodes = list(G.nodes())
+        A = ga.get_csgraph(G = G, nodes = nodes)
+        nodes_bc, edges_bc, nsources = ga.get_betweenness(A = A,
+                                                          batchsize = 16,
+                                                          nprocs = 2)
+        assert nsources == len(nodes)
+        expected = nx.betweenness_centrality(G)
+        assert_almost_equal(nodes_bc, [expected[n] for n in nodes])
+        expected = nx.edge_betweenness_centrality(G)
+        assert_almost_equal([edges_bc[nodes.index(u), nodes.index(v)]
+                             for u, v in expected],
+                            list(expected.values()))
+        expected = nx.closeness_centrality(G)
+        assert_almost_equal(ga.get_closeness(A = A),
+                            [expected[n] for n in nodes])
+        # current-flow betweenness within the largest component
+        cc = max(nx.connected_components(G), key = len)
+        expected = nx.current_flow_betweenness_centrality(G.subgraph(cc))
+        current_flow = ga.get_current_flow(A = A)
+        assert_almost_equal([current_flow[nodes.index(n)] for n in cc],
+                            [expected[n] for n in cc])
+
     def test_get_resnum(self, resstring):
         return ga.get_resnum(resstring = resstring)
 
@@ -252,6 +485,55 @@ class TestGraphAnalysis(object):
         return ga.write_connected_components(ccs = ccs,
                                              outfile = None)
 
+    @pytest.mark.parametrize("ext", [".tsv", ".json"])
+    def test_write_tables(self, ccs, hubs, paths, tmpdir, ext):
+        fnames = [str(tmpdir.join(name + ext)) \
+                  for name in ("ccs", "hubs", "paths")]
+        ga.write_connected_components(ccs = ccs, outfile = fnames[0])
+        ga.write_hubs(hubs = hubs, outfile = fnames[1])
+        ga.write_paths(paths = paths, outfile = fnames[2])
+        if ext == ".json":
+            import json
+            tables = []
+            for fname in fnames:
+                with open(fname) as f:
+                    tables.append(json.load(f))
+            assert_equal([set(row["Residues"]) for row in tables[0]], ccs)
+            assert_equal([(row["Node"], row["k"]) for row in tables[1]],
+                         hubs)
+            assert_equal(tables[2][0]["Path"], paths[0][0])
+        else:
+            for fname, rows in zip(fnames, (ccs, hubs, paths)):
+                with open(fname) as f:
+                    assert len(f.readlines()) == len(rows) + 1
+
+    def test_graphs_batch(self, matrices_fnames, pdb_fname, ccs, hubs,
+                          tmpdir):
+        fnames = matrices_fnames + ["missing.dat"]
+        results = ga.run_graphs_batch(fnames = fnames,
+                                      pdb = pdb_fname,
+                                      nprocs = 2)
+        assert results[-1] is None
+        identifiers, numedges, sizes, hubs_k = results[0]
+        assert_equal(sizes, sorted([len(cc) for cc in ccs], reverse = True))
+        assert_equal(hubs_k, dict(hubs))
+        # the reference structure is read once, by the parent process
+        ref_identifiers = ga.get_reference_identifiers(pdb_fname)
+        assert_equal(ga.analyse_graph(fname = fnames[0],
+                                      ref_identifiers = ref_identifiers),
+                     results[0])
+        out_hubs = str(tmpdir.join("hubs.tsv"))
+        ga.write_hubs_batch(fnames = fnames,
+                            results = results,
+                            outfile = out_hubs)
+        with open(out_hubs) as f:
+            lines = [line.rstrip("\n").split("\t") for line in f]
+        assert_equal(lines[0], ["Node", "Frequency"] + matrices_fnames)
+        assert len(lines) == len(set(hubs_k) | set(results[1][3])) + 1
+        ga.write_components_batch(fnames = fnames,
+                                  results = results,
+                                  outfile = str(tmpdir.join("ccs.tsv")))
+
     def test_write_connected_components_pdb(self, identifiers, ccs, \
                                             pdb_fname, results_dir):
         components_pdb = os.path.join(results_dir, "test_ccs.pdb")
@@ -262,6 +544,25 @@ class TestGraphAnalysis(object):
                     components_pdb = components_pdb,
                     replace_bfac_func = ga.replace_bfac_column)
 
+    def test_write_annotated_pdbs(self, identifiers, pdb_fname, tmpdir):
+        vals = np.arange(len(identifiers)) + 0.5
+        fnames = [str(tmpdir.join(f"test_{i}.pdb")) for i in range(2)]
+        ga.write_annotated_pdbs(pdb = pdb_fname,
+                                annotations = {\
+                                    fnames[0] : {"bfactor" : vals},
+                                    fnames[1] : {"bfactor" : vals,
+                                                 "occupancy" : -vals}})
+        with open(pdb_fname) as f:
+            ref = f.readlines()
+        for fname in fnames:
+            with open(fname) as f:
+                lines = f.readlines()
+            assert len(lines) == len(ref)
+            atoms = [line for line in lines if line.startswith("ATOM")]
+            assert float(atoms[0][60:66]) == vals[0]
+            assert float(atoms[-1][60:66]) == vals[-1]
+        assert float(atoms[-1][54:60]) == -vals[-1]
+
     def test_write_hubs(self, hubs):
         return ga.write_hubs(hubs = hubs,
                              outfile = None)
@@ -287,3 +588,183 @@ class TestGraphAnalysis(object):
                                        paths = paths,
                                        fmt = "%.1f",
                                        where = results_dir)
+
+    def test_write_paths_edges(self, identifiers, G, paths, tmpdir):
+        fname = str(tmpdir.join("paths.npz"))
+        ga.write_paths_edges(identifiers = identifiers,
+                             G = G,
+                             paths = paths,
+                             fname = fname)
+        (path_ids, rows, cols, weights), ids, _ = gio.load_paths(fname)
+        assert_equal(ids, identifiers)
+        assert_equal(path_ids, [0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3])
+        assert_equal([ids[i] for i in rows[:2]], paths[0][0][:2])
+        assert_almost_equal(weights[:2].sum(), paths[0][2])
+        # the exported matrices are the same as those written directly
+        for where in ("edges", "direct"):
+            tmpdir.mkdir(where)
+        ga.export_paths_matrices(fname = fname,
+                                 fmt = "%.1f",
+                                 where = str(tmpdir.join("edges")))
+        ga.write_paths_matrices(identifiers = identifiers,
+                                G = G,
+                                paths = paths,
+                                fmt = "%.1f",
+                                where = str(tmpdir.join("direct")))
+        for num in range(1, len(paths)+1):
+            dat = f"path{num}.dat"
+            assert_equal(np.loadtxt(str(tmpdir.join("edges", dat))),
+                         np.loadtxt(str(tmpdir.join("direct", dat))))
+
+
+########################### GRAPH I/O TESTS ###########################
+
+class TestGraphIO(object):
+
+    #--------------------------- Fixtures ----------------------------#
+
+    @pytest.fixture(scope = "class")
+    def identifiers(self, matrices_fnames, pdb_fname):
+        identifiers, G = ga.build_graph(fname = matrices_fnames[0],
+                                        pdb = pdb_fname)
+        return identifiers
+
+    @pytest.fixture(scope = "class")
+    def sparse_fname(self, matrices, identifiers, tmpdir_factory):
+        fname = str(tmpdir_factory.mktemp("graphs").join("hc-graph.npz"))
+        gio.save_graph(fname = fname,
+                       matrix = matrices[0],
+                       fmt = "%.1f",
+                       identifiers = identifiers,
+                       metadata = {"kind" : "hc"})
+        return fname
+
+    #---------------------------- Tests ------------------------------#
+
+    def test_format_detection(self, matrices_fnames, sparse_fname):
+        assert gio.is_sparse_file(sparse_fname)
+        assert not gio.is_sparse_file(matrices_fnames[0])
+
+    def test_load_graph(self, matrices, identifiers, sparse_fname):
+        matrix, ids, metadata = gio.load_graph(sparse_fname)
+        assert_equal(matrix, matrices[0])
+        assert_equal(ids, identifiers)
+        assert_equal(metadata, {"kind" : "hc"})
+
+    def test_text_header(self, matrices, identifiers, pdb_fname, tmpdir):
+        fname = str(tmpdir.join("hc-graph.dat"))
+        gio.save_graph(fname = fname,
+                       matrix = matrices[0],
+                       fmt = "%.1f",
+                       identifiers = identifiers,
+                       metadata = {"kind" : "hc"})
+        # the header is a comment for plain text readers
+        assert_equal(np.loadtxt(fname), matrices[0])
+        matrix, ids, metadata = gio.load_graph(fname)
+        assert_equal(matrix, matrices[0])
+        assert_equal(ids, identifiers)
+        assert_equal(metadata, {"kind" : "hc"})
+        assert_equal(gio.load_identifiers(fname), identifiers)
+        # no reference structure is needed to name the nodes
+        assert_equal(ga.load_graph_matrix(fname)[0], identifiers)
+        assert_equal(ga.load_graph_matrix(fname,
+                                          pdb = pdb_fname,
+                                          check_pdb = True)[0],
+                     identifiers)
+        # values cannot be written by position to a reference
+        # structure with the residues in a different order
+        gio.save_graph(fname = fname,
+                       matrix = matrices[0],
+                       fmt = "%.1f",
+                       identifiers = identifiers[::-1])
+        with pytest.raises(ValueError):
+            ga.load_graph_matrix(fname, pdb = pdb_fname, check_pdb = True)
+        gio.save_graph(fname = fname, matrix = matrices[0], fmt = "%.1f")
+        assert_equal(gio.load_graph(fname)[1:], (None, {}))
+
+    def test_load_graph_cache(self, matrices, tmpdir):
+        fname = str(tmpdir.join("hc-graph.dat"))
+        np.savetxt(fname, matrices[0], fmt = "%.1f")
+        matrix = gio.load_graph(fname, cache = True)[0]
+        assert os.path.exists(gio.get_cache_fname(fname))
+        assert_equal(gio.load_graph(fname, cache = True)[0], matrix)
+        # the cache is not used once the matrix file changes
+        np.savetxt(fname, matrices[1], fmt = "%.1f")
+        os.utime(fname, ns = (0, 0))
+        assert_equal(gio.load_graph(fname, cache = True)[0], matrices[1])
+
+    def test_load_graphs(self, matrices_fnames, matrices, caplog):
+        graphs = gio.load_graphs(matrices_fnames + ["missing.dat"],
+                                 nprocs = 2)
+        assert graphs[-1] is None
+        for graph, matrix in zip(graphs, matrices):
+            assert_equal(graph[0], matrix)
+        # the cause of the failure is logged
+        assert gio.load_graphs(["missing.dat"], nprocs = 1) == [None]
+        assert caplog.records[-1].exc_info[0] is FileNotFoundError
+
+    def test_is_symmetric(self, matrices):
+        matrix = matrices[0].copy()
+        assert gio.is_symmetric(matrix, blocksize = 100)
+        matrix[0, -1] += 1.0
+        assert not gio.is_symmetric(matrix, blocksize = 100)
+
+    def test_build_graph(self, matrices_fnames, identifiers, sparse_fname):
+        ref_ids, ref_G = ga.build_graph(fname = matrices_fnames[0])
+        # identifiers are read from the sparse file
+        ids, G = ga.build_graph(fname = sparse_fname)
+        assert_equal(ids, identifiers)
+        assert_equal(len(G.nodes()), len(ref_G.nodes()))
+        relabel = dict(zip(ids, ref_ids))
+        edges = [(relabel[u], relabel[v], w) \
+                 for u, v, w in G.edges(data = "weight")]
+        assert_equal(edges, list(ref_G.edges(data = "weight")))
+
+    def test_write_dat(self, matrices, identifiers, tmpdir):
+        fname = str(tmpdir.join("filtered.npz"))
+        fg.write_dat(matrices = matrices,
+                     matrix_filter = 20.0,
+                     out_dat = fname,
+                     identifiers = identifiers)
+        matrix, ids, metadata = gio.load_graph(fname)
+        expected = np.logical_or.reduce([m > 20.0 for m in matrices])
+        assert_equal(matrix, expected.astype(float))
+        assert_equal(ids, identifiers)
+
+
+############################ STARTUP TESTS ############################
+
+class TestStartup(object):
+
+    #--------------------------- Fixtures ----------------------------#
+
+    @pytest.fixture(scope = "class")
+    def heavy_modules(self):
+        return ["MDAnalysis", "pkg_resources", "matplotlib",
+                "scipy", "networkx", "Bio"]
+
+    #---------------------------- Tests ------------------------------#
+
+    @pytest.mark.parametrize("module",
+                             ["pyinteraph", "filter_graph",
+                              "graph_analysis"])
+    def test_help_imports(self, module, heavy_modules, request):
+        # print the help and the heavy modules that were imported
+        code = \
+            "import sys\n" \
+            "sys.argv = ['{0:s}', '--help']\n" \
+            "from pyinteraph import {0:s}\n" \
+            "try:\n" \
+            "    {0:s}.main()\n" \
+            "except SystemExit:\n" \
+            "    pass\n" \
+            "print(sorted(set(m.split('.')[0] for m in sys.modules)))\n"
+        env = dict(os.environ,
+                   PYTHONPATH = os.path.join(request.fspath.dirname, ".."))
+        out = subprocess.run([sys.executable, "-c", code.format(module)],
+                             stdout = subprocess.PIPE,
+                             env = env,
+                             check = True,
+                             universal_newlines = True).stdout
+        imported = eval(out.splitlines()[-1])
+        assert_equal(sorted(set(heavy_modules) & set(imported)), [])